@@ -0,0 +1,309 @@
+import numpy as np
+import tensorflow as tf
+import time
+import pandas as pd
+
+from dynamics import NNDynamicsModel, NNDynamicsStudentModel
+from controllers import RandomController, MPCcontroller, rollout_costs
+from cost_functions import cheetah_cost_fn
+from cheetah_env import HalfCheetahEnvNew
+from data_buffer import DataBufferGeneral
+from utils import sample, compute_normalization
+from proposals import make_proposal
+
+# Offline planner benchmark: fit a dynamics model on random data (or restore one), then measure the best
+# imagined cost the shooting planner reaches per number of sampled paths for every action proposal.
+#
+# python benchmark_planners.py --proposals=uniform,halton,colored,ar,spline,pca --path_counts=25,50,100,200,400
+#
+# With --student_sizes it also distills students of those widths from the model and compares planning with
+# the model and with every student: decision latency and real episode return of the random shooting controller.
+#
+# python benchmark_planners.py --proposals= --student_sizes=32,64,128
+#
+# --quantize_modes checks that planning with the quantized model picks the same action as the float32 model
+# on recorded states, for the same sampled paths.
+#
+# python benchmark_planners.py --proposals= --quantize_modes=int8,float16
+#
+# --horizons sweeps the mpc horizon with and without the terminal value of the ppo value head (restored with the
+# model from a train_mpc_ppo.py checkpoint) and reports the shortest horizon that matches the longest plain one.
+#
+# python benchmark_planners.py --proposals= --model_path=data/<exp> --horizons=3,5,10,15,30
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('env_name', 'HalfCheetah-v1', 'Environment name')
+tf.app.flags.DEFINE_integer('seed', 3, 'random seed')
+tf.app.flags.DEFINE_string('model_path', '', 'Checkpoint directory to restore the dynamics model from, empty fits a new one')
+tf.app.flags.DEFINE_string('out', '', 'Write the results to <out>_<benchmark>.csv')
+
+# Model args, as in train_mpc_ppo.py
+tf.app.flags.DEFINE_float('learning_rate', 1e-3, 'Learning rate')
+tf.app.flags.DEFINE_integer('dyn_iters', 2000, 'dyn_iters')
+tf.app.flags.DEFINE_integer('batch_size', 512, 'batch_size')
+tf.app.flags.DEFINE_boolean('LAYER_NORM', True, """Use layer normalization""")
+tf.app.flags.DEFINE_integer('random_paths', 10, '')
+tf.app.flags.DEFINE_integer('ep_len', 1000, '')
+tf.app.flags.DEFINE_integer('n_layers', 2, '')
+tf.app.flags.DEFINE_integer('size', 256, '')
+
+# Benchmark args
+tf.app.flags.DEFINE_integer('mpc_horizon', 15, '')
+tf.app.flags.DEFINE_integer('num_states', 20, 'Start states, taken from the random data')
+tf.app.flags.DEFINE_integer('repeats', 3, 'Plans per start state and setting')
+tf.app.flags.DEFINE_string('path_counts', '25,50,100,200,400,800', 'Comma separated numbers of sampled paths')
+tf.app.flags.DEFINE_string('proposals', 'uniform,halton,colored,ar,spline,pca', 'Comma separated proposals, see proposals.py')
+tf.app.flags.DEFINE_string('quantize_modes', '', 'Comma separated quantizations (int8, float16) to check against the float32 planner, empty skips')
+tf.app.flags.DEFINE_string('horizons', '', 'Comma separated mpc horizons to sweep with and without the terminal value, empty skips')
+tf.app.flags.DEFINE_float('gamma', 0.99, 'Terminal value discount, the ppo gamma')
+tf.app.flags.DEFINE_float('value_weight', 1., 'Terminal value weight')
+tf.app.flags.DEFINE_string('student_sizes', '', 'Comma separated widths of distilled students to compare with the model, empty skips')
+tf.app.flags.DEFINE_integer('distill_layers', 1, 'Student hidden layers')
+tf.app.flags.DEFINE_integer('distill_iters', 2000, 'Student distillation iterations')
+tf.app.flags.DEFINE_integer('simulated_paths', 400, 'Paths of the controller in the student comparison')
+tf.app.flags.DEFINE_integer('eval_paths', 2, 'Real episodes per model in the student comparison')
+tf.app.flags.DEFINE_integer('eval_len', 200, 'Episode length in the student comparison')
+
+
+def build_model(env, sess):
+    """ Random data, normalization and a fitted (or restored) NNDynamicsModel. With --horizons also the ppo policy
+    (restored from the same checkpoint) for its value head. Returns the model, the data buffer and the policy or None """
+    paths = sample(env, RandomController(env), num_paths=FLAGS.random_paths, horizon=FLAGS.ep_len)
+
+    data_buffer = DataBufferGeneral(FLAGS.random_paths * FLAGS.ep_len, 5)
+    for path in paths:
+        for n in range(len(path['observations'])):
+            data_buffer.add([path['observations'][n],
+                             path['actions'][n],
+                             path['rewards'][n],
+                             path['next_observations'][n],
+                             path['next_observations'][n] - path['observations'][n]])
+
+    dyn_model = NNDynamicsModel(env=env,
+                                n_layers=FLAGS.n_layers,
+                                size=FLAGS.size,
+                                activation=tf.nn.relu,
+                                output_activation=None,
+                                normalization=compute_normalization(data_buffer),
+                                batch_size=FLAGS.batch_size,
+                                iterations=FLAGS.dyn_iters,
+                                learning_rate=FLAGS.learning_rate,
+                                sess=sess)
+
+    policy = None
+    if FLAGS.horizons:
+        from ppo_bc_policy import MlpPolicy
+        policy = MlpPolicy(sess=sess, env=env, hid_size=128, num_hid_layers=2, clip_param=0.2, entcoeff=0.)
+    sess.run(tf.global_variables_initializer())
+
+    checkpoint = tf.train.get_checkpoint_state(FLAGS.model_path) if FLAGS.model_path else None
+    if checkpoint and checkpoint.model_checkpoint_path:
+        # only the dynamics variables, the checkpoint may hold the policy as well
+        saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, dyn_model.scope))
+        saver.restore(sess, checkpoint.model_checkpoint_path)
+        print("Restored dynamics model from ", checkpoint.model_checkpoint_path)
+        if policy is not None:
+            tf.train.Saver(policy.get_variables()).restore(sess, checkpoint.model_checkpoint_path)
+    else:
+        loss, _ = dyn_model.fit(data_buffer)
+        print("Dynamics model fit loss: ", loss)
+
+    return dyn_model, data_buffer, policy
+
+def best_cost(dyn_model, cost_fn, proposal, state, horizon, num_paths):
+    action_paths = proposal.sample(horizon, num_paths)
+    costs = rollout_costs(dyn_model, cost_fn, np.tile(state, [num_paths, 1]), action_paths)
+    best = np.argmin(costs)
+    return costs[best], action_paths[:, best, :]
+
+def benchmark_proposals(env, dyn_model, cost_fn, start_states):
+    """ Mean best imagined cost over start states and repeats for every proposal and number of paths """
+    path_counts = [int(n) for n in FLAGS.path_counts.split(',')]
+    results = []
+
+    for name in FLAGS.proposals.split(','):
+        if name == 'pca':
+            # fit the components on the plans uniform random shooting finds at the largest budget
+            proposal = make_proposal(name, env, min_history=1)
+            uniform = make_proposal('uniform', env)
+            for state in start_states:
+                proposal.update(best_cost(dyn_model, cost_fn, uniform, state, FLAGS.mpc_horizon, path_counts[-1])[1])
+        else:
+            proposal = make_proposal(name, env)
+
+        for num_paths in path_counts:
+            start = time.time()
+            costs = [best_cost(dyn_model, cost_fn, proposal, state, FLAGS.mpc_horizon, num_paths)[0]
+                     for state in start_states for _ in range(FLAGS.repeats)]
+            results.append({"Proposal": name,
+                            "Paths": num_paths,
+                            "ModelRows": num_paths * FLAGS.mpc_horizon,
+                            "MeanBestCost": np.mean(costs),
+                            "StdBestCost": np.std(costs),
+                            "TimePerPlan": (time.time() - start) / len(costs)})
+            print("%-8s paths %5d  best cost %10.3f +- %8.3f" % (name, num_paths, np.mean(costs), np.std(costs)))
+
+    results = pd.DataFrame(results)
+
+    # paths each proposal needs to match uniform sampling at the largest budget
+    target = results[(results.Proposal == 'uniform') & (results.Paths == path_counts[-1])].MeanBestCost
+    if len(target):
+        print("Paths needed to reach the uniform cost at %d paths (%.3f):" % (path_counts[-1], target.iloc[0]))
+        for name, group in results.groupby("Proposal", sort=False):
+            reached = group[group.MeanBestCost <= target.iloc[0]].Paths
+            print("  %-8s %s" % (name, reached.min() if len(reached) else "> %d" % path_counts[-1]))
+
+    return results
+
+def benchmark_quantization(env, dyn_model, data_buffer, cost_fn, start_states):
+    """ Plan from the recorded start states with the float32 model and every quantized numpy copy on the same
+    sampled paths: how often the quantized argmin (and so the action taken) matches, and the float32 cost
+    regret of the quantized choice in cost stds """
+    # float32 model, only to draw the calibration batch the training runs use
+    dyn_model.quantize(None, data_buffer)
+    calibration_state, calibration_action = dyn_model.calibration_batch()
+
+    uniform = make_proposal('uniform', env)
+    results = []
+    for mode in ['float32'] + FLAGS.quantize_modes.split(','):
+        model = dyn_model.export_numpy().quantize(None if mode == 'float32' else mode, calibration_state, calibration_action)
+        np.random.seed(FLAGS.seed)
+        matches, regrets, times = [], [], []
+        for state in start_states:
+            for _ in range(FLAGS.repeats):
+                action_paths = uniform.sample(FLAGS.mpc_horizon, FLAGS.simulated_paths)
+                states = np.tile(state, [FLAGS.simulated_paths, 1])
+                costs = rollout_costs(dyn_model, cost_fn, states, action_paths)
+                start = time.time()
+                quantized_costs = rollout_costs(model, cost_fn, states, action_paths)
+                times.append(time.time() - start)
+
+                choice = np.argmin(quantized_costs)
+                matches.append(choice == np.argmin(costs))
+                regrets.append((costs[choice] - np.min(costs)) / (np.std(costs) + 1e-8))
+        results.append({"Quantization": mode,
+                        "ArgminMatch": np.mean(matches),
+                        "MeanRegret": np.mean(regrets),
+                        "MaxRegret": np.max(regrets),
+                        "TimePerPlan": np.mean(times)})
+        print("%-8s argmin match %.3f  regret %.4f (max %.4f) cost stds  %.4f s/plan" % (mode, np.mean(matches), 
+              np.mean(regrets), np.max(regrets), np.mean(times)))
+
+    return pd.DataFrame(results)
+
+def benchmark_horizons(env, dyn_model, policy, cost_fn):
+    """ Real return of the random shooting controller for every horizon, with and without the terminal value """
+    horizons = [int(h) for h in FLAGS.horizons.split(',')]
+    results = []
+    for terminal_value in [False, True]:
+        for horizon in horizons:
+            controller = MPCcontroller(env=env, 
+                                       dyn_model=dyn_model, 
+                                       horizon=horizon, 
+                                       cost_fn=cost_fn, 
+                                       num_simulated_paths=FLAGS.simulated_paths,
+                                       value_net=policy,
+                                       terminal_value=terminal_value,
+                                       value_weight=FLAGS.value_weight,
+                                       value_discount=FLAGS.gamma)
+            start = time.time()
+            paths = sample(env, controller, num_paths=FLAGS.eval_paths, horizon=FLAGS.eval_len)
+            returns = [np.sum(path['rewards']) for path in paths]
+            results.append({"TerminalValue": terminal_value,
+                            "Horizon": horizon,
+                            "TimePerDecision": (time.time() - start) / (FLAGS.eval_paths * FLAGS.eval_len),
+                            "AverageReturn": np.mean(returns),
+                            "StdReturn": np.std(returns)})
+            print("terminal value %-5s horizon %3d  return %10.3f +- %8.3f  %.4f s/decision" % (terminal_value, horizon, 
+                  np.mean(returns), np.std(returns), results[-1]["TimePerDecision"]))
+
+    results = pd.DataFrame(results)
+
+    # shortest horizon with the terminal value that reaches the return of the longest horizon without it
+    target = results[(~results.TerminalValue) & (results.Horizon == horizons[-1])].AverageReturn.iloc[0]
+    reached = results[results.TerminalValue & (results.AverageReturn >= target)].Horizon
+    print("Return of horizon %d without terminal value: %.3f, shortest horizon reaching it with terminal value: %s" % (
+          horizons[-1], target, reached.min() if len(reached) else "none"))
+    return results
+
+def benchmark_students(env, sess, dyn_model, data_buffer, cost_fn):
+    """ Distill a student per width and plan with the model and every student: seconds per decision, real
+    return and the student's error against the model """
+    students = [NNDynamicsStudentModel(teacher=dyn_model, 
+                                       n_layers=FLAGS.distill_layers, 
+                                       size=int(size), 
+                                       activation=tf.nn.relu, 
+                                       batch_size=FLAGS.batch_size,
+                                       iterations=FLAGS.distill_iters,
+                                       learning_rate=FLAGS.learning_rate,
+                                       sess=sess,
+                                       scope="NNDynamicsStudentModel_%s" % size)
+                for size in FLAGS.student_sizes.split(',')]
+    uninitialized = [v for v in tf.global_variables() if not sess.run(tf.is_variable_initialized(v))]
+    sess.run(tf.variables_initializer(uninitialized))
+
+    results = []
+    for model in [dyn_model] + students:
+        error = model.fit(data_buffer)[1] if model is not dyn_model else 0.
+        controller = MPCcontroller(env=env, 
+                                   dyn_model=model, 
+                                   horizon=FLAGS.mpc_horizon, 
+                                   cost_fn=cost_fn, 
+                                   num_simulated_paths=FLAGS.simulated_paths)
+
+        start = time.time()
+        paths = sample(env, controller, num_paths=FLAGS.eval_paths, horizon=FLAGS.eval_len)
+        returns = [np.sum(path['rewards']) for path in paths]
+        results.append({"Model": model.scope,
+                        "Size": model.size,
+                        "TimePerDecision": (time.time() - start) / (FLAGS.eval_paths * FLAGS.eval_len),
+                        "AverageReturn": np.mean(returns),
+                        "StdReturn": np.std(returns),
+                        "TeacherError": error})
+        print("%-28s size %4d  %.4f s/decision  return %10.3f +- %8.3f  error %.4f" % (model.scope, model.size, 
+              results[-1]["TimePerDecision"], np.mean(returns), np.std(returns), error))
+
+    results = pd.DataFrame(results)
+    # latency gained and return lost relative to planning with the model
+    results["Speedup"] = results.TimePerDecision.iloc[0] / results.TimePerDecision
+    results["ReturnLost"] = results.AverageReturn.iloc[0] - results.AverageReturn
+    print(results[["Model", "Speedup", "ReturnLost"]].to_string(index=False))
+    return results
+
+def main():
+    np.random.seed(FLAGS.seed)
+    tf.set_random_seed(FLAGS.seed)
+
+    # the cost function is only defined for the cheetah
+    assert FLAGS.env_name == "HalfCheetah-v1"
+    env = HalfCheetahEnvNew()
+    env.seed(FLAGS.seed)
+    cost_fn = cheetah_cost_fn
+
+    sess = tf.Session()
+    dyn_model, data_buffer, policy = build_model(env, sess)
+    start_states = data_buffer.sample(FLAGS.num_states)[0]
+
+    if FLAGS.proposals:
+        results = benchmark_proposals(env, dyn_model, cost_fn, start_states)
+        if FLAGS.out:
+            results.to_csv(FLAGS.out + "_proposals.csv", index=False)
+
+    if FLAGS.quantize_modes:
+        results = benchmark_quantization(env, dyn_model, data_buffer, cost_fn, start_states)
+        if FLAGS.out:
+            results.to_csv(FLAGS.out + "_quantization.csv", index=False)
+
+    if FLAGS.horizons:
+        results = benchmark_horizons(env, dyn_model, policy, cost_fn)
+        if FLAGS.out:
+            results.to_csv(FLAGS.out + "_horizons.csv", index=False)
+
+    if FLAGS.student_sizes:
+        results = benchmark_students(env, sess, dyn_model, data_buffer, cost_fn)
+        if FLAGS.out:
+            results.to_csv(FLAGS.out + "_student.csv", index=False)
+
+if __name__ == "__main__":
+    main()
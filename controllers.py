@@ -2,6 +2,244 @@ import numpy as np
 from cost_functions import trajectory_cost_fn
 import time
 import copy
+import multiprocessing
+import threading
+import os
+import sys
+import contextlib
+import numpy_nets
+from proposals import RandomActionPool
+
+def rollout_costs(dyn_model, cost_fn, states, action_paths, gamma=1., terminal_fn=None):
+    """ Roll action_paths [horizon, num_paths, ac_dim] out from states [num_paths, ob_dim] through dyn_model
+    and return the (discounted) cost of every path. If cost_fn is None the dyn_model is expected to predict
+    rewards as well (NNDynamicsRewardModel) and the cost is the negative discounted predicted reward.
+    terminal_fn(final_states) is a terminal value subtracted from the costs (Controller.terminal_values). """
+    costs = np.zeros(action_paths.shape[1])
+
+    for i in range(action_paths.shape[0]):
+        if cost_fn is None:
+            nxt_states, reward = dyn_model.predict(states, action_paths[i])
+            costs -= np.reshape(reward, [-1]) * gamma**i
+        else:
+            nxt_states = dyn_model.predict(states, action_paths[i])
+            costs += cost_fn(states, action_paths[i], nxt_states) * gamma**i
+        states = nxt_states
+
+    if terminal_fn is not None:
+        costs -= terminal_fn(states)
+    return costs
+
+def policy_rollout_costs(dyn_model, cost_fn, policy_net, states, exploration, self_exp=True, explore=1., gamma=1., terminal_fn=None,
+                         num_open_loop=0):
+    """ Roll the policy_net out from states [num_paths, ob_dim] through dyn_model for exploration.shape[0] steps,
+    mixing in the external exploration [horizon, num_paths, ac_dim] when self_exp is False. The first
+    num_open_loop paths replay their exploration open loop (warm start).
+    Returns the cost of every path (negative predicted reward if cost_fn is None, minus terminal_fn of the
+    final states if given) and the action paths taken. """
+    costs = np.zeros(states.shape[0])
+    action_paths = []
+
+    for i in range(exploration.shape[0]):
+        if self_exp:
+            actions, _ = policy_net.act(states, stochastic=True)
+        else:
+            actions, _ = policy_net.act(states, stochastic=False)
+            actions = (1 - explore) * actions + explore * exploration[i, :, :]
+        if num_open_loop:
+            actions[:num_open_loop] = exploration[i, :num_open_loop]
+
+        if cost_fn is None:
+            nxt_states, reward = dyn_model.predict(states, actions)
+            costs -= np.reshape(reward, [-1]) * gamma**i
+        else:
+            nxt_states = dyn_model.predict(states, actions)
+            costs += cost_fn(states, actions, nxt_states) * gamma**i
+        states = nxt_states
+        action_paths.append(actions)
+
+    if terminal_fn is not None:
+        costs -= terminal_fn(states)
+    return costs, np.asarray(action_paths)
+
+def pruned_rollout_costs(dyn_model, cost_fn, states, action_paths, prune_steps, prune_fraction=0.5, value_fn=None, 
+                         policy_net=None, self_exp=True, explore=1., num_open_loop=0, gamma=1., terminal_fn=None):
+    """ Successive halving version of rollout_costs / policy_rollout_costs. After every horizon step listed in
+    prune_steps the worst prune_fraction of the surviving paths (accumulated cost minus the discounted value_fn
+    estimate of their current states, if given) is dropped, so later steps run on shrinking batches.
+    Without policy_net the actions come from action_paths, with a policy_net action_paths is the exploration
+    and its first num_open_loop paths are replayed open loop (warm start). terminal_fn(final_states) of the
+    paths that survive to the end is subtracted from their costs.
+    Returns the costs (inf for pruned paths), the action paths taken and the number of model rows evaluated. """
+    num_paths = states.shape[0]
+    costs = np.zeros(num_paths)
+    taken_paths = np.array(action_paths, copy=True)
+    alive = np.arange(num_paths)
+    model_rows = 0
+
+    for i in range(action_paths.shape[0]):
+        if policy_net is None:
+            actions = action_paths[i, alive, :]
+        else:
+            if self_exp:
+                actions, _ = policy_net.act(states, stochastic=True)
+            else:
+                actions, _ = policy_net.act(states, stochastic=False)
+                actions = (1 - explore) * actions + explore * action_paths[i, alive, :]
+            open_loop = alive < num_open_loop
+            actions[open_loop] = action_paths[i, alive[open_loop], :]
+
+        if cost_fn is None:
+            nxt_states, reward = dyn_model.predict(states, actions)
+            costs[alive] -= np.reshape(reward, [-1]) * gamma**i
+        else:
+            nxt_states = dyn_model.predict(states, actions)
+            costs[alive] += cost_fn(states, actions, nxt_states) * gamma**i
+        model_rows += len(alive)
+        taken_paths[i, alive, :] = actions
+        states = nxt_states
+
+        if (i + 1) in prune_steps and i + 1 < action_paths.shape[0]:
+            scores = costs[alive]
+            if value_fn is not None:
+                scores = scores - gamma**(i + 1) * np.reshape(value_fn(states), [-1])
+            num_keep = max(int(np.ceil(len(alive) * (1 - prune_fraction))), 1)
+            order = np.argsort(scores)
+            keep = order[:num_keep]
+            costs[alive[order[num_keep:]]] = np.inf
+            alive = alive[keep]
+            states = states[keep]
+
+    if terminal_fn is not None:
+        costs[alive] -= terminal_fn(states)
+    return costs, taken_paths, model_rows
+
+def ensemble_rollout_costs(dyn_model, cost_fn, states, action_paths, disagreement_threshold=None, gamma=1., terminal_fn=None):
+    """ Trajectory sampling rollout through an NNDynamicsEnsembleModel: every path is propagated by one randomly
+    drawn ensemble member for the whole horizon. With a disagreement_threshold a path is truncated at the first step
+    where the member disagreement exceeds it, it keeps the cost accumulated so far and is dropped from later batches.
+    terminal_fn(final_states) of the paths that reach the end of the horizon is subtracted from their costs.
+    Returns the costs, the number of model rows evaluated and the number of truncated paths. """
+    num_paths = states.shape[0]
+    costs = np.zeros(num_paths)
+    members = np.random.randint(dyn_model.ensemble_size, size=num_paths)
+    alive = np.arange(num_paths)
+    model_rows = 0
+
+    for i in range(action_paths.shape[0]):
+        actions = action_paths[i, alive, :]
+        if disagreement_threshold is None:
+            nxt_states = dyn_model.predict_ts(states, actions, members[alive])
+        else:
+            nxt_states, disagreement = dyn_model.predict_disagreement(states, actions, members[alive])
+        costs[alive] += cost_fn(states, actions, nxt_states) * gamma**i
+        # the disagreement runs every member on every alive row
+        model_rows += len(alive) if disagreement_threshold is None else dyn_model.ensemble_size * len(alive)
+        states = nxt_states
+
+        if disagreement_threshold is not None:
+            reliable = disagreement <= disagreement_threshold
+            alive = alive[reliable]
+            states = states[reliable]
+            if len(alive) == 0:
+                break
+
+    if terminal_fn is not None and len(alive):
+        costs[alive] -= terminal_fn(states)
+    return costs, model_rows, num_paths - len(alive)
+
+def best_first_actions(costs, action_paths, num_states):
+    """ Split costs [num_states * num_paths] and action_paths [horizon, num_states * num_paths, ac_dim] per root
+    state (paths of a root state are contiguous) and return the first action of the cheapest path of every root. """
+    costs = np.reshape(costs, [num_states, -1])
+    best = np.argmin(costs, axis=1)
+    first_actions = np.reshape(action_paths[0], [num_states, costs.shape[1], -1])
+    return first_actions[np.arange(num_states), best]
+
+def shift_action_path(action_path, env):
+    """ Shift a [horizon, ac_dim] plan one step forward in time and pad the end with a random action """
+    shifted = np.roll(action_path, -1, axis=0)
+    shifted[-1] = env.action_space.sample()
+    return shifted
+
+def shifted_plan(action_path, horizon, env):
+    """ shift_action_path truncated or padded with uniform random actions to horizon steps, the previous plan
+    may be shorter (replanning, adaptive budget) or longer than the current horizon """
+    shifted = shift_action_path(action_path, env)[:horizon]
+    if len(shifted) < horizon:
+        padding = np.random.uniform(low=env.action_space.low, high=env.action_space.high, size=[horizon - len(shifted), shifted.shape[1]])
+        shifted = np.concatenate([shifted, padding], axis=0)
+    return shifted
+
+def warm_start_action_paths(action_paths, prev_action_path, env, noise_std=0.1, fraction=0.5):
+    """ Overwrite the first fraction of action_paths [horizon, num_paths, ac_dim] with noisy copies of the
+    shifted previous plan, path 0 is the exact shifted plan. Returns the action paths and the number of seeded paths. """
+    low, high = env.action_space.low, env.action_space.high
+    num_warm = max(int(action_paths.shape[1] * fraction), 1)
+
+    shifted = shifted_plan(prev_action_path, action_paths.shape[0], env)
+    noise = np.random.normal(size=[action_paths.shape[0], num_warm, action_paths.shape[2]]) * noise_std * (high - low) / 2.
+    noise[:, 0, :] = 0.
+    action_paths[:, :num_warm, :] = np.clip(shifted[:, None, :] + noise, low, high)
+
+    return action_paths, num_warm
+
+def check_budget(adaptive_budget, in_graph):
+    # the in-graph rollout returns only the best path and its cost, the budget needs the costs of all paths
+    if adaptive_budget and in_graph:
+        raise ValueError("the adaptive budget is not supported with in-graph rollouts")
+
+class AdaptiveBudget():
+    """ Grows or shrinks the num_simulated_paths and horizon of a controller between decisions, within bounds.
+    Paths grow when the decision is ambiguous: the gap between the best and second best path cost is below
+    min_gap cost std's. The horizon grows when the new first action disagrees with what the previous plan had
+    scheduled for this step by more than tolerance (fraction of the action range). Otherwise both shrink. """
+    def __init__(self, min_paths, max_paths, min_horizon, max_horizon, min_gap=0.1, tolerance=0.1, growth=1.5):
+        self.min_paths = min_paths
+        self.max_paths = max_paths
+        self.min_horizon = min_horizon
+        self.max_horizon = max_horizon
+        self.min_gap = min_gap
+        self.tolerance = tolerance
+        self.growth = growth
+        self.paths_spent = []
+        self.horizon_spent = []
+        self.rows_spent = []
+
+    # model_rows: rows the decision actually evaluated (pruned and truncated rollouts), paths * horizon if None
+    def update(self, controller, costs, opt_action_path, model_rows=None):
+        self.paths_spent.append(len(costs))
+        self.horizon_spent.append(len(opt_action_path))
+        self.rows_spent.append(len(costs) * len(opt_action_path) if model_rows is None else model_rows)
+
+        costs = costs[np.isfinite(costs)]
+        if len(costs) > 1:
+            best, second = np.partition(costs, 1)[:2]
+            ambiguous = (second - best) / (np.std(costs) + 1e-8) < self.min_gap
+        else:
+            ambiguous = True
+        scale = self.growth if ambiguous else 1. / self.growth
+        controller.num_simulated_paths = int(np.clip(round(controller.num_simulated_paths * scale), self.min_paths, self.max_paths))
+
+        prev_plan = controller.prev_action_path
+        if prev_plan is not None and len(prev_plan) > 1:
+            low, high = controller.env.action_space.low, controller.env.action_space.high
+            deviation = np.mean(np.abs(opt_action_path[0] - prev_plan[1]) / (high - low))
+            step = 1 if deviation > self.tolerance else -1
+            controller.horizon = int(np.clip(controller.horizon + step, self.min_horizon, self.max_horizon))
+
+    # Average paths, horizon and model rows evaluated per decision since the last call, for logging
+    def stats(self):
+        paths = np.mean(self.paths_spent) if self.paths_spent else 0
+        horizon = np.mean(self.horizon_spent) if self.horizon_spent else 0
+        rows = np.mean(self.rows_spent) if self.rows_spent else 0
+        self.paths_spent = []
+        self.horizon_spent = []
+        self.rows_spent = []
+        return paths, horizon, rows
+
+# mutable controller fields copied by Controller.snapshot
+SNAPSHOT_FIELDS = ["prev_action_path", "prev_mean", "nominal_actions", "anytime_samples", "decision_allocations", "adaptive_budget"]
 
 class Controller():
     def __init__(self):
@@ -11,6 +249,97 @@ class Controller():
     def get_action(self, state):
         pass
 
+    # Clear any state kept between calls, called at episode boundaries
+    def reset(self):
+        pass
+
+    # Block until any background planning is done
+    def wait(self):
+        pass
+
+    # Release worker processes and threads, called once at the end of training
+    def close(self):
+        pass
+
+    # Copy of the state a get_action call changes (plans, warm starts, stats, budget, proposal history), the
+    # env, models and workspace buffers are shared. Used to roll back speculative plans (AsyncController)
+    def snapshot(self):
+        state = copy.copy(self.__dict__)
+        for name in SNAPSHOT_FIELDS:
+            if name in state:
+                state[name] = copy.deepcopy(state[name])
+        if getattr(self, "proposal", None) is not None:
+            state["proposal"] = self.proposal.snapshot()
+        return state
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+    # Anytime planning: evaluate chunk_size paths at a time with plan_chunk until the next chunk would
+    # overrun self.deadline (seconds) at the slowest chunk time seen, then play the best path found so far.
+    # The first chunk is warm started from the previous plan, the adaptive budget sees the costs of all chunks
+    def get_action_anytime(self, state):
+        start = time.time()
+        opt_cost = np.inf
+        num_samples = 0
+        chunk_time = 0.
+        warm_start = getattr(self, "warm_start", False) and self.prev_action_path is not None
+        all_costs = []
+
+        while num_samples == 0 or time.time() - start + chunk_time < self.deadline:
+            chunk_start = time.time()
+            costs, action_paths = self.plan_chunk(state, self.chunk_size, warm_start=warm_start and num_samples == 0)
+            all_costs.append(costs)
+
+            best = np.argmin(costs)
+            if costs[best] < opt_cost:
+                opt_cost = costs[best]
+                opt_action_path = action_paths[:, best, :]
+
+            num_samples += len(costs)
+            chunk_time = max(chunk_time, time.time() - chunk_start)
+
+        self.anytime_samples.append(num_samples)
+        if time.time() - start > self.deadline:
+            self.missed_deadlines += 1
+
+        if getattr(self, "adaptive_budget", None):
+            self.adaptive_budget.update(self, np.concatenate(all_costs), opt_action_path)
+        self.prev_action_path = opt_action_path
+        return copy.copy(opt_action_path[0])
+
+    # Discounted terminal value of the final imagined states [num_paths, ob_dim] from the value head (vpred) of
+    # self.value_net, value_weight * value_discount^horizon * vpred in reward units
+    def terminal_values(self, final_states):
+        _, vpred = self.value_net.act(final_states, stochastic=False)
+        return self.value_weight * self.value_discount**self.horizon * np.reshape(vpred, [-1])
+
+    # terminal_values if the controller adds a terminal value, else None, for the rollout helpers
+    def terminal_fn(self):
+        return self.terminal_values if getattr(self, "terminal_value", False) else None
+
+    # Workspace buffers (re)allocated so far by the controller and its dynamics model
+    def workspace_allocations(self):
+        count = self.workspace.allocations
+        model_workspace = getattr(self.dyn_model, "workspace", None)
+        if model_workspace is not None:
+            count += model_workspace.allocations
+        return count
+
+    # Mean workspace (re)allocations per decision since the last call, 0 in steady state, for logging
+    def workspace_stats(self):
+        allocations = np.mean(self.decision_allocations) if getattr(self, "decision_allocations", None) else 0
+        self.decision_allocations = []
+        return allocations
+
+    # Samples per decision and missed deadlines since the last call, for logging
+    def anytime_stats(self):
+        samples = np.mean(self.anytime_samples) if getattr(self, "anytime_samples", None) else 0
+        missed = getattr(self, "missed_deadlines", 0)
+        self.anytime_samples = []
+        self.missed_deadlines = 0
+        return samples, missed
+
 
 class RandomController(Controller):
     def __init__(self, env):
@@ -32,6 +361,23 @@ class MPCcontroller(Controller):
                  cost_fn=None, 
                  num_simulated_paths=10,
                  gamma=1.,
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 in_graph=False,
+                 cost_fn_tf=None,
+                 deadline=None,
+                 chunk_size=100,
+                 prune_steps=None,
+                 prune_fraction=0.5,
+                 prune_value=False,
+                 value_net=None,
+                 ensemble_ts=False,
+                 disagreement_threshold=None,
+                 adaptive_budget=None,
+                 proposal=None,
+                 terminal_value=False,
+                 value_weight=1.,
+                 value_discount=0.99,
                  ):
         self.env = env
         self.dyn_model = dyn_model
@@ -39,8 +385,49 @@ class MPCcontroller(Controller):
         self.cost_fn = cost_fn
         self.num_simulated_paths = num_simulated_paths
         self.gamma = gamma
-
-    def sample_random_actions(self):
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.in_graph = in_graph
+        self.cost_fn_tf = cost_fn_tf
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.anytime_samples = []
+        self.missed_deadlines = 0
+        self.prune_steps = prune_steps
+        self.prune_fraction = prune_fraction
+        # rank the paths at the prune steps by cost minus the value_net value of their current states
+        self.prune_value = prune_value
+        self.value_net = value_net
+        # subtract the discounted value_net value of the final states from the path costs (see terminal_values)
+        self.terminal_value = terminal_value
+        self.value_weight = value_weight
+        self.value_discount = value_discount
+        # trajectory sampling through an NNDynamicsEnsembleModel
+        self.ensemble_ts = ensemble_ts
+        self.disagreement_threshold = disagreement_threshold
+        self.truncated_paths = 0
+        self.adaptive_budget = adaptive_budget
+        check_budget(adaptive_budget, in_graph)
+        # proposals.Proposal generating the sampled action paths, None samples i.i.d. uniform actions
+        self.proposal = proposal
+        # rollout buffers reused by every decision, allocated again only when the horizon or number of paths changes.
+        # States and rewards are float64 like the unbuffered rollouts, the cheetah cost differences absolute positions
+        self.workspace = numpy_nets.Workspace()
+        self.decision_allocations = []
+        self.prev_action_path = None
+        self.model_rows = 0
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def value_fn(self, states):
+        _, vpred = self.value_net.act(states, stochastic=False)
+        return vpred
+
+    def sample_random_actions(self, num_paths=None):
+        num_paths = num_paths or self.num_simulated_paths
+        if self.proposal:
+            return self.proposal.sample(self.horizon, num_paths)
       
         # sample random action trajectories
         # actions = []
@@ -50,39 +437,100 @@ class MPCcontroller(Controller):
 
         # np_action_paths = np.asarray(actions)
         # np_action_paths = np.reshape(np_action_paths, [self.horizon, self.num_simulated_paths, -1])
-        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, self.num_simulated_paths, len(self.env.action_space.high)])
+        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, num_paths, len(self.env.action_space.high)])
 
         return np_action_paths
 
+    def get_actions(self, states):
+        """ Plan for a batch of root states [batch, ob_dim] in one (batch * num_simulated_paths)-row model pass,
+        returns one action per state. The warm start plan is neither used nor updated. """
+        action_paths = self.sample_random_actions(len(states) * self.num_simulated_paths)
+        states = np.repeat(states, self.num_simulated_paths, axis=0)
+
+        costs = rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, terminal_fn=self.terminal_fn())
+        return best_first_actions(costs, action_paths, len(states) // self.num_simulated_paths)
+
+    def plan_chunk(self, state, num_paths, warm_start=False):
+        action_paths = self.sample_random_actions(num_paths)
+        if warm_start:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
+        states = np.tile(state, [num_paths, 1])
+        return rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, terminal_fn=self.terminal_fn()), action_paths
+
     def get_action(self, state):
         """ YOUR CODE HERE """
         """ Note: be careful to batch your simulations through the model for speed """
-        action_paths = self.sample_random_actions()
+        if self.proposal and self.prev_action_path is not None:
+            self.proposal.update(self.prev_action_path)
 
-        # get init observations and copy num_simulated_paths times
-        states = np.tile(state, [self.num_simulated_paths, 1])
+        if self.deadline:
+            return self.get_action_anytime(state)
 
-        states_paths_all = []
-        states_paths_all.append(states)
-
-
-        for i in range(self.horizon):
-            states = self.dyn_model.predict(states, action_paths[i, :, :])
-            states_paths_all.append(states)
+        action_paths = self.sample_random_actions()
 
-        # evaluate trajectories
-        states_paths_all = np.asarray(states_paths_all)
+        if self.warm_start and self.prev_action_path is not None:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
 
-        # batch cost function
+        if self.in_graph:
+            # whole rollout, terminal value and path selection in one sess.run
+            if self.terminal_value:
+                opt_action_path, opt_cost = self.dyn_model.rollout(state, action_paths, cost_fn=self.cost_fn_tf, value_net=self.value_net, 
+                                                                   terminal_weight=self.value_weight * self.value_discount**self.horizon)
+            else:
+                opt_action_path, opt_cost = self.dyn_model.rollout(state, action_paths, cost_fn=self.cost_fn_tf)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        # get init observations and copy num_simulated_paths times, the pruned and ensemble rollouts compact them per step
+        if self.prune_steps or self.ensemble_ts:
+            states = np.tile(state, [self.num_simulated_paths, 1])
+
+        if self.prune_steps:
+            costs, action_paths, self.model_rows = pruned_rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, 
+                                                                        self.prune_steps, self.prune_fraction, 
+                                                                        value_fn=self.value_fn if self.prune_value else None,
+                                                                        terminal_fn=self.terminal_fn())
+            opt_action_path = action_paths[:, np.argmin(costs), :]
+            if self.adaptive_budget:
+                self.adaptive_budget.update(self, costs, opt_action_path, self.model_rows)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        if self.ensemble_ts:
+            costs, self.model_rows, self.truncated_paths = ensemble_rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, 
+                                                                                  self.disagreement_threshold, self.gamma, 
+                                                                                  terminal_fn=self.terminal_fn())
+            opt_action_path = action_paths[:, np.argmin(costs), :]
+            if self.adaptive_budget:
+                self.adaptive_budget.update(self, costs, opt_action_path, self.model_rows)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        allocations = self.workspace_allocations()
+        states_paths_all = self.workspace.get("states", [self.horizon + 1, self.num_simulated_paths, len(state)], dtype=np.float64)
+        states_paths_all[0] = state
+
+        # every path starts from the root state, its half of the first layer is computed once
+        self.dyn_model.predict_shared(state, action_paths[0], out=states_paths_all[1])
+        for i in range(1, self.horizon):
+            self.dyn_model.predict(states_paths_all[i], action_paths[i, :, :], out=states_paths_all[i + 1])
+
+        # batch cost function on views of the workspace
         states_paths = states_paths_all[:-1, :, :]
         states_nxt_paths = states_paths_all[1:, :, :]
 
         costs = trajectory_cost_fn(self.cost_fn, states_paths, action_paths, states_nxt_paths)
+        if self.terminal_value:
+            costs = costs - self.terminal_values(states_paths_all[-1])
+        self.decision_allocations.append(self.workspace_allocations() - allocations)
 
         min_cost_path = np.argmin(costs)
         opt_cost = costs[min_cost_path]
         opt_action_path = action_paths[:, min_cost_path, :]
         opt_action = copy.copy(opt_action_path[0])
+        if self.adaptive_budget:
+            self.adaptive_budget.update(self, costs, opt_action_path)
+        self.prev_action_path = opt_action_path
 
         # print("MPC imagine min cost: ", opt_cost)
         return opt_action
@@ -96,7 +544,14 @@ class MPCcontrollerReward(Controller):
                  cost_fn=None, 
                  num_simulated_paths=10,
                  gamma=1.,
-
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 in_graph=False,
+                 cost_fn_tf=None,
+                 deadline=None,
+                 chunk_size=100,
+                 adaptive_budget=None,
+                 proposal=None,
                  ):
         self.env = env
         self.dyn_model = dyn_model
@@ -104,38 +559,85 @@ class MPCcontrollerReward(Controller):
         self.cost_fn = cost_fn
         self.num_simulated_paths = num_simulated_paths
         self.gamma = gamma
-
-    def sample_random_actions(self):
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.in_graph = in_graph
+        self.cost_fn_tf = cost_fn_tf
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.anytime_samples = []
+        self.missed_deadlines = 0
+        self.adaptive_budget = adaptive_budget
+        check_budget(adaptive_budget, in_graph)
+        # proposals.Proposal generating the sampled action paths, None samples i.i.d. uniform actions
+        self.proposal = proposal
+        # rollout buffers reused by every decision, allocated again only when the horizon or number of paths changes
+        self.workspace = numpy_nets.Workspace()
+        self.decision_allocations = []
+        self.prev_action_path = None
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def sample_random_actions(self, num_paths=None):
+        num_paths = num_paths or self.num_simulated_paths
+        if self.proposal:
+            return self.proposal.sample(self.horizon, num_paths)
       
         # sample random action trajectories
-        actions = []
-        for n in range(self.num_simulated_paths):
-            for h in range(self.horizon):
-                actions.append(self.env.action_space.sample())
-
-        np_action_paths = np.asarray(actions)
-        np_action_paths = np.reshape(np_action_paths, [self.horizon, self.num_simulated_paths, -1])
+        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, num_paths, len(self.env.action_space.high)])
 
         return np_action_paths
 
+    def get_actions(self, states):
+        """ Plan for a batch of root states [batch, ob_dim] in one (batch * num_simulated_paths)-row model pass,
+        returns one action per state. The warm start plan is neither used nor updated. """
+        action_paths = self.sample_random_actions(len(states) * self.num_simulated_paths)
+        states = np.repeat(states, self.num_simulated_paths, axis=0)
+
+        costs = rollout_costs(self.dyn_model, None, states, action_paths, self.gamma)
+        return best_first_actions(costs, action_paths, len(states) // self.num_simulated_paths)
+
+    def plan_chunk(self, state, num_paths, warm_start=False):
+        action_paths = self.sample_random_actions(num_paths)
+        if warm_start:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
+        states = np.tile(state, [num_paths, 1])
+        return rollout_costs(self.dyn_model, None, states, action_paths, self.gamma), action_paths
+
     def get_action(self, state):
 
         """ YOUR CODE HERE """
         """ Note: be careful to batch your simulations through the model for speed """
 
+        if self.proposal and self.prev_action_path is not None:
+            self.proposal.update(self.prev_action_path)
+
+        if self.deadline:
+            return self.get_action_anytime(state)
+
         action_paths = self.sample_random_actions()
 
-        # get init observations and copy num_simulated_paths times
-        states = np.tile(state, [self.num_simulated_paths, 1])
+        if self.warm_start and self.prev_action_path is not None:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
 
-        # states_paths_all = []
-        rewards_all = []
-        # states_paths_all.append(states)
+        if self.in_graph:
+            opt_action_path, opt_imgreward = self.dyn_model.rollout(state, action_paths, gamma=self.gamma)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        allocations = self.workspace_allocations()
+        states_paths_all = self.workspace.get("states", [self.horizon + 1, self.num_simulated_paths, len(state)], dtype=np.float64)
+        rewards_all = self.workspace.get("rewards", [self.horizon, self.num_simulated_paths], dtype=np.float64)
+        states_paths_all[0] = state
 
         for i in range(self.horizon):
-            states, reward = self.dyn_model.predict(states, action_paths[i, :, :])
-            # states_paths_all.append(states)
-            rewards_all.append(reward*self.gamma**i)
+            if i == 0:
+                # every path starts from the root state, its half of the first layer is computed once
+                _, reward = self.dyn_model.predict_shared(state, action_paths[0], out=states_paths_all[1])
+            else:
+                _, reward = self.dyn_model.predict(states_paths_all[i], action_paths[i, :, :], out=states_paths_all[i + 1])
+            np.multiply(reward[:, 0], self.gamma**i, out=rewards_all[i])
 
         # # evaluate trajectories
         # states_paths_all = np.asarray(states_paths_all)
@@ -146,13 +648,15 @@ class MPCcontrollerReward(Controller):
 
         # costs = trajectory_cost_fn(self.cost_fn, states_paths, action_paths, states_nxt_paths)
 
-        rewards_all = np.asarray(rewards_all)
         rewards_all = np.sum(rewards_all, axis=0)
-        rewards_all = np.reshape(rewards_all, [-1])
+        self.decision_allocations.append(self.workspace_allocations() - allocations)
         min_cost_path = np.argmax(rewards_all)
         opt_imgreward = rewards_all[min_cost_path]
         opt_action_path = action_paths[:, min_cost_path, :]
         opt_action = copy.copy(opt_action_path[0])
+        if self.adaptive_budget:
+            self.adaptive_budget.update(self, -rewards_all, opt_action_path)
+        self.prev_action_path = opt_action_path
 
         # print("MPC imagine min cost: ", opt_imgreward)
         return opt_action
@@ -168,54 +672,166 @@ class MPCcontrollerPolicyNet(Controller):
                  horizon=5, 
                  cost_fn=None, 
                  num_simulated_paths=10,
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 in_graph=False,
+                 cost_fn_tf=None,
+                 deadline=None,
+                 chunk_size=100,
+                 prune_steps=None,
+                 prune_fraction=0.5,
+                 prune_value=False,
+                 adaptive_budget=None,
+                 proposal=None,
+                 terminal_value=False,
+                 value_weight=1.,
+                 value_discount=0.99,
                  ):
         self.env = env
         self.dyn_model = dyn_model
         self.policy_net = policy_net
+        # add the discounted policy value of the final states to the path returns (see terminal_values)
+        self.value_net = policy_net
+        self.terminal_value = terminal_value
+        self.value_weight = value_weight
+        self.value_discount = value_discount
         self.horizon = horizon
         self.cost_fn = cost_fn
         self.num_simulated_paths = num_simulated_paths
         self.self_exp = self_exp
         self.explore = explore
-
-    def sample_random_actions(self):
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.in_graph = in_graph
+        self.cost_fn_tf = cost_fn_tf
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.anytime_samples = []
+        self.missed_deadlines = 0
+        self.prune_steps = prune_steps
+        self.prune_fraction = prune_fraction
+        self.prune_value = prune_value
+        self.adaptive_budget = adaptive_budget
+        check_budget(adaptive_budget, in_graph)
+        # proposals.Proposal generating the sampled action paths, None samples i.i.d. uniform actions
+        self.proposal = proposal
+        # rollout buffers reused by every decision, allocated again only when the horizon or number of paths changes
+        self.workspace = numpy_nets.Workspace()
+        self.decision_allocations = []
+        self.prev_action_path = None
+        self.model_rows = 0
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def value_fn(self, states):
+        _, vpred = self.policy_net.act(states, stochastic=False)
+        return vpred
+
+    def sample_random_actions(self, num_paths=None):
+        num_paths = num_paths or self.num_simulated_paths
+        if self.proposal:
+            return self.proposal.sample(self.horizon, num_paths)
       
         # sample random action trajectories
-        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, self.num_simulated_paths, len(self.env.action_space.high)])
+        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, num_paths, len(self.env.action_space.high)])
 
         return np_action_paths
 
+    def get_actions(self, states):
+        """ Plan for a batch of root states [batch, ob_dim] in one (batch * num_simulated_paths)-row pass through
+        the policy and the model per horizon step, returns one action per state. The warm start plan is neither used nor updated. """
+        exploration = self.sample_random_actions(len(states) * self.num_simulated_paths)
+        states = np.repeat(states, self.num_simulated_paths, axis=0)
+
+        costs, action_paths = policy_rollout_costs(self.dyn_model, self.cost_fn, self.policy_net, states, exploration, 
+                                                   self.self_exp, self.explore, terminal_fn=self.terminal_fn())
+        return best_first_actions(costs, action_paths, len(states) // self.num_simulated_paths)
+
+
+    def plan_chunk(self, state, num_paths, warm_start=False):
+        exploration = self.sample_random_actions(num_paths)
+        num_warm = 0
+        if warm_start:
+            # warm paths are replayed open loop
+            warm_paths, num_warm = warm_start_action_paths(self.sample_random_actions(num_paths), self.prev_action_path, self.env, self.warm_start_std)
+            exploration[:, :num_warm] = warm_paths[:, :num_warm]
+        states = np.tile(state, [num_paths, 1])
+        return policy_rollout_costs(self.dyn_model, self.cost_fn, self.policy_net, states, exploration, self.self_exp, self.explore, 
+                                    terminal_fn=self.terminal_fn(), num_open_loop=num_warm)
 
     def get_action(self, state):
         """ YOUR CODE HERE """
         """ Note: be careful to batch your simulations through the model for speed """
-        exploration = self.sample_random_actions()
+        if self.proposal and self.prev_action_path is not None:
+            self.proposal.update(self.prev_action_path)
 
-        # get init observations and copy num_simulated_paths times
-        states = np.tile(state, [self.num_simulated_paths, 1])
+        if self.deadline:
+            return self.get_action_anytime(state)
 
-        states_paths_all = []
-        action_paths = []
-        states_paths_all.append(states)
+        exploration = self.sample_random_actions()
+
+        # the first num_warm paths replay the shifted previous plan open loop instead of following the policy
+        num_warm = 0
+        if self.warm_start and self.prev_action_path is not None:
+            warm_paths, num_warm = warm_start_action_paths(self.sample_random_actions(), self.prev_action_path, self.env, self.warm_start_std)
+
+        if self.in_graph:
+            # policy, model and cost unrolled in one sess.run, warm paths ride in the exploration rows
+            if num_warm:
+                exploration[:, :num_warm] = warm_paths[:, :num_warm]
+            opt_action_path, opt_cost = self.dyn_model.rollout(state, exploration, cost_fn=self.cost_fn_tf, policy_net=self.policy_net, 
+                                                               self_exp=self.self_exp, explore=self.explore, num_open_loop=num_warm,
+                                                               value_net=self.policy_net if self.terminal_value else None,
+                                                               terminal_weight=self.value_weight * self.value_discount**self.horizon)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        if self.prune_steps:
+            # get init observations and copy num_simulated_paths times, the pruned rollout compacts them per step
+            states = np.tile(state, [self.num_simulated_paths, 1])
+            if num_warm:
+                exploration[:, :num_warm] = warm_paths[:, :num_warm]
+            costs, action_paths, self.model_rows = pruned_rollout_costs(self.dyn_model, self.cost_fn, states, exploration, 
+                                                                        self.prune_steps, self.prune_fraction, 
+                                                                        value_fn=self.value_fn if self.prune_value else None,
+                                                                        policy_net=self.policy_net, self_exp=self.self_exp, 
+                                                                        explore=self.explore, num_open_loop=num_warm, 
+                                                                        terminal_fn=self.terminal_fn())
+            opt_action_path = action_paths[:, np.argmin(costs), :]
+            if self.adaptive_budget:
+                self.adaptive_budget.update(self, costs, opt_action_path, self.model_rows)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        allocations = self.workspace_allocations()
+        states_paths_all = self.workspace.get("states", [self.horizon + 1, self.num_simulated_paths, len(state)], dtype=np.float64)
+        action_paths = self.workspace.get("actions", exploration.shape)
+        states_paths_all[0] = state
 
         for i in range(self.horizon):
             if self.self_exp:
-                actions, _ = self.policy_net.act(states, stochastic=True)
+                action_paths[i], _ = self.policy_net.act(states_paths_all[i], stochastic=True)
             else:
-                actions, _ = self.policy_net.act(states, stochastic=False)
+                if i == 0:
+                    # deterministic policy at the root, one row broadcast to every path
+                    action_paths[i], _ = self.policy_net.act(states_paths_all[0, :1], stochastic=False)
+                else:
+                    action_paths[i], _ = self.policy_net.act(states_paths_all[i], stochastic=False)
                 # actions += np.random.rand(self.num_simulated_paths, self.env.action_space.shape[0]) * (2*self.explore) - self.explore
 
-                actions = (1 - self.explore) * actions + self.explore * exploration[i, :, :]
-
-            states = self.dyn_model.predict(states, actions)
+                # (1 - explore) * actions + explore * exploration, in place
+                action_paths[i] *= 1 - self.explore
+                exploration[i] *= self.explore
+                action_paths[i] += exploration[i]
 
-            # states = self.dyn_model.predict(states, action_paths[i, :, :])
-            states_paths_all.append(states)
-            action_paths.append(actions)
+            if num_warm:
+                action_paths[i, :num_warm] = warm_paths[i, :num_warm]
 
-        # evaluate trajectories
-        states_paths_all = np.asarray(states_paths_all)
-        action_paths = np.asarray(action_paths)
+            if i == 0:
+                self.dyn_model.predict_shared(state, action_paths[0], out=states_paths_all[1])
+            else:
+                self.dyn_model.predict(states_paths_all[i], action_paths[i], out=states_paths_all[i + 1])
 
 
         # batch cost function
@@ -227,11 +843,18 @@ class MPCcontrollerPolicyNet(Controller):
         # print("states_nxt_paths: ", states_nxt_paths.shape)
 
         costs = trajectory_cost_fn(self.cost_fn, states_paths, action_paths, states_nxt_paths)
+        if self.terminal_value:
+            costs = costs - self.terminal_values(states_paths_all[-1])
+        self.decision_allocations.append(self.workspace_allocations() - allocations)
 
         min_cost_path = np.argmin(costs)
         opt_cost = costs[min_cost_path]
-        opt_action_path = action_paths[:, min_cost_path, :]
+        # copied out of the workspace, the next decision overwrites it
+        opt_action_path = np.array(action_paths[:, min_cost_path, :])
         opt_action = copy.copy(opt_action_path[0])
+        if self.adaptive_budget:
+            self.adaptive_budget.update(self, costs, opt_action_path)
+        self.prev_action_path = opt_action_path
 
         # print("MPC imagine min cost: ", opt_cost)
         return opt_action
@@ -297,72 +920,160 @@ class MPCcontrollerPolicyNetReward(Controller):
                  horizon=5, 
                  cost_fn=None, 
                  num_simulated_paths=10,
-                 gamma=1.
+                 gamma=1.,
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 in_graph=False,
+                 cost_fn_tf=None,
+                 deadline=None,
+                 chunk_size=100,
+                 adaptive_budget=None,
+                 proposal=None,
+                 terminal_value=False,
+                 value_weight=1.,
+                 value_discount=0.99,
                  ):
         self.env = env
         self.dyn_model = dyn_model
         self.policy_net = policy_net
+        # add the discounted policy value of the final states to the path returns (see terminal_values)
+        self.value_net = policy_net
+        self.terminal_value = terminal_value
+        self.value_weight = value_weight
+        self.value_discount = value_discount
         self.horizon = horizon
         self.cost_fn = cost_fn
         self.num_simulated_paths = num_simulated_paths
         self.self_exp = self_exp
         self.explore = explore
         self.gamma = gamma
-
-    def sample_random_actions(self):
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.in_graph = in_graph
+        self.cost_fn_tf = cost_fn_tf
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.anytime_samples = []
+        self.missed_deadlines = 0
+        self.adaptive_budget = adaptive_budget
+        check_budget(adaptive_budget, in_graph)
+        # proposals.Proposal generating the sampled action paths, None samples i.i.d. uniform actions
+        self.proposal = proposal
+        # rollout buffers reused by every decision, allocated again only when the horizon or number of paths changes
+        self.workspace = numpy_nets.Workspace()
+        self.decision_allocations = []
+        self.prev_action_path = None
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def sample_random_actions(self, num_paths=None):
+        num_paths = num_paths or self.num_simulated_paths
+        if self.proposal:
+            return self.proposal.sample(self.horizon, num_paths)
       
         # sample random action trajectories
-        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, self.num_simulated_paths, len(self.env.action_space.high)])
+        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, num_paths, len(self.env.action_space.high)])
 
         return np_action_paths
 
+    def get_actions(self, states):
+        """ Plan for a batch of root states [batch, ob_dim] in one (batch * num_simulated_paths)-row pass through
+        the policy and the model per horizon step, returns one action per state. The warm start plan is neither used nor updated. """
+        exploration = self.sample_random_actions(len(states) * self.num_simulated_paths)
+        states = np.repeat(states, self.num_simulated_paths, axis=0)
+
+        costs, action_paths = policy_rollout_costs(self.dyn_model, None, self.policy_net, states, exploration, 
+                                                   self.self_exp, self.explore, terminal_fn=self.terminal_fn())
+        return best_first_actions(costs, action_paths, len(states) // self.num_simulated_paths)
+
+    def plan_chunk(self, state, num_paths, warm_start=False):
+        exploration = self.sample_random_actions(num_paths)
+        num_warm = 0
+        if warm_start:
+            # warm paths are replayed open loop
+            warm_paths, num_warm = warm_start_action_paths(self.sample_random_actions(num_paths), self.prev_action_path, self.env, self.warm_start_std)
+            exploration[:, :num_warm] = warm_paths[:, :num_warm]
+        states = np.tile(state, [num_paths, 1])
+        return policy_rollout_costs(self.dyn_model, None, self.policy_net, states, exploration, self.self_exp, self.explore, 
+                                    terminal_fn=self.terminal_fn(), num_open_loop=num_warm)
+
     def get_action(self, state):
 
         """ YOUR CODE HERE """
         """ Note: be careful to batch your simulations through the model for speed """
-        exploration = self.sample_random_actions()
+        if self.proposal and self.prev_action_path is not None:
+            self.proposal.update(self.prev_action_path)
 
-        # get init observations and copy num_simulated_paths times
-        states = np.tile(state, [self.num_simulated_paths, 1])
-        states_paths_all = []
-        action_paths = []
-        states_paths_all.append(states)
+        if self.deadline:
+            return self.get_action_anytime(state)
 
-        rewards_all = []
-        action_paths = []
+        exploration = self.sample_random_actions()
+
+        num_warm = 0
+        if self.warm_start and self.prev_action_path is not None:
+            warm_paths, num_warm = warm_start_action_paths(self.sample_random_actions(), self.prev_action_path, self.env, self.warm_start_std)
+
+        if self.in_graph:
+            if num_warm:
+                exploration[:, :num_warm] = warm_paths[:, :num_warm]
+            opt_action_path, opt_imgreward = self.dyn_model.rollout(state, exploration, policy_net=self.policy_net, 
+                                                                    self_exp=self.self_exp, explore=self.explore, num_open_loop=num_warm,
+                                                                    value_net=self.policy_net if self.terminal_value else None,
+                                                                    terminal_weight=self.value_weight * self.value_discount**self.horizon)
+            self.prev_action_path = opt_action_path
+            return copy.copy(opt_action_path[0])
+
+        allocations = self.workspace_allocations()
+        states_paths_all = self.workspace.get("states", [self.horizon + 1, self.num_simulated_paths, len(state)], dtype=np.float64)
+        action_paths = self.workspace.get("actions", exploration.shape)
+        rewards_all = self.workspace.get("rewards", [self.horizon, self.num_simulated_paths], dtype=np.float64)
+        states_paths_all[0] = state
 
         for i in range(self.horizon):
             if self.self_exp:
-                actions, _ = self.policy_net.act(states, stochastic=True)
+                action_paths[i], _ = self.policy_net.act(states_paths_all[i], stochastic=True)
             else:
-                actions, _ = self.policy_net.act(states, stochastic=False)
+                if i == 0:
+                    # deterministic policy at the root, one row broadcast to every path
+                    action_paths[i], _ = self.policy_net.act(states_paths_all[0, :1], stochastic=False)
+                else:
+                    action_paths[i], _ = self.policy_net.act(states_paths_all[i], stochastic=False)
                 # actions += np.random.rand(self.num_simulated_paths, self.env.action_space.shape[0]) * (2*self.explore) - self.explore
-                actions = (1 - self.explore) * actions + self.explore * exploration[i, :, :]
-
-            states, reward = self.dyn_model.predict(states, actions)
+                action_paths[i] *= 1 - self.explore
+                exploration[i] *= self.explore
+                action_paths[i] += exploration[i]
 
-            # states = self.dyn_model.predict(states, action_paths[i, :, :])
-            states_paths_all.append(states)
-            action_paths.append(actions)
-            rewards_all.append(reward)
+            if num_warm:
+                action_paths[i, :num_warm] = warm_paths[i, :num_warm]
 
-        # evaluate trajectories
-        action_paths = np.asarray(action_paths)
-        rewards_all = np.asarray(rewards_all)
+            if i == 0:
+                _, reward = self.dyn_model.predict_shared(state, action_paths[0], out=states_paths_all[1])
+            else:
+                _, reward = self.dyn_model.predict(states_paths_all[i], action_paths[i], out=states_paths_all[i + 1])
+            rewards_all[i] = reward[:, 0]
 
         rewards_all = np.sum(rewards_all, axis=0)
-        rewards_all = np.reshape(rewards_all, [-1])
-
-        print("rewards_all", rewards_all.shape)
+        if self.terminal_value:
+            rewards_all += self.terminal_values(states_paths_all[-1])
+        self.decision_allocations.append(self.workspace_allocations() - allocations)
 
         max_reward_path = np.argmax(rewards_all)
         opt_imgreward = rewards_all[max_reward_path]
-        opt_action_path = action_paths[:, max_reward_path, :]
+        # copied out of the workspace, the next decision overwrites it
+        opt_action_path = np.array(action_paths[:, max_reward_path, :])
         opt_action = copy.copy(opt_action_path[0])
+        if self.adaptive_budget:
+            self.adaptive_budget.update(self, -rewards_all, opt_action_path)
+        self.prev_action_path = opt_action_path
 
         return opt_action
 
 class MCTScontrollerPolicyNetReward(Controller):
+    """ Two stage search: num_first_stage_actions candidate first actions, each followed by random_path_per_action
+    policy rollouts mixed with rollout_explore of random exploration. The downstream rollout of the baseline
+    (rollout_explore 0, deterministic policy and model) is deterministic: each candidate is then rolled out
+    once, random_path_per_action is unused and common_random_numbers is only a guard for rollout_explore > 0. """
     def __init__(self, 
                  env, 
                  dyn_model,
@@ -374,6 +1085,10 @@ class MCTScontrollerPolicyNetReward(Controller):
                  num_first_stage_actions=10, 
                  random_path_per_action=10,
                  random_first_stage_action = False,
+                 warm_start=False,
+                 common_random_numbers=True,
+                 rollout_explore=0.,
+                 proposal=None,
                  ):
 
         self.env = env
@@ -386,58 +1101,71 @@ class MCTScontrollerPolicyNetReward(Controller):
         self.self_exp = self_exp
         self.explore = explore
         self.random_first_stage_action = random_first_stage_action
+        self.warm_start = warm_start
+        self.common_random_numbers = common_random_numbers
+        self.rollout_explore = rollout_explore
+        # proposals.Proposal (e.g. a shared RandomActionPool) for the random actions, None samples np.random.uniform
+        self.proposal = proposal
+        self.prev_action_path = None
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def sample_random_actions(self, num_paths, horizon=None):
+        horizon = horizon or self.horizon
+        if self.proposal:
+            return self.proposal.sample(horizon, num_paths)
 
-    def sample_random_actions(self):
-      
         # sample random action trajectories
-        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[self.horizon, self.num_simulated_paths, len(self.env.action_space.high)])
+        np_action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high , size=[horizon, num_paths, len(self.env.action_space.high)])
 
         return np_action_paths
 
     def get_action(self, state):
+        # first stage: all candidate actions through one policy call and one model call from the shared root
+        if self.random_first_stage_action:
+            action_1s = np.array(self.sample_random_actions(self.num_first_stage_actions, horizon=1)[0])
+        elif self.self_exp:
+            action_1s, _ = self.policy_net.act(np.tile(state, [self.num_first_stage_actions, 1]), stochastic=True)
+        else:
+            action_1s, _ = self.policy_net.act(np.reshape(state, [1, -1]), stochastic=False)
+            action_1s = np.tile(action_1s, [self.num_first_stage_actions, 1])
+
+        if self.warm_start and self.prev_action_path is not None:
+            # keep the surviving branch of the previous search as a first stage candidate
+            action_1s[0] = self.prev_action_path[0]
+
+        state_1s, reward_1s = self.dyn_model.predict_shared(state, action_1s)
+        reward_1s = np.reshape(reward_1s, [-1])
+
+        # following stages, random_path_per_action rows per candidate. Without rollout_explore the downstream
+        # rollout is deterministic and the rows of a candidate identical, so one row per candidate is enough
+        rows = self.random_path_per_action if self.rollout_explore else 1
+        if not self.rollout_explore:
+            exploration = None
+        elif self.common_random_numbers:
+            # every candidate sees the same downstream noise, so differences in return come from the first action only
+            exploration = np.tile(self.sample_random_actions(rows), [1, self.num_first_stage_actions, 1])
+        else:
+            exploration = self.sample_random_actions(self.num_first_stage_actions * rows)
 
-        best_action1_idx = 0
-        best_reward = None
-        action_1s = []
-        state_init = np.expand_dims(state, axis=0)
-        states_all_actions = []
-        reward_1s = []
-        for action_idx in range(self.num_first_stage_actions):
-            total_reward = 0
-
-            if self.random_first_stage_action:
-                action_1 = self.env.action_space.sample()
-                action_1 = np.expand_dims(action_1, axis=0)
-            else:
-                if self.self_exp:
-                    action_1, _ = self.policy_net.act(state_init, stochastic=True)
-                else:
-                    action_1, _ = self.policy_net.act(state_init, stochastic=False)
-            
-            state_1, reward_1 = self.dyn_model.predict(state_init, action_1)
-            reward_1s.append(reward_1[0][0])
-            action_1s.append(action_1)
-
-            # following stages
-            rewards_all = []
-            states = np.tile(state_1, [self.random_path_per_action, 1])
-            states_all_actions.append(states)
-        
-        states_all_actions = np.asarray(states_all_actions)
-        
-        states = states_all_actions.reshape((-1,state.shape[0]))
-
+        rewards_all = []
+        action_paths = []
         for i in range(self.horizon):
+            if i == 0:
+                # the rows of a candidate are copies of its state: policy once per candidate, shared first layer
+                actions, _ = self.policy_net.act(state_1s, stochastic=False)
+                actions = np.repeat(actions, rows, axis=0)
+            else:
+                actions, _ = self.policy_net.act(states, stochastic=False)
+            if self.rollout_explore:
+                actions = (1 - self.rollout_explore) * actions + self.rollout_explore * exploration[i, :, :]
+            action_paths.append(actions)
 
-            actions, _ = self.policy_net.act(states, stochastic=False)
-            
-            # if self.self_exp:
-            #     actions, _ = self.policy_net.act(states, stochastic=True)
-            # else:
-            #     actions, _ = self.policy_net.act(states, stochastic=False)
-
-            states, reward = self.dyn_model.predict(states, actions)
-            # states = self.dyn_model.predict(states, action_paths[i, :, :])
+            if i == 0:
+                states, reward = self.dyn_model.predict_shared(state_1s, actions)
+            else:
+                states, reward = self.dyn_model.predict(states, actions)
             rewards_all.append(reward)
 
         rewards_all = np.asarray(rewards_all)
@@ -446,22 +1174,896 @@ class MCTScontrollerPolicyNetReward(Controller):
         rewards_all = rewards_all.reshape((self.num_first_stage_actions, -1))
 
         rewards_all_mean = np.mean(rewards_all, axis=1)
-        reward_1s = np.asarray(reward_1s)
         total_rewards = reward_1s + rewards_all_mean
-        
 
         best_action1_idx = np.argmax(total_rewards)
 
-        opt_action = action_1s[best_action1_idx]
+        opt_action = copy.copy(action_1s[best_action1_idx:best_action1_idx + 1])
+
+        # surviving subtree: the best downstream path below the chosen first action
+        best_path = best_action1_idx * rewards_all.shape[1] + np.argmax(rewards_all[best_action1_idx])
+        self.prev_action_path = np.asarray(action_paths)[:, best_path, :]
 
         return opt_action
 
+class CEMcontroller(Controller):
+    """ Cross entropy method planner. Every iteration samples num_simulated_paths action sequences from a diagonal
+    Gaussian, rolls them out through dyn_model and refits the Gaussian to the num_elites cheapest ones.
+    The total model budget per step is iterations * num_simulated_paths paths. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=5, 
+                 cost_fn=None, 
+                 num_simulated_paths=10,
+                 num_elites=None,
+                 iterations=5,
+                 alpha=0.1,
+                 gamma=1.,
+                 warm_start=False,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.horizon = horizon
+        self.cost_fn = cost_fn
+        self.num_simulated_paths = num_simulated_paths
+        self.num_elites = num_elites or max(num_simulated_paths // 10, 1)
+        self.iterations = iterations
+        self.alpha = alpha
+        self.gamma = gamma
+        self.warm_start = warm_start
+        self.prev_mean = None
+        self.prev_action_path = None
+
+        self.ac_low = self.env.action_space.low
+        self.ac_high = self.env.action_space.high
 
+    def reset(self):
+        self.prev_mean = None
+        self.prev_action_path = None
 
+    def init_distribution(self):
+        mean = np.tile((self.ac_high + self.ac_low) / 2., [self.horizon, 1])
+        std = np.tile((self.ac_high - self.ac_low) / 4., [self.horizon, 1])
+        return mean, std
 
+    def sample_actions(self, mean, std):
+        noise = np.random.normal(size=[self.horizon, self.num_simulated_paths, len(self.ac_high)])
+        np_action_paths = mean[:, None, :] + std[:, None, :] * noise
+        return np.clip(np_action_paths, self.ac_low, self.ac_high)
 
+    def get_action(self, state):
+        mean, std = self.init_distribution()
 
+        if self.warm_start and self.prev_mean is not None:
+            # shift the previous mean past the steps taken since it was planned (ReplanController leaves only the
+            # unexecuted rest of the plan in prev_action_path), keep the initial std so the search can still move
+            shift = 1 + len(self.prev_mean) - len(self.prev_action_path)
+            kept = max(len(self.prev_mean) - shift, 0)
+            mean[:kept] = self.prev_mean[shift:shift + kept]
 
+        states = np.tile(state, [self.num_simulated_paths, 1])
 
+        opt_cost = np.inf
+        opt_action_path = None
 
+        for it in range(self.iterations):
+            action_paths = self.sample_actions(mean, std)
+            costs = rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, self.gamma)
 
+            elites_idx = np.argsort(costs)[:self.num_elites]
+            elites = action_paths[:, elites_idx, :]
+
+            if costs[elites_idx[0]] < opt_cost:
+                opt_cost = costs[elites_idx[0]]
+                opt_action_path = action_paths[:, elites_idx[0], :]
+
+            # refit gaussian to elites with smoothing
+            mean = self.alpha * mean + (1 - self.alpha) * np.mean(elites, axis=1)
+            std = self.alpha * std + (1 - self.alpha) * np.std(elites, axis=1)
+
+        opt_action = copy.copy(opt_action_path[0])
+        self.prev_mean = mean
+        self.prev_action_path = opt_action_path
+
+        # print("CEM imagine min cost: ", opt_cost)
+        return opt_action
+
+class MPPIcontroller(Controller):
+    """ Model predictive path integral planner. Perturbs a nominal action sequence with gaussian noise and
+    returns the exponentially reward (negative cost) weighted average of the sampled sequences. The nominal
+    sequence is kept between calls as prev_action_path and shifted past the steps taken since. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=5, 
+                 cost_fn=None, 
+                 num_simulated_paths=10,
+                 temperature=1.,
+                 noise_std=0.5,
+                 gamma=1.,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.horizon = horizon
+        self.cost_fn = cost_fn
+        self.num_simulated_paths = num_simulated_paths
+        self.temperature = temperature
+        self.noise_std = noise_std * (self.env.action_space.high - self.env.action_space.low) / 2.
+        self.gamma = gamma
+
+        self.ac_low = self.env.action_space.low
+        self.ac_high = self.env.action_space.high
+        self.reset()
+
+    def reset(self):
+        self.nominal_actions = np.tile((self.ac_high + self.ac_low) / 2., [self.horizon, 1])
+        self.prev_action_path = None
+
+    def get_action(self, state):
+        if self.prev_action_path is not None:
+            # one step per call, more when ReplanController executed part of the plan open loop
+            shift = 1 + len(self.nominal_actions) - len(self.prev_action_path)
+            self.nominal_actions = np.roll(self.nominal_actions, -shift, axis=0)
+            self.nominal_actions[max(self.horizon - shift, 0):] = (self.ac_high + self.ac_low) / 2.
+
+        noise = np.random.normal(size=[self.horizon, self.num_simulated_paths, len(self.ac_high)]) * self.noise_std
+        action_paths = np.clip(self.nominal_actions[:, None, :] + noise, self.ac_low, self.ac_high)
+
+        states = np.tile(state, [self.num_simulated_paths, 1])
+        costs = rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, self.gamma)
+
+        # exponentially weighted average, shift by min cost for numerical stability
+        weights = np.exp(-(costs - np.min(costs)) / self.temperature)
+        weights /= np.sum(weights)
+        self.nominal_actions = np.sum(weights[None, :, None] * action_paths, axis=1)
+
+        opt_action = copy.copy(self.nominal_actions[0])
+        self.prev_action_path = self.nominal_actions
+
+        return opt_action
+
+class GradientMPCcontroller(Controller):
+    """ Random shooting followed by gradient refinement: the top_k of num_simulated_paths sampled sequences are
+    refined with refine_steps of gradient descent on their cost through the unrolled dyn_model (dyn_model.refine),
+    all candidates in one batched graph. cost_fn is the numpy cost of the sampling stage and cost_fn_tf the
+    tensorflow cost of the refinement, both None with a reward predicting model. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=5, 
+                 cost_fn=None, 
+                 cost_fn_tf=None,
+                 num_simulated_paths=10,
+                 top_k=10,
+                 refine_steps=5,
+                 step_size=0.05,
+                 gamma=1.,
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 proposal=None,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.horizon = horizon
+        self.cost_fn = cost_fn
+        self.cost_fn_tf = cost_fn_tf
+        self.num_simulated_paths = num_simulated_paths
+        self.top_k = top_k
+        self.refine_steps = refine_steps
+        self.step_size = step_size
+        self.gamma = gamma
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.proposal = proposal
+        self.prev_action_path = None
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def get_action(self, state):
+        if self.proposal:
+            action_paths = self.proposal.sample(self.horizon, self.num_simulated_paths)
+        else:
+            action_paths = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high, 
+                                             size=[self.horizon, self.num_simulated_paths, len(self.env.action_space.high)])
+
+        if self.warm_start and self.prev_action_path is not None:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
+
+        states = np.tile(state, [self.num_simulated_paths, 1])
+        costs = rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, self.gamma)
+
+        top = np.argsort(costs)[:self.top_k]
+        refined_paths, refined_costs = self.dyn_model.refine(state, action_paths[:, top, :], cost_fn=self.cost_fn_tf, 
+                                                             steps=self.refine_steps, step_size=self.step_size, gamma=self.gamma)
+
+        opt_action_path = refined_paths[:, np.argmin(refined_costs), :]
+        self.prev_action_path = opt_action_path
+
+        # print("Gradient mpc imagine min cost: ", np.min(refined_costs))
+        return copy.copy(opt_action_path[0])
+
+def quadratize_cost(cost_fn, states, actions, nxt_states, eps=1e-3):
+    """ Gradients and diagonal Hessians of a batched cost_fn(state, action, next_state) at every row, by central
+    differences with all perturbed rows in one cost_fn call. Returns (grad, hess) pairs for state, action and
+    next state, each [T, dim] """
+    dims = [states.shape[1], actions.shape[1], nxt_states.shape[1]]
+    inputs = np.concatenate([states, actions, nxt_states], axis=1)
+    num_rows, num_dims = inputs.shape
+
+    # [2 * num_dims + 1, T, num_dims]: +eps and -eps along every dim, then the unperturbed rows
+    offsets = np.concatenate([np.eye(num_dims), -np.eye(num_dims), np.zeros((1, num_dims))]) * eps
+    perturbed = np.reshape(inputs[None] + offsets[:, None, :], [-1, num_dims])
+    costs = np.reshape(cost_fn(*np.split(perturbed, np.cumsum(dims)[:-1], axis=1)), [-1, num_rows])
+
+    plus, minus, center = costs[:num_dims].T, costs[num_dims:2 * num_dims].T, costs[-1][:, None]
+    grad = (plus - minus) / (2 * eps)
+    # convexified, non-positive curvature is left to the regularization
+    hess = np.maximum((plus - 2 * center + minus) / eps**2, 0.)
+
+    splits = np.cumsum(dims)[:-1]
+    return list(zip(np.split(grad, splits, axis=1), np.split(hess, splits, axis=1)))
+
+def ilqr_backward(A, B, l_x, l_u, l_xx, l_uu, l_ux, mu):
+    """ iLQR backward pass over the linearized dynamics x' = A x + B u and the quadratized step costs, with
+    mu * I added to Q_uu. Returns the feedforward terms k [T, ac_dim] and feedback gains K [T, ac_dim, ob_dim],
+    (None, None) if Q_uu is not positive definite. """
+    horizon, ob_dim, ac_dim = B.shape
+    V_x = np.zeros(ob_dim)
+    V_xx = np.zeros((ob_dim, ob_dim))
+    k = np.zeros((horizon, ac_dim))
+    K = np.zeros((horizon, ac_dim, ob_dim))
+
+    for t in reversed(range(horizon)):
+        V_xx_A = V_xx.dot(A[t])
+        Q_x = l_x[t] + A[t].T.dot(V_x)
+        Q_u = l_u[t] + B[t].T.dot(V_x)
+        Q_xx = l_xx[t] + A[t].T.dot(V_xx_A)
+        Q_ux = l_ux[t] + B[t].T.dot(V_xx_A)
+        Q_uu = l_uu[t] + B[t].T.dot(V_xx).dot(B[t]) + mu * np.eye(ac_dim)
+
+        try:
+            np.linalg.cholesky(Q_uu)
+        except np.linalg.LinAlgError:
+            return None, None
+
+        solution = np.linalg.solve(Q_uu, np.column_stack([Q_u, Q_ux]))
+        k[t] = -solution[:, 0]
+        K[t] = -solution[:, 1:]
+
+        V_x = Q_x + K[t].T.dot(Q_uu).dot(k[t]) + K[t].T.dot(Q_u) + Q_ux.T.dot(k[t])
+        V_xx = Q_xx + K[t].T.dot(Q_uu).dot(K[t]) + K[t].T.dot(Q_ux) + Q_ux.T.dot(K[t])
+        V_xx = (V_xx + V_xx.T) / 2.
+
+    return k, K
+
+class ILQRcontroller(Controller):
+    """ Iterative LQR on the learned dynamics. Every iteration linearizes the model around the nominal trajectory
+    (all horizon steps in one batched jacobian sess.run), quadratizes the cost (cost_fn by batched central
+    differences, or the gradient of the learned reward if cost_fn is None), runs the backward pass and a closed
+    loop forward pass with every line search step size in one batch per model call. The nominal plan starts from
+    the shifted previous plan, the regularization mu adapts across calls. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=15, 
+                 cost_fn=None, 
+                 iterations=3,
+                 mu=1.,
+                 alphas=(1., 0.5, 0.25, 0.1),
+                 fd_eps=1e-3,
+                 warm_start=True,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.horizon = horizon
+        self.cost_fn = cost_fn
+        self.iterations = iterations
+        self.init_mu = mu
+        self.alphas = np.asarray(alphas)
+        self.fd_eps = fd_eps
+        self.warm_start = warm_start
+
+        self.ac_low = self.env.action_space.low
+        self.ac_high = self.env.action_space.high
+        self.reset()
+
+    def reset(self):
+        self.prev_action_path = None
+        self.mu = self.init_mu
+
+    def rollout(self, state, nominal_states, nominal_actions, k, K, alphas):
+        """ Closed loop rollouts of u = u_nom + alpha * k + K (x - x_nom), one batch row per alpha. Returns the
+        states [horizon + 1, len(alphas), ob_dim], actions [horizon, len(alphas), ac_dim] and costs """
+        states = np.zeros([self.horizon + 1, len(alphas), len(state)])
+        actions = np.zeros([self.horizon, len(alphas), len(self.ac_high)])
+        costs = np.zeros(len(alphas))
+        states[0] = state
+
+        for t in range(self.horizon):
+            actions[t] = nominal_actions[t] + alphas[:, None] * k[t] + (states[t] - nominal_states[t]).dot(K[t].T)
+            np.clip(actions[t], self.ac_low, self.ac_high, out=actions[t])
+            if self.cost_fn is None:
+                _, reward = self.dyn_model.predict(states[t], actions[t], out=states[t + 1])
+                costs -= np.reshape(reward, [-1])
+            else:
+                self.dyn_model.predict(states[t], actions[t], out=states[t + 1])
+                costs += self.cost_fn(states[t], actions[t], states[t + 1])
+
+        return states, actions, costs
+
+    def backward(self, nominal_states, nominal_actions):
+        linearization = self.dyn_model.jacobians(nominal_states[:-1], nominal_actions)
+        A, B = linearization["A"], linearization["B"]
+        ob_dim, ac_dim = B.shape[1], B.shape[2]
+
+        if self.cost_fn is None:
+            # first order in the learned reward, the curvature comes from mu
+            l_x, l_u = -linearization["reward_s"], -linearization["reward_a"]
+            l_xx = np.zeros((self.horizon, ob_dim, ob_dim))
+            l_uu = np.zeros((self.horizon, ac_dim, ac_dim))
+            l_ux = np.zeros((self.horizon, ac_dim, ob_dim))
+        else:
+            # cost(s, a, s') with s' = f(s, a), chained through the Jacobians (Gauss-Newton in s')
+            (c_s, h_s), (c_a, h_a), (c_n, h_n) = quadratize_cost(self.cost_fn, nominal_states[:-1], nominal_actions, 
+                                                                 nominal_states[1:], self.fd_eps)
+            l_x = c_s + np.einsum('tij,ti->tj', A, c_n)
+            l_u = c_a + np.einsum('tij,ti->tj', B, c_n)
+            l_xx = np.einsum('tki,tk,tkj->tij', A, h_n, A) + h_s[:, :, None] * np.eye(ob_dim)
+            l_uu = np.einsum('tki,tk,tkj->tij', B, h_n, B) + h_a[:, :, None] * np.eye(ac_dim)
+            l_ux = np.einsum('tki,tk,tkj->tij', B, h_n, A)
+
+        return ilqr_backward(A, B, l_x, l_u, l_xx, l_uu, l_ux, self.mu)
+
+    def get_action(self, state):
+        ac_dim = len(self.ac_high)
+        if self.warm_start and self.prev_action_path is not None:
+            nominal_actions = shifted_plan(self.prev_action_path, self.horizon, self.env)
+        else:
+            nominal_actions = np.tile((self.ac_high + self.ac_low) / 2., [self.horizon, 1])
+
+        # nominal trajectory: the open loop rollout of the nominal actions
+        states, actions, costs = self.rollout(state, np.zeros([self.horizon, len(state)]), nominal_actions, 
+                                              np.zeros((self.horizon, ac_dim)), np.zeros((self.horizon, ac_dim, len(state))), 
+                                              np.zeros(1))
+        nominal_states, nominal_actions, nominal_cost = states[:, 0], actions[:, 0], costs[0]
+
+        for i in range(self.iterations):
+            k, K = self.backward(nominal_states, nominal_actions)
+            if k is None:
+                self.mu = min(self.mu * 10., 1e6)
+                continue
+
+            states, actions, costs = self.rollout(state, nominal_states, nominal_actions, k, K, self.alphas)
+            best = np.argmin(costs)
+            if costs[best] < nominal_cost:
+                nominal_states, nominal_actions, nominal_cost = states[:, best], actions[:, best], costs[best]
+                self.mu = max(self.mu / 2., 1e-6)
+            else:
+                self.mu = min(self.mu * 10., 1e6)
+
+        self.prev_action_path = nominal_actions
+        return copy.copy(nominal_actions[0])
+
+def chunk_rollout_costs(dyn_model, cost_fn, states, action_paths, gamma=1.):
+    """ rollout_costs through a chunk model (dynamics.NNDynamicsChunkModel): action_paths [horizon, num_paths, ac_dim]
+    with horizon a multiple of dyn_model.chunk go through horizon / chunk model calls. Without cost_fn the cost is
+    the negative predicted chunk reward, otherwise cost_fn is evaluated once per chunk on its first and last state
+    (a progress term telescopes exactly, state penalties are only checked at the chunk boundaries). """
+    chunk = dyn_model.chunk
+    costs = np.zeros(action_paths.shape[1])
+
+    for i in range(action_paths.shape[0] // chunk):
+        # [num_paths, chunk * ac_dim] actions of the chunk
+        actions = np.reshape(np.transpose(action_paths[i * chunk:(i + 1) * chunk], [1, 0, 2]), [action_paths.shape[1], -1])
+        nxt_states, reward = dyn_model.predict(states, actions)
+        if cost_fn is None:
+            costs -= np.reshape(reward, [-1]) * gamma**(i * chunk)
+        else:
+            costs += cost_fn(states, action_paths[i * chunk], nxt_states) * gamma**(i * chunk)
+        states = nxt_states
+
+    return costs
+
+class ChunkMPCcontroller(Controller):
+    """ Random shooting through a chunk model that predicts dyn_model.chunk steps per call, so a horizon step plan
+    takes horizon / chunk sequential model calls (the horizon is rounded up to whole chunks). With repeat_actions
+    one action is sampled per chunk and held for its chunk steps, a horizon / chunk * ac_dim search space. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=5, 
+                 cost_fn=None, 
+                 num_simulated_paths=10,
+                 gamma=1.,
+                 repeat_actions=False,
+                 proposal=None,
+                 warm_start=False,
+                 warm_start_std=0.1,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.chunk = dyn_model.chunk
+        self.horizon = int(np.ceil(horizon / float(self.chunk))) * self.chunk
+        self.cost_fn = cost_fn
+        self.num_simulated_paths = num_simulated_paths
+        self.gamma = gamma
+        self.repeat_actions = repeat_actions
+        self.proposal = proposal
+        self.warm_start = warm_start
+        self.warm_start_std = warm_start_std
+        self.prev_action_path = None
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def sample_random_actions(self):
+        low, high = self.env.action_space.low, self.env.action_space.high
+        steps = self.horizon // self.chunk if self.repeat_actions else self.horizon
+        if self.proposal:
+            action_paths = self.proposal.sample(steps, self.num_simulated_paths)
+        else:
+            action_paths = np.random.uniform(low=low, high=high, size=[steps, self.num_simulated_paths, len(high)])
+        if self.repeat_actions:
+            action_paths = np.repeat(action_paths, self.chunk, axis=0)
+        return action_paths
+
+    def get_action(self, state):
+        if self.proposal and self.prev_action_path is not None:
+            self.proposal.update(self.prev_action_path[::self.chunk] if self.repeat_actions else self.prev_action_path)
+
+        action_paths = self.sample_random_actions()
+        # the shifted plan is no longer piecewise constant, only warm start free action paths
+        if self.warm_start and not self.repeat_actions and self.prev_action_path is not None:
+            action_paths, _ = warm_start_action_paths(action_paths, self.prev_action_path, self.env, self.warm_start_std)
+
+        states = np.tile(state, [self.num_simulated_paths, 1])
+        costs = chunk_rollout_costs(self.dyn_model, self.cost_fn, states, action_paths, self.gamma)
+
+        opt_action_path = action_paths[:, np.argmin(costs), :]
+        self.prev_action_path = opt_action_path
+        return copy.copy(opt_action_path[0])
+
+class TreeSearchcontrollerPolicyNetReward(Controller):
+    """ Batched tree search over the learned dynamics and reward model (NNDynamicsRewardModel).
+    Nodes live in preallocated arrays (parent, action, state, edge reward, visit count, value sum), children of a
+    node are stored contiguously. Every iteration selects up to expand_batch leaves with UCT (virtual visits valued
+    as a loss keep the batch diverse), expands them with num_children policy actions in one batched policy and model call,
+    bootstraps the new nodes with the policy value head (vpred) and backs the returns up to the root.
+    Nodes at full depth and nodes whose children are all exhausted are never selected again, the search stops
+    early once the whole tree is exhausted. """
+    def __init__(self, 
+                 env, 
+                 dyn_model,
+                 policy_net, 
+                 explore=0.,
+                 self_exp=True,
+                 horizon=5, 
+                 num_iterations=20,
+                 expand_batch=8,
+                 num_children=4,
+                 gamma=0.99,
+                 c_uct=1.,
+                 proposal=None,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.policy_net = policy_net
+        self.horizon = horizon
+        self.num_iterations = num_iterations
+        self.expand_batch = expand_batch
+        self.num_children = num_children
+        self.gamma = gamma
+        self.c_uct = c_uct
+        self.proposal = proposal
+        self.self_exp = self_exp
+        self.explore = explore
+
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+        self.max_nodes = 1 + (num_iterations + 1) * expand_batch * num_children
+
+        self.parent = np.zeros(self.max_nodes, dtype=np.int32)
+        self.first_child = np.zeros(self.max_nodes, dtype=np.int32)
+        self.depth = np.zeros(self.max_nodes, dtype=np.int32)
+        self.action = np.zeros((self.max_nodes, ac_dim), dtype=np.float32)
+        self.state = np.zeros((self.max_nodes, ob_dim), dtype=np.float32)
+        self.reward = np.zeros(self.max_nodes)
+        self.visits = np.zeros(self.max_nodes)
+        self.value_sum = np.zeros(self.max_nodes)
+        self.exhausted = np.zeros(self.max_nodes, dtype=bool)
+        self.num_nodes = 0
+
+    def init_tree(self, state):
+        self.num_nodes = 1
+        self.parent[0] = -1
+        self.first_child[0] = -1
+        self.depth[0] = 0
+        self.state[0] = state
+        self.reward[0] = 0.
+        self.visits[0] = 0.
+        self.value_sum[0] = 0.
+        self.exhausted[0] = False
+
+    def select_leaf(self):
+        node = 0
+        path = [node]
+        values = self.value_sum[1:self.num_nodes] / np.maximum(self.visits[1:self.num_nodes], 1)
+        q_min, q_max = np.min(values), np.max(values)
+
+        while self.first_child[node] >= 0:
+            children = np.arange(self.first_child[node], self.first_child[node] + self.num_children)
+            q = (self.value_sum[children] / self.visits[children] - q_min) / (q_max - q_min + 1e-8)
+            u = self.c_uct * np.sqrt(self.visits[node]) / (1 + self.visits[children])
+            score = q + u
+            score[self.exhausted[children]] = -np.inf
+            node = children[np.argmax(score)]
+            path.append(node)
+
+        return node, path
+
+    def expand(self, leaves):
+        """ Add num_children children to every leaf with one policy and one model call, returns the child
+        indices [num_leaves, num_children] and their bootstrapped values r + gamma * vpred(s') """
+        num_new = len(leaves) * self.num_children
+        children = np.arange(self.num_nodes, self.num_nodes + num_new)
+        self.num_nodes += num_new
+
+        leaf_states = np.repeat(self.state[leaves], self.num_children, axis=0)
+        if self.self_exp:
+            actions, _ = self.policy_net.act(leaf_states, stochastic=True)
+        else:
+            actions, _ = self.policy_net.act(leaf_states, stochastic=False)
+            if self.proposal:
+                exploration = self.proposal.sample(1, len(actions))[0]
+            else:
+                exploration = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high, size=actions.shape)
+            actions = (1 - self.explore) * actions + self.explore * exploration
+
+        nxt_states, rewards = self.dyn_model.predict(leaf_states, actions)
+        _, vpreds = self.policy_net.act(nxt_states, stochastic=False)
+        rewards = np.reshape(rewards, [-1])
+        values = rewards + self.gamma * np.reshape(vpreds, [-1])
+
+        self.parent[children] = np.repeat(leaves, self.num_children)
+        self.first_child[children] = -1
+        self.first_child[leaves] = children[::self.num_children]
+        self.depth[children] = self.depth[leaves].repeat(self.num_children) + 1
+        self.action[children] = actions
+        self.state[children] = nxt_states
+        self.reward[children] = rewards
+        self.visits[children] = 1.
+        self.value_sum[children] = values
+        # full depth children are final, their bootstrapped value is all there is to evaluate
+        self.exhausted[children] = self.depth[children] >= self.horizon
+        for leaf in leaves:
+            self.mark_exhausted(leaf)
+
+        return children.reshape((len(leaves), self.num_children)), values.reshape((len(leaves), self.num_children))
+
+    def mark_exhausted(self, node):
+        # a node is exhausted once all its children are, propagated up towards the root
+        while node >= 0 and not self.exhausted[node]:
+            first = self.first_child[node]
+            if first < 0 or not np.all(self.exhausted[first:first + self.num_children]):
+                break
+            self.exhausted[node] = True
+            node = self.parent[node]
+
+    def backup(self, node, returns):
+        # returns are the values of the new evaluations below node, seen from node's state
+        while node > 0:
+            returns = self.reward[node] + self.gamma * returns
+            self.visits[node] += len(returns)
+            self.value_sum[node] += np.sum(returns)
+            node = self.parent[node]
+        self.visits[0] += len(returns)
+
+    def get_action(self, state):
+        self.init_tree(state)
+        self.expand(np.array([0]))
+        self.visits[0] = self.num_children
+
+        for it in range(self.num_iterations):
+            if self.exhausted[0]:
+                break
+            leaves = []
+            paths = []
+            # virtual loss: a pending visit counts as the lowest node value in the tree, so it lowers q whatever
+            # the sign of the values and the following selections of this batch spread out
+            loss_value = np.min(self.value_sum[1:self.num_nodes] / self.visits[1:self.num_nodes])
+            for b in range(self.expand_batch):
+                leaf, path = self.select_leaf()
+                self.visits[path] += 1
+                self.value_sum[path] += loss_value
+                paths.append(path)
+                if leaf not in leaves:
+                    leaves.append(leaf)
+
+            for path in paths:
+                self.visits[path] -= 1
+                self.value_sum[path] -= loss_value
+
+            # selected leaves are never exhausted, so never at full depth
+            _, values = self.expand(np.array(leaves, dtype=np.int32))
+            for leaf, leaf_values in zip(leaves, values):
+                self.backup(leaf, leaf_values)
+
+        root_children = np.arange(self.first_child[0], self.first_child[0] + self.num_children)
+        best_child = root_children[np.argmax(self.value_sum[root_children] / self.visits[root_children])]
+
+        return copy.copy(self.action[best_child])
+
+
+def sharded_planner_worker(conn, cost_fn, ac_low, ac_high, gamma, seed):
+    """ Worker process of ShardedMPCcontroller: holds its own numpy copy of the dynamics model and answers
+    ("weights", model) and ("plan", state, horizon, num_paths) messages, the latter with its best (cost, action path) """
+    np.random.seed(seed)
+    action_pool = RandomActionPool(ac_low, ac_high, seed=seed)
+    dyn_model = None
+
+    while True:
+        msg = conn.recv()
+        if msg[0] == "weights":
+            dyn_model = msg[1]
+        elif msg[0] == "plan":
+            _, state, horizon, num_paths = msg
+            action_paths = action_pool.sample(horizon, num_paths)
+            states = np.tile(state, [num_paths, 1])
+            costs = rollout_costs(dyn_model, cost_fn, states, action_paths, gamma)
+            best = np.argmin(costs)
+            conn.send((costs[best], action_paths[:, best, :]))
+        else:
+            break
+
+# thread count variables of the BLAS / OpenMP runtimes numpy may be linked against
+BLAS_THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+@contextlib.contextmanager
+def light_spawn(threads):
+    """ Processes spawned inside start with threads BLAS threads and without re-importing the __main__ script
+    (the training scripts import tensorflow), so numpy workers only load the modules their target needs.
+    Their target and arguments must not be defined in __main__. """
+    environ = dict(os.environ)
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    # multiprocessing passes the main script to the children through its __file__ / __spec__
+    main = sys.modules["__main__"]
+    hidden = {name: main.__dict__.pop(name) for name in ["__file__", "__spec__"] if name in main.__dict__}
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        del main.__spec__
+        main.__dict__.update(hidden)
+        os.environ.clear()
+        os.environ.update(environ)
+
+class ShardedMPCcontroller(Controller):
+    """ Random shooting MPC with num_simulated_paths split across num_workers processes. Every worker holds a
+    numpy copy of the dynamics weights (dyn_model.export_numpy) which is resent after each dyn_model.fit,
+    the per-shard best paths are reduced to the global argmin. Workers are spawned rather than forked from the
+    process holding the tf session, each limited to worker_threads BLAS threads so they do not oversubscribe
+    the cores, and load neither the training script nor tensorflow (see light_spawn). At most num_simulated_paths workers are started. """
+    def __init__(self, 
+                 env, 
+                 dyn_model, 
+                 horizon=5, 
+                 cost_fn=None, 
+                 num_simulated_paths=10,
+                 num_workers=4,
+                 gamma=1.,
+                 worker_threads=1,
+                 ):
+        self.env = env
+        self.dyn_model = dyn_model
+        self.horizon = horizon
+        self.cost_fn = cost_fn
+        self.num_simulated_paths = num_simulated_paths
+        self.num_workers = min(num_workers, num_simulated_paths)
+        self.gamma = gamma
+        self.synced_version = None
+        self.prev_action_path = None
+
+        context = multiprocessing.get_context("spawn")
+        self.conns = []
+        self.workers = []
+        with light_spawn(worker_threads):
+            for i in range(self.num_workers):
+                parent_conn, child_conn = context.Pipe()
+                worker = context.Process(target=sharded_planner_worker, 
+                                         args=(child_conn, cost_fn, env.action_space.low, env.action_space.high, 
+                                               gamma, np.random.randint(2**31 - 1)))
+                worker.daemon = True
+                worker.start()
+                self.conns.append(parent_conn)
+                self.workers.append(worker)
+
+    def sync_weights(self):
+        numpy_model = self.dyn_model.export_numpy()
+        for conn in self.conns:
+            conn.send(("weights", numpy_model))
+        self.synced_version = self.dyn_model.weights_version
+
+    def get_action(self, state):
+        if self.synced_version != self.dyn_model.weights_version:
+            self.sync_weights()
+
+        # no empty shards if num_simulated_paths dropped below the number of workers
+        shards = np.array_split(np.arange(self.num_simulated_paths), min(self.num_workers, self.num_simulated_paths))
+        conns = self.conns[:len(shards)]
+        for conn, shard in zip(conns, shards):
+            conn.send(("plan", state, self.horizon, len(shard)))
+        results = [conn.recv() for conn in conns]
+
+        opt_cost, opt_action_path = min(results, key=lambda result: result[0])
+        self.prev_action_path = opt_action_path
+        return copy.copy(opt_action_path[0])
+
+    def reset(self):
+        self.prev_action_path = None
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("close",))
+        for worker in self.workers:
+            worker.join()
+
+class ReplanController(Controller):
+    """ Executes the first interval actions of every plan open loop instead of replanning at every step.
+    Replans early when the observed state deviates from the model's prediction for the last action by more
+    than threshold (max deviation in units of the model's std_obs), or when the plan runs out. """
+    def __init__(self, controller, dyn_model, interval=1, threshold=0.1):
+        self.controller = controller
+        self.dyn_model = dyn_model
+        self.interval = interval
+        self.threshold = threshold
+        self.plan = None
+        self.plan_step = 0
+        self.predicted_state = None
+        self.decisions = 0
+        self.replans = 0
+
+    def __getattr__(self, name):
+        # stats, budgets, close() etc. come from the wrapped controller
+        if name == "controller":
+            raise AttributeError(name)
+        return getattr(self.controller, name)
+
+    def reset(self):
+        self.plan = None
+        self.predicted_state = None
+        self.controller.reset()
+
+    def snapshot(self):
+        return Controller.snapshot(self), self.controller.snapshot()
+
+    def restore(self, state):
+        Controller.restore(self, state[0])
+        self.controller.restore(state[1])
+
+    def get_action(self, state):
+        self.decisions += 1
+
+        if self.plan is not None and self.plan_step < min(self.interval, len(self.plan)) and \
+           np.max(np.abs(state - self.predicted_state) / (self.dyn_model.std_obs + 1e-10)) <= self.threshold:
+            action = copy.copy(self.plan[self.plan_step])
+            self.plan_step += 1
+        else:
+            if self.plan is not None:
+                # warm starts shift prev_action_path by one step, so it has to start at the last executed action
+                self.controller.prev_action_path = self.plan[self.plan_step - 1:]
+            action = self.controller.get_action(state)
+            self.replans += 1
+
+            # open loop only for plans that start with the action taken (not e.g. the tree search subtree)
+            plan = getattr(self.controller, "prev_action_path", None)
+            if plan is not None and np.allclose(plan[0], action):
+                self.plan = np.array(plan)
+                self.plan_step = 1
+            else:
+                self.plan = None
+
+        if self.plan is not None and self.plan_step < min(self.interval, len(self.plan)):
+            prediction = self.dyn_model.predict(np.reshape(state, [1, -1]), np.reshape(action, [1, -1]))
+            if isinstance(prediction, tuple):
+                prediction = prediction[0]
+            self.predicted_state = prediction[0]
+        return action
+
+    def anytime_stats(self):
+        return self.controller.anytime_stats()
+
+    def workspace_stats(self):
+        return self.controller.workspace_stats()
+
+    def close(self):
+        self.controller.close()
+
+    # Fraction of decisions that called the planner since the last call, for logging
+    def replan_stats(self):
+        replan_rate = float(self.replans) / max(self.decisions, 1)
+        self.decisions = 0
+        self.replans = 0
+        return replan_rate
+
+class AsyncController(Controller):
+    """ Overlaps planning with env stepping. After returning the action for state s, the wrapped controller
+    starts planning in a background thread from the model predicted next state, while the caller steps the env.
+    If the real next state is within tolerance (max deviation in units of the model's std_obs) the speculative
+    action is used, otherwise the controller is rolled back to before the speculative plan and replans from the
+    real state. TF and MuJoCo release the GIL, so a step takes about max(plan, env step) instead of their sum. """
+    def __init__(self, controller, dyn_model, tolerance=0.1):
+        self.controller = controller
+        self.dyn_model = dyn_model
+        self.tolerance = tolerance
+        self.thread = None
+        self.speculative_state = None
+        self.speculative_action = None
+        self.rollback_state = None
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # stats, budgets, close() etc. come from the wrapped controller
+        if name == "controller":
+            raise AttributeError(name)
+        return getattr(self.controller, name)
+
+    def speculate(self, state):
+        self.speculative_action = self.controller.get_action(state)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def reset(self):
+        self.wait()
+        if self.speculative_state is not None:
+            # the last speculative plan was never used
+            self.controller.restore(self.rollback_state)
+        self.speculative_state = None
+        self.controller.reset()
+
+    def get_action(self, state):
+        self.wait()
+
+        if self.speculative_state is not None and \
+           np.max(np.abs(state - self.speculative_state) / (self.dyn_model.std_obs + 1e-10)) <= self.tolerance:
+            action = self.speculative_action
+            self.hits += 1
+        else:
+            if self.speculative_state is not None:
+                # drop the speculative plan (warm start, cem mean, stats, proposal history, ...) before replanning
+                self.controller.restore(self.rollback_state)
+                self.misses += 1
+            action = self.controller.get_action(state)
+
+        prediction = self.dyn_model.predict(np.reshape(state, [1, -1]), np.reshape(action, [1, -1]))
+        if isinstance(prediction, tuple):
+            prediction = prediction[0]
+        self.speculative_state = prediction[0]
+        self.rollback_state = self.controller.snapshot()
+
+        self.thread = threading.Thread(target=self.speculate, args=(self.speculative_state,))
+        self.thread.daemon = True
+        self.thread.start()
+        return action
+
+    def anytime_stats(self):
+        return self.controller.anytime_stats()
+
+    def workspace_stats(self):
+        return self.controller.workspace_stats()
+
+    def close(self):
+        self.wait()
+        self.controller.close()
+
+    # Fraction of decisions served by the speculative plan since the last call, for logging
+    def async_stats(self):
+        hit_rate = float(self.hits) / max(self.hits + self.misses, 1)
+        self.hits = 0
+        self.misses = 0
+        return hit_rate
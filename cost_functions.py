@@ -51,6 +51,21 @@ def cheetah_cost_fn(state, action, next_state):
     score -= (next_state[17] - state[17]) / 0.01 #+ 0.1 * (np.sum(action**2))
     return score
 
+def cheetah_cost_fn_tf(state, action, next_state):
+    # tensorflow version of the batched cheetah_cost_fn, used by the in-graph rollouts
+    # tensorflow is imported here so the numpy cost functions stay importable without it (planner worker processes)
+    import tensorflow as tf
+    heading_penalty_factor=10
+
+    #dont move front shin back so far that you tilt forward
+    scores = heading_penalty_factor * tf.cast(state[:,5] >= 0.2, tf.float32)
+    scores += heading_penalty_factor * tf.cast(state[:,6] >= 0, tf.float32)
+    scores += heading_penalty_factor * tf.cast(state[:,7] >= 0, tf.float32)
+
+    scores -= (next_state[:,17] - state[:,17]) / 0.01
+
+    return scores
+
 #========================================================
 # 
 # Cost function for a whole trajectory:
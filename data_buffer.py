@@ -56,6 +56,10 @@ class DataBufferGeneral(object):
 
         return return_data
 
+    def arrays(self):
+        # all entries in insertion order, one array per item
+        return [np.array([_[i] for _ in self.buffer]) for i in range(self.item_num)]
+
     def clear(self):
         self.buffer.clear()
         self.size = 0
@@ -1,10 +1,34 @@
 import tensorflow as tf
 import tensorflow.contrib.layers as layers
 import numpy as np
+import numpy_nets
 
 FLAGS = tf.app.flags.FLAGS
 
+# activation functions the numpy forward pass can reproduce
+NUMPY_ACTIVATIONS = {None: None, tf.tanh: 'tanh', tf.nn.relu: 'relu'}
+
+# same names tf.layers / layer_norm pick by default, so checkpoints stay compatible when reusing the layers
+layer_name = numpy_nets.layer_name
+
+def split_dense(states, actions, activation, name):
+    """ The existing dense layer name (variables looked up in the current, reused scope) on concat([states, actions])
+    computed as separate state and action projections. states [K, ob_dim] are projected once and broadcast over
+    their group of actions [K * R, ac_dim], rows k*R..(k+1)*R-1 belong to states[k] """
+    kernel = tf.get_variable(name + "/kernel")
+    bias = tf.get_variable(name + "/bias")
+    ob_dim = int(states.shape[1])
+    units = int(kernel.shape[1])
+
+    state_projection = tf.expand_dims(tf.matmul(states, kernel[:ob_dim]), 1)
+    action_projection = tf.reshape(tf.matmul(actions, kernel[ob_dim:]), [tf.shape(states)[0], -1, units])
+    out = tf.reshape(state_projection + action_projection, [-1, units]) + bias
+    return out if activation is None else activation(out)
+
 class NNDynamicsModel():
+    # see quantize
+    quantization = None
+
     def __init__(self, 
                  env, 
                  n_layers,
@@ -15,7 +39,8 @@ class NNDynamicsModel():
                  batch_size,
                  iterations,
                  learning_rate,
-                 sess
+                 sess,
+                 numpy_threshold=0
                  ):
         """ YOUR CODE HERE """
         """ Note: Be careful about normalization """
@@ -29,6 +54,10 @@ class NNDynamicsModel():
 
         # print("input_placeholder: ", self.input_placeholder)
         self.scope = "NNDynamicsModel"
+        self.n_layers = n_layers
+        self.size = size
+        self.activation = activation
+        self.output_activation = output_activation
         self.state_delta_predict = self.build_network(self.states_action_input, 
                                    self.env.observation_space.shape[0], 
                                    self.scope, 
@@ -38,6 +67,7 @@ class NNDynamicsModel():
                                    output_activation=output_activation)
 
         # data normalization
+        self.normalization = normalization
         self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = normalization
 
         # optimization
@@ -46,6 +76,12 @@ class NNDynamicsModel():
         self.iterations = iterations
         self.batch_size = batch_size
 
+        # batches up to numpy_threshold rows are predicted with the numpy snapshot of the weights
+        self.numpy_threshold = numpy_threshold
+        self.numpy_model = None
+        self.weights_version = 0
+        self.init_workspace()
+
         # states_delta = self.nxt_states_placeholder - self.states_input_placeholder
         self.loss = tf.reduce_mean(tf.squared_difference(self.states_delta, self.state_delta_predict))
         self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
@@ -58,18 +94,242 @@ class NNDynamicsModel():
                   n_layers=2, 
                   size=500, 
                   activation=tf.tanh,
-                  output_activation=None
+                  output_activation=None,
+                  reuse=False,
+                  split_states=None
                   ):
         # Predefined function to build a feedforward neural network
+        # with split_states (reuse only) the input is the action batch and the first layer a split_dense on split_states
         out = input_placeholder
-        with tf.variable_scope(scope):
-            for _ in range(n_layers):
-                out = tf.layers.dense(out, size, activation=activation)
+        with tf.variable_scope(scope, reuse=reuse):
+            for i in range(n_layers):
+                if i == 0 and split_states is not None:
+                    out = split_dense(split_states, out, activation, layer_name("dense", i))
+                else:
+                    out = tf.layers.dense(out, size, activation=activation, name=layer_name("dense", i))
                 if FLAGS.LAYER_NORM:
-                  out = layers.layer_norm(out)
-            out = tf.layers.dense(out, output_size, activation=output_activation)
+                  out = layers.layer_norm(out, scope=layer_name("LayerNorm", i))
+            if n_layers == 0 and split_states is not None:
+                out = split_dense(split_states, out, output_activation, layer_name("dense", n_layers))
+            else:
+                out = tf.layers.dense(out, output_size, activation=output_activation, name=layer_name("dense", n_layers))
         return out
 
+    def predict_graph(self, states, actions):
+        """ In-graph version of predict, reusing the model weights on (unnormalized) state and action tensors """
+        normalized_state = (states - self.mean_obs.astype(np.float32)) / (self.std_obs.astype(np.float32) + 1e-10)
+        normalized_action = (actions - self.mean_action.astype(np.float32)) / (self.std_action.astype(np.float32) + 1e-10)
+
+        normalized_state_delta = self.build_network(tf.concat([normalized_state, normalized_action], axis=1), 
+                                   self.env.observation_space.shape[0], 
+                                   self.scope, 
+                                   n_layers=self.n_layers, 
+                                   size=self.size,
+                                   activation=self.activation,
+                                   output_activation=self.output_activation,
+                                   reuse=True)
+
+        return states + normalized_state_delta * self.std_deltas.astype(np.float32) + self.mean_deltas.astype(np.float32)
+
+    def build_rollout(self, cost_fn=None, policy_net=None, self_exp=True, value_net=None):
+        """ Build a fused rollout graph: unroll the model over the horizon with tf.while_loop from one root state,
+        evaluate the paths in-graph and select the best one, so planning a step takes a single sess.run.
+
+        Open loop: actions come from the action_paths placeholder [horizon, num_paths, ac_dim].
+        With a policy_net: actions come from policy_net.act_graph, action_paths is the external exploration
+        (blended with explore when self_exp is False), except for the first num_open_loop paths which replay
+        action_paths directly (warm start).
+        cost_fn is a tensorflow cost (see cost_functions.cheetah_cost_fn_tf), None uses the predicted reward.
+        With a value_net, terminal_weight times its value head (vpred) at the final states is subtracted from the costs. """
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+
+        root_state = tf.placeholder(tf.float32, shape=(ob_dim,))
+        action_paths = tf.placeholder(tf.float32, shape=(None, None, ac_dim))
+        num_open_loop = tf.placeholder_with_default(0, shape=())
+        explore = tf.placeholder_with_default(0., shape=())
+        gamma = tf.placeholder_with_default(1., shape=())
+        terminal_weight = tf.placeholder_with_default(0., shape=())
+
+        horizon = tf.shape(action_paths)[0]
+        num_paths = tf.shape(action_paths)[1]
+        open_loop = tf.expand_dims(tf.range(num_paths) < num_open_loop, 1)
+
+        states = tf.tile(tf.expand_dims(root_state, 0), [num_paths, 1])
+        costs = tf.zeros([num_paths])
+        actions_all = tf.TensorArray(tf.float32, size=horizon)
+
+        def body(i, states, costs, actions_all):
+            if policy_net is None:
+                actions = action_paths[i]
+            else:
+                sample_ac, mean_ac, _ = policy_net.act_graph(states)
+                if self_exp:
+                    actions = sample_ac
+                else:
+                    actions = (1 - explore) * mean_ac + explore * action_paths[i]
+                actions = tf.where(tf.tile(open_loop, [1, ac_dim]), action_paths[i], actions)
+
+            prediction = self.predict_graph(states, actions)
+            if isinstance(prediction, tuple):
+                nxt_states, reward = prediction
+            else:
+                nxt_states, reward = prediction, None
+
+            if cost_fn is None:
+                step_cost = -tf.reshape(reward, [-1])
+            else:
+                step_cost = cost_fn(states, actions, nxt_states)
+
+            costs = costs + step_cost * tf.pow(gamma, tf.cast(i, tf.float32))
+            return i + 1, nxt_states, costs, actions_all.write(i, actions)
+
+        _, final_states, costs, actions_all = tf.while_loop(lambda i, *_: i < horizon, body, 
+                                                            [tf.constant(0), states, costs, actions_all])
+        action_paths_out = actions_all.stack()
+
+        if value_net is not None:
+            _, _, vpred = value_net.act_graph(final_states)
+            costs = costs - terminal_weight * tf.reshape(vpred, [-1])
+
+        opt_path = tf.argmin(costs, axis=0)
+        return {"root_state": root_state,
+                "action_paths": action_paths,
+                "num_open_loop": num_open_loop,
+                "explore": explore,
+                "gamma": gamma,
+                "terminal_weight": terminal_weight,
+                "opt_action_path": tf.gather(action_paths_out, opt_path, axis=1),
+                "opt_cost": tf.gather(costs, opt_path)}
+
+    def rollout(self, state, action_paths, cost_fn=None, policy_net=None, self_exp=True, explore=0., gamma=1., num_open_loop=0,
+                value_net=None, terminal_weight=0.):
+        """ Plan with the fused rollout graph, returns the best action path [horizon, ac_dim] and its cost.
+        Graphs are built once per (cost_fn, policy_net, self_exp, value_net) and cached. """
+        if not hasattr(self, "rollout_graphs"):
+            self.rollout_graphs = {}
+        key = (cost_fn, policy_net, self_exp, value_net)
+        if key not in self.rollout_graphs:
+            self.rollout_graphs[key] = self.build_rollout(cost_fn, policy_net, self_exp, value_net)
+        graph = self.rollout_graphs[key]
+
+        return self.sess.run([graph["opt_action_path"], graph["opt_cost"]], 
+                             feed_dict={graph["root_state"]: state,
+                                        graph["action_paths"]: action_paths,
+                                        graph["num_open_loop"]: num_open_loop,
+                                        graph["explore"]: explore,
+                                        graph["gamma"]: gamma,
+                                        graph["terminal_weight"]: terminal_weight})
+
+    def build_refine(self, cost_fn=None):
+        """ Build the gradient refinement graph: the costs of open loop action_paths [horizon, num_paths, ac_dim]
+        from one root state, unrolled with tf.while_loop, and their gradient w.r.t. the actions. Paths do not
+        interact, so the gradient of the summed cost gives every path its own gradient in one batched pass.
+        cost_fn is a tensorflow cost, None uses the predicted reward. """
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+
+        root_state = tf.placeholder(tf.float32, shape=(ob_dim,))
+        action_paths = tf.placeholder(tf.float32, shape=(None, None, ac_dim))
+        gamma = tf.placeholder_with_default(1., shape=())
+
+        horizon = tf.shape(action_paths)[0]
+        states = tf.tile(tf.expand_dims(root_state, 0), [tf.shape(action_paths)[1], 1])
+        costs = tf.zeros([tf.shape(action_paths)[1]])
+
+        def body(i, states, costs):
+            actions = action_paths[i]
+            prediction = self.predict_graph(states, actions)
+            if isinstance(prediction, tuple):
+                nxt_states, reward = prediction
+                step_cost = -tf.reshape(reward, [-1]) if cost_fn is None else cost_fn(states, actions, nxt_states)
+            else:
+                nxt_states = prediction
+                step_cost = cost_fn(states, actions, nxt_states)
+            return i + 1, nxt_states, costs + step_cost * tf.pow(gamma, tf.cast(i, tf.float32))
+
+        _, _, costs = tf.while_loop(lambda i, *_: i < horizon, body, [tf.constant(0), states, costs])
+
+        return {"root_state": root_state,
+                "action_paths": action_paths,
+                "gamma": gamma,
+                "costs": costs,
+                "gradients": tf.gradients(tf.reduce_sum(costs), action_paths)[0]}
+
+    def refine(self, state, action_paths, cost_fn=None, steps=5, step_size=0.1, gamma=1.):
+        """ Refine action_paths [horizon, num_paths, ac_dim] with steps of gradient descent on their cost through
+        the unrolled model, one sess.run per step for all paths. The gradient of every path is scaled to unit RMS,
+        so step_size is a fraction of the action range, and actions are clipped to the action space.
+        Returns the best version of every path seen during refinement and its cost. """
+        if not hasattr(self, "refine_graphs"):
+            self.refine_graphs = {}
+        if cost_fn not in self.refine_graphs:
+            self.refine_graphs[cost_fn] = self.build_refine(cost_fn)
+        graph = self.refine_graphs[cost_fn]
+
+        low, high = self.env.action_space.low, self.env.action_space.high
+        best_paths = np.array(action_paths, copy=True)
+        best_costs = np.full(action_paths.shape[1], np.inf)
+
+        for i in range(steps + 1):
+            costs, gradients = self.sess.run([graph["costs"], graph["gradients"]], 
+                                             feed_dict={graph["root_state"]: state,
+                                                        graph["action_paths"]: action_paths,
+                                                        graph["gamma"]: gamma})
+            improved = costs < best_costs
+            best_costs[improved] = costs[improved]
+            best_paths[:, improved] = action_paths[:, improved]
+
+            if i < steps:
+                rms = np.sqrt(np.mean(np.square(gradients), axis=(0, 2), keepdims=True)) + 1e-8
+                action_paths = np.clip(action_paths - step_size * (high - low) * gradients / rms, low, high)
+
+        return best_paths, best_costs
+
+    def build_jacobians(self):
+        """ Build the linearization graph: next states of a batch of (unnormalized) state and action rows and their
+        Jacobians, one tf.gradients per state dimension since the rows do not interact. With a reward model also the
+        reward and its gradients. """
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+
+        states = tf.placeholder(tf.float32, shape=(None, ob_dim))
+        actions = tf.placeholder(tf.float32, shape=(None, ac_dim))
+        prediction = self.predict_graph(states, actions)
+        if isinstance(prediction, tuple):
+            nxt_states, reward = prediction
+        else:
+            nxt_states, reward = prediction, None
+
+        jacobian_states = []
+        jacobian_actions = []
+        for j in range(ob_dim):
+            gradient_states, gradient_actions = tf.gradients(nxt_states[:, j], [states, actions])
+            jacobian_states.append(gradient_states)
+            jacobian_actions.append(gradient_actions)
+
+        graph = {"states": states,
+                 "actions": actions,
+                 "nxt_states": nxt_states,
+                 "A": tf.stack(jacobian_states, axis=1),
+                 "B": tf.stack(jacobian_actions, axis=1)}
+        if reward is not None:
+            graph["reward"] = tf.reshape(reward, [-1])
+            graph["reward_s"], graph["reward_a"] = tf.gradients(tf.reduce_sum(reward), [states, actions])
+        return graph
+
+    def jacobians(self, unnormalized_state, unnormalized_action):
+        """ Linearize the model at every row of (unnormalized) states [T, ob_dim] and actions [T, ac_dim], e.g. all steps
+        of a nominal trajectory, in one sess.run. Returns a dict with the next states, A = d s'/d s [T, ob_dim, ob_dim],
+        B = d s'/d a [T, ob_dim, ac_dim] and, for a reward model, the reward with its gradients reward_s and reward_a """
+        if not hasattr(self, "jacobian_graph"):
+            self.jacobian_graph = self.build_jacobians()
+        graph = self.jacobian_graph
+        names = [name for name in graph if name not in ("states", "actions")]
+        values = self.sess.run([graph[name] for name in names], 
+                               feed_dict={graph["states"]: unnormalized_state, graph["actions"]: unnormalized_action})
+        return dict(zip(names, values))
+
     def normalize(self, unnormalized_data, std, mean):
         normalized_data =  (unnormalized_data - mean)/ (std+ 1e-10)
         return normalized_data
@@ -101,11 +361,50 @@ class NNDynamicsModel():
                                      self.states_delta:normalized_sample_state_delta})
             
             # print("loss ", i, " : ", loss)
+        self.numpy_model = None
+        self.weights_version += 1
         return loss, 0
 
-    def predict(self, unnormalized_state, unnormalized_action):
+    def init_workspace(self):
+        # reusable normalization buffers and precomputed divisors for predict(..., out=...)
+        self.workspace = numpy_nets.Workspace()
+        self.std_obs_eps = self.std_obs + 1e-10
+        self.std_action_eps = self.std_action + 1e-10
+
+    def normalize_into(self, unnormalized_state, unnormalized_action):
+        """ Normalize into the workspace buffers in place, no temporaries """
+        normalized_state = self.workspace.get("normalized_state", unnormalized_state.shape)
+        normalized_action = self.workspace.get("normalized_action", unnormalized_action.shape)
+        np.subtract(unnormalized_state, self.mean_obs, out=normalized_state)
+        np.divide(normalized_state, self.std_obs_eps, out=normalized_state)
+        np.subtract(unnormalized_action, self.mean_action, out=normalized_action)
+        np.divide(normalized_action, self.std_action_eps, out=normalized_action)
+        return normalized_state, normalized_action
+
+    def denormalize_into(self, unnormalized_state, normalized_state_delta, out):
+        # out = state + delta * std + mean, in place
+        np.multiply(normalized_state_delta, self.std_deltas, out=out)
+        out += self.mean_deltas
+        out += unnormalized_state
+        return out
+
+    def predict(self, unnormalized_state, unnormalized_action, out=None):
         """ Write a function to take in a batch of (unnormalized) states and (unnormalized) actions and return the (unnormalized) next states as predicted by using the model """
         """ YOUR CODE HERE """
+        """ With out (e.g. a row of a controller workspace) the next states are written into it and the
+        normalization goes through reused workspace buffers """
+        if len(unnormalized_state) <= self.numpy_threshold or self.quantization:
+            nxt_state = self.predict_numpy(unnormalized_state, unnormalized_action)
+            if out is None:
+                return nxt_state
+            out[...] = nxt_state
+            return out
+
+        if out is not None:
+            normalized_state, normalized_action = self.normalize_into(unnormalized_state, unnormalized_action)
+            normalized_state_delta = self.sess.run(self.state_delta_predict, feed_dict={self.states_input_placeholder:normalized_state, self.actions_input_placeholder:normalized_action})
+            return self.denormalize_into(unnormalized_state, normalized_state_delta, out)
+
         normalized_state =  (unnormalized_state - self.mean_obs)/ (self.std_obs + 1e-10)
         normalized_action =  (unnormalized_action - self.mean_action)/ (self.std_action + 1e-10)
 
@@ -118,6 +417,87 @@ class NNDynamicsModel():
 
         return unnormalized_nxt_state
 
+    def build_shared(self):
+        # graph of predict_shared, on normalized inputs
+        states = tf.placeholder(tf.float32, shape=(None, self.env.observation_space.shape[0]))
+        actions = tf.placeholder(tf.float32, shape=(None, self.env.action_space.shape[0]))
+        return {"states": states, "actions": actions, "outputs": self.shared_network(states, actions)}
+
+    def shared_network(self, states, actions):
+        # normalized outputs of the split first layer network: [state delta] (, reward)
+        return [self.build_network(actions, 
+                                   self.env.observation_space.shape[0], 
+                                   self.scope, 
+                                   n_layers=self.n_layers, 
+                                   size=self.size,
+                                   activation=self.activation,
+                                   output_activation=self.output_activation,
+                                   reuse=True,
+                                   split_states=states)]
+
+    def predict_shared(self, unnormalized_states, unnormalized_action, out=None):
+        """ predict for groups of actions starting from the same state: unnormalized_states [K, ob_dim] (or one root
+        state [ob_dim]) and unnormalized_action [K * R, ac_dim], rows k*R..(k+1)*R-1 start from state k.
+        The first dense layer is split into state and action projections, so the state half is computed for the
+        K distinct states only instead of every row. Same returns as predict, out has to be contiguous. """
+        ob_dim = self.env.observation_space.shape[0]
+        unnormalized_states = np.reshape(unnormalized_states, [-1, ob_dim])
+        num_states = len(unnormalized_states)
+        repeats = len(unnormalized_action) // num_states
+
+        if len(unnormalized_action) <= self.numpy_threshold or self.quantization:
+            return self.predict(np.repeat(unnormalized_states, repeats, axis=0), unnormalized_action, out=out)
+
+        if not hasattr(self, "shared_graph"):
+            self.shared_graph = self.build_shared()
+        outputs = self.sess.run(self.shared_graph["outputs"], 
+                                feed_dict={self.shared_graph["states"]: (unnormalized_states - self.mean_obs) / self.std_obs_eps,
+                                           self.shared_graph["actions"]: (unnormalized_action - self.mean_action) / self.std_action_eps})
+
+        if out is None:
+            out = np.empty([len(unnormalized_action), ob_dim])
+        # every state broadcasts over its group of rows
+        self.denormalize_into(unnormalized_states[:, None], 
+                              np.reshape(outputs[0], [num_states, repeats, ob_dim]), 
+                              out.reshape([num_states, repeats, ob_dim]))
+        if len(outputs) > 1:
+            return out, self.denomalize(outputs[1], self.std_reward, self.mean_reward)
+        return out
+
+    def snapshot_weights(self):
+        """ Copy the current weights out of the session """
+        variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self.scope)
+        return numpy_nets.snapshot_variables(self.sess, variables, self.scope)
+
+    def export_numpy(self):
+        """ Picklable numpy copy of the model with the current weights """
+        return numpy_nets.NumpyDynamicsModel(self.snapshot_weights(), self.normalization, self.n_layers, 
+                                             NUMPY_ACTIVATIONS[self.activation], NUMPY_ACTIVATIONS[self.output_activation], 
+                                             FLAGS.LAYER_NORM)
+
+    def predict_numpy(self, unnormalized_state, unnormalized_action):
+        """ Same as predict but with a numpy forward pass, the numpy copy is refreshed lazily after fit """
+        if self.numpy_model is None:
+            self.numpy_model = self.export_numpy()
+            if self.quantization:
+                self.numpy_model.quantize(self.quantization, *self.calibration_batch())
+        return self.numpy_model.predict(unnormalized_state, unnormalized_action)
+
+    def quantize(self, mode, data, calibration_size=2000):
+        """ Quantized inference: every predict goes through the numpy copy with int8 or float16 dense layers
+        (see numpy_nets.NumpyDynamicsModel.quantize), recalibrated on states from data after every fit.
+        None goes back to float32. """
+        self.quantization = mode
+        self.calibration_data = data
+        self.calibration_size = calibration_size
+        self.numpy_model = None
+
+    def calibration_batch(self):
+        # buffer states with both their own and uniform random actions, the planners query mostly the latter
+        sample_state, sample_action = self.calibration_data.sample(self.calibration_size)[:2]
+        random_action = np.random.uniform(low=self.env.action_space.low, high=self.env.action_space.high, size=sample_action.shape)
+        return np.concatenate([sample_state, sample_state]), np.concatenate([sample_action, random_action])
+
 class NNDynamicsRewardModel(NNDynamicsModel):
     def __init__(self, 
                  env, 
@@ -125,7 +505,8 @@ class NNDynamicsRewardModel(NNDynamicsModel):
                  batch_size,
                  iterations,
                  learning_rate,
-                 sess
+                 sess,
+                 numpy_threshold=0
                  ):
         """ YOUR CODE HERE """
         """ Note: Be careful about normalization """
@@ -144,6 +525,7 @@ class NNDynamicsRewardModel(NNDynamicsModel):
                                    self.env.observation_space.shape[0], 
                                    self.scope)
         # data normalization
+        self.normalization = normalization
         self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = normalization
 
         # optimization
@@ -152,6 +534,12 @@ class NNDynamicsRewardModel(NNDynamicsModel):
         self.iterations = iterations
         self.batch_size = batch_size
 
+        # batches up to numpy_threshold rows are predicted with the numpy snapshot of the weights
+        self.numpy_threshold = numpy_threshold
+        self.numpy_model = None
+        self.weights_version = 0
+        self.init_workspace()
+
         self.loss_dynamic = tf.reduce_mean(tf.squared_difference(self.states_delta, self.state_delta_predict))
         self.loss_reward = tf.reduce_mean(tf.squared_difference(self.reward, self.reward_predict))
         self.loss = self.loss_dynamic + self.loss_reward
@@ -159,39 +547,56 @@ class NNDynamicsRewardModel(NNDynamicsModel):
         self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
         self.train_step = self.optimizer.minimize(self.loss)
 
-    def build_network(self, states_action_input, state_size, scope, activation=tf.tanh):
+    def build_network(self, states_action_input, state_size, scope, activation=tf.tanh, reuse=False, split_states=None):
         # Predefined function to build a feedforward neural network with dynamic and reward
-        with tf.variable_scope(scope):
+        # with split_states (reuse only) the input is the action batch, see NNDynamicsModel.build_network
+        with tf.variable_scope(scope, reuse=reuse):
+            # share layer
+            if split_states is not None:
+              share = split_dense(split_states, states_action_input, activation, "dense")
+            else:
+              share = tf.layers.dense(states_action_input, 500, activation=activation, name="dense")
+
             if FLAGS.LAYER_NORM:
-              # share layer
-              share = tf.layers.dense(states_action_input, 500, activation=activation)
-              share = layers.layer_norm(share)
+              share = layers.layer_norm(share, scope="LayerNorm")
 
               # state delta prediction
-              state_delta_predict = tf.layers.dense(share, 500, activation=activation)
-              state_delta_predict = layers.layer_norm(state_delta_predict)
+              state_delta_predict = tf.layers.dense(share, 500, activation=activation, name="dense_1")
+              state_delta_predict = layers.layer_norm(state_delta_predict, scope="LayerNorm_1")
 
-              state_delta_predict = tf.layers.dense(state_delta_predict, state_size, activation=None)
+              state_delta_predict = tf.layers.dense(state_delta_predict, state_size, activation=None, name="dense_2")
 
               # reward prediction
-              reward_predict = tf.layers.dense(share, 500, activation=activation)
-              reward_predict = layers.layer_norm(reward_predict)
+              reward_predict = tf.layers.dense(share, 500, activation=activation, name="dense_3")
+              reward_predict = layers.layer_norm(reward_predict, scope="LayerNorm_2")
 
-              reward_predict = tf.layers.dense(reward_predict, 1, activation=None)
+              reward_predict = tf.layers.dense(reward_predict, 1, activation=None, name="dense_4")
             else:
-              # share layer
-              share = tf.layers.dense(states_action_input, 500, activation=activation)
               # state delta prediction
-              state_delta_predict = tf.layers.dense(share, 500, activation=activation)
-              state_delta_predict = tf.layers.dense(state_delta_predict, state_size, activation=None)
+              state_delta_predict = tf.layers.dense(share, 500, activation=activation, name="dense_1")
+              state_delta_predict = tf.layers.dense(state_delta_predict, state_size, activation=None, name="dense_2")
 
               # reward prediction
-              reward_predict = tf.layers.dense(share, 500, activation=activation)
-              reward_predict = tf.layers.dense(reward_predict, 1, activation=None)
+              reward_predict = tf.layers.dense(share, 500, activation=activation, name="dense_3")
+              reward_predict = tf.layers.dense(reward_predict, 1, activation=None, name="dense_4")
 
 
         return state_delta_predict, reward_predict
 
+    def predict_graph(self, states, actions):
+        """ In-graph version of predict, returns (unnormalized) next state and reward tensors """
+        normalized_state = (states - self.mean_obs.astype(np.float32)) / (self.std_obs.astype(np.float32) + 1e-10)
+        normalized_action = (actions - self.mean_action.astype(np.float32)) / (self.std_action.astype(np.float32) + 1e-10)
+
+        normalized_state_delta, normalized_reward = self.build_network(tf.concat([normalized_state, normalized_action], axis=1), 
+                                   self.env.observation_space.shape[0], 
+                                   self.scope,
+                                   reuse=True)
+
+        nxt_states = states + normalized_state_delta * self.std_deltas.astype(np.float32) + self.mean_deltas.astype(np.float32)
+        reward = normalized_reward * np.float32(self.std_reward) + np.float32(self.mean_reward)
+        return nxt_states, reward
+
     def fit(self, data):
         """
         Write a function to take in a dataset of (unnormalized)states, (unnormalized)actions, (unnormalized)next_states and fit the dynamics model going from normalized states, normalized actions to normalized state differences (s_t+1 - s_t)
@@ -216,11 +621,29 @@ class NNDynamicsRewardModel(NNDynamicsModel):
                                      self.states_delta:normalized_sample_state_delta})
             
             # print("loss ", i, " : ", loss)
+        self.numpy_model = None
+        self.weights_version += 1
         return model_loss, reward_loss
 
-    def predict(self, unnormalized_state, unnormalized_action):
+    def predict(self, unnormalized_state, unnormalized_action, out=None):
         """ Write a function to take in a batch of (unnormalized) states and (unnormalized) actions and return the (unnormalized) next states as predicted by using the model """
         """ YOUR CODE HERE """
+        if len(unnormalized_state) <= self.numpy_threshold or self.quantization:
+            nxt_state, reward = self.predict_numpy(unnormalized_state, unnormalized_action)
+            if out is None:
+                return nxt_state, reward
+            out[...] = nxt_state
+            return out, reward
+
+        if out is not None:
+            normalized_state, normalized_action = self.normalize_into(unnormalized_state, unnormalized_action)
+            normalized_state_delta, normalized_reward = self.sess.run([self.state_delta_predict, self.reward_predict],
+                                     feed_dict={self.states_input_placeholder:normalized_state, 
+                                                self.actions_input_placeholder:normalized_action})
+            np.multiply(normalized_reward, self.std_reward, out=normalized_reward)
+            normalized_reward += self.mean_reward
+            return self.denormalize_into(unnormalized_state, normalized_state_delta, out), normalized_reward
+
         normalized_state =  (unnormalized_state - self.mean_obs)/ (self.std_obs + 1e-10)
         normalized_action =  (unnormalized_action - self.mean_action)/ (self.std_action + 1e-10)
 
@@ -237,8 +660,504 @@ class NNDynamicsRewardModel(NNDynamicsModel):
 
         return unnormalized_nxt_state, unnormalized_reward
 
+    def shared_network(self, states, actions):
+        return list(self.build_network(actions, self.env.observation_space.shape[0], self.scope, reuse=True, split_states=states))
+
+    def export_numpy(self):
+        """ Picklable numpy copy of the model with the current weights """
+        return numpy_nets.NumpyDynamicsRewardModel(self.snapshot_weights(), self.normalization, FLAGS.LAYER_NORM)
+
+class NNDynamicsEnsembleModel(NNDynamicsModel):
+    def __init__(self, 
+                 env, 
+                 n_layers,
+                 size, 
+                 activation, 
+                 output_activation, 
+                 normalization,
+                 batch_size,
+                 iterations,
+                 learning_rate,
+                 sess,
+                 ensemble_size=5,
+                 numpy_threshold=0
+                 ):
+        """ Ensemble of ensemble_size bootstrapped dynamics networks. The member weights are stacked into
+        [ensemble_size, in, out] tensors, so all members run as one batched matmul per layer in one sess.run. """
+        self.env = env
+        self.ensemble_size = ensemble_size
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+
+        # [ensemble_size, batch, ob_dim + ac_dim] normalized inputs, one batch per member
+        self.ensemble_input = tf.placeholder(tf.float32, shape=(ensemble_size, None, ob_dim + ac_dim))
+        self.states_delta = tf.placeholder(tf.float32, shape=(ensemble_size, None, ob_dim))
+
+        self.scope = "NNDynamicsEnsembleModel"
+        self.n_layers = n_layers
+        self.size = size
+        self.activation = activation
+        self.output_activation = output_activation
+        self.state_delta_predict = self.build_network(self.ensemble_input, ob_dim, self.scope, n_layers=n_layers, size=size, 
+                                                      activation=activation, output_activation=output_activation)
+
+        # data normalization
+        self.normalization = normalization
+        self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = normalization
+
+        # optimization
+        self.sess = sess
+        self.learning_rate = learning_rate
+        self.iterations = iterations
+        self.batch_size = batch_size
+        self.numpy_threshold = numpy_threshold
+        self.numpy_model = None
+        self.weights_version = 0
+        self.init_workspace()
+
+        # members are summed so each one gets the gradient of its own mean loss
+        self.loss = tf.reduce_sum(tf.reduce_mean(tf.squared_difference(self.states_delta, self.state_delta_predict), axis=[1, 2]))
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        self.train_step = self.optimizer.minimize(self.loss)
+
+    def build_network(self, ensemble_input, output_size, scope, n_layers=2, size=500, activation=tf.tanh, output_activation=None, reuse=False):
+        # feedforward networks of all members at once, input [ensemble_size, batch, in]
+        out = ensemble_input
+        with tf.variable_scope(scope, reuse=reuse):
+            for i in range(n_layers + 1):
+                in_size = out.get_shape().as_list()[-1]
+                out_size = size if i < n_layers else output_size
+                kernel = tf.get_variable("kernel_%d" % i, [self.ensemble_size, in_size, out_size], 
+                                         initializer=tf.truncated_normal_initializer(stddev=1. / np.sqrt(in_size)))
+                bias = tf.get_variable("bias_%d" % i, [self.ensemble_size, 1, out_size], initializer=tf.zeros_initializer())
+                out = tf.matmul(out, kernel) + bias
+
+                if i < n_layers:
+                    if activation is not None:
+                        out = activation(out)
+                    if FLAGS.LAYER_NORM:
+                        # per member layer norm over the feature axis
+                        gamma = tf.get_variable("ln_gamma_%d" % i, [self.ensemble_size, 1, out_size], initializer=tf.ones_initializer())
+                        beta = tf.get_variable("ln_beta_%d" % i, [self.ensemble_size, 1, out_size], initializer=tf.zeros_initializer())
+                        mean, var = tf.nn.moments(out, axes=[2], keep_dims=True)
+                        out = (out - mean) * tf.rsqrt(var + 1e-12) * gamma + beta
+                elif output_activation is not None:
+                    out = output_activation(out)
+        return out
+
+    def normalized_input(self, unnormalized_state, unnormalized_action):
+        normalized_state =  (unnormalized_state - self.mean_obs)/ (self.std_obs + 1e-10)
+        normalized_action =  (unnormalized_action - self.mean_action)/ (self.std_action + 1e-10)
+        return np.concatenate([normalized_state, normalized_action], axis=-1)
+
+    def fit(self, data):
+        """ Every member is trained on its own bootstrap sample of the buffer """
+        print("Ensemble model fitting for ", self.iterations, "times ... ")
+        for i in range(self.iterations):
+            inputs = []
+            deltas = []
+            for k in range(self.ensemble_size):
+                sample_state, sample_action, sample_reward, sample_nxt_state, sample_state_delta = data.sample(self.batch_size)
+                inputs.append(self.normalized_input(sample_state, sample_action))
+                deltas.append(self.normalize(sample_state_delta, self.std_deltas, self.mean_deltas))
+
+            loss, _ = self.sess.run([self.loss, self.train_step], 
+                          feed_dict={self.ensemble_input:np.asarray(inputs), 
+                                     self.states_delta:np.asarray(deltas)})
+
+        self.numpy_model = None
+        self.weights_version += 1
+        return loss / self.ensemble_size, 0
+
+    def predict_all(self, unnormalized_state, unnormalized_action):
+        """ Next states of every member for every row [ensemble_size, batch, ob_dim], one sess.run """
+        inputs = np.tile(self.normalized_input(unnormalized_state, unnormalized_action)[None], [self.ensemble_size, 1, 1])
+        normalized_state_delta = self.sess.run(self.state_delta_predict, feed_dict={self.ensemble_input:inputs})
+        return unnormalized_state[None] + self.denomalize(normalized_state_delta, self.std_deltas, self.mean_deltas)
+
+    def predict(self, unnormalized_state, unnormalized_action, out=None):
+        # ensemble mean, same interface as NNDynamicsModel.predict
+        if len(unnormalized_state) <= self.numpy_threshold:
+            nxt_state = self.predict_numpy(unnormalized_state, unnormalized_action)
+            if out is None:
+                return nxt_state
+            out[...] = nxt_state
+            return out
+        return np.mean(self.predict_all(unnormalized_state, unnormalized_action), axis=0, out=out)
+
+    def predict_ts(self, unnormalized_state, unnormalized_action, members):
+        """ Trajectory sampling: row i is propagated by member members[i] only. Rows are grouped per member
+        (padded to the largest group) so the batch stays ~batch rows instead of ensemble_size * batch """
+        inputs = self.normalized_input(unnormalized_state, unnormalized_action)
+        counts = np.bincount(members, minlength=self.ensemble_size)
+        order = np.argsort(members, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        position = np.arange(len(members)) - starts[members[order]]
+
+        grouped = np.zeros((self.ensemble_size, np.max(counts), inputs.shape[1]))
+        grouped[members[order], position] = inputs[order]
+        normalized_state_delta = self.sess.run(self.state_delta_predict, feed_dict={self.ensemble_input:grouped})
+
+        state_delta = np.zeros_like(unnormalized_state)
+        state_delta[order] = normalized_state_delta[members[order], position]
+        return unnormalized_state + self.denomalize(state_delta, self.std_deltas, self.mean_deltas)
+
+    def predict_disagreement(self, unnormalized_state, unnormalized_action, members):
+        """ Trajectory sampling prediction plus the member disagreement of every row: the std across members
+        averaged over state dims, in units of the normalized state deltas """
+        nxt_states = self.predict_all(unnormalized_state, unnormalized_action)
+        disagreement = np.mean(np.std(nxt_states, axis=0) / (self.std_deltas + 1e-10), axis=1)
+        return nxt_states[members, np.arange(len(members))], disagreement
+
+    def predict_graph(self, states, actions):
+        """ In-graph ensemble mean prediction """
+        normalized_state = (states - self.mean_obs.astype(np.float32)) / (self.std_obs.astype(np.float32) + 1e-10)
+        normalized_action = (actions - self.mean_action.astype(np.float32)) / (self.std_action.astype(np.float32) + 1e-10)
+        inputs = tf.tile(tf.expand_dims(tf.concat([normalized_state, normalized_action], axis=1), 0), [self.ensemble_size, 1, 1])
+
+        normalized_state_delta = tf.reduce_mean(self.build_network(inputs, self.env.observation_space.shape[0], self.scope, 
+                                                                   n_layers=self.n_layers, size=self.size, activation=self.activation, 
+                                                                   output_activation=self.output_activation, reuse=True), axis=0)
+
+        return states + normalized_state_delta * self.std_deltas.astype(np.float32) + self.mean_deltas.astype(np.float32)
+
+    def predict_shared(self, unnormalized_states, unnormalized_action, out=None):
+        # the stacked member kernels are not split, rows are expanded and go through predict
+        unnormalized_states = np.reshape(unnormalized_states, [-1, self.env.observation_space.shape[0]])
+        repeats = len(unnormalized_action) // len(unnormalized_states)
+        return self.predict(np.repeat(unnormalized_states, repeats, axis=0), unnormalized_action, out=out)
+
+    def quantize(self, mode, data, calibration_size=2000):
+        # predict_all / predict_ts / predict_disagreement have no quantized path
+        if mode:
+            raise ValueError("quantized inference is not supported by the ensemble model")
+
+    def export_numpy(self):
+        """ Picklable numpy copy of the ensemble with the current weights """
+        return numpy_nets.NumpyEnsembleDynamicsModel(self.snapshot_weights(), self.normalization, self.n_layers, 
+                                                     NUMPY_ACTIVATIONS[self.activation], NUMPY_ACTIVATIONS[self.output_activation], 
+                                                     FLAGS.LAYER_NORM)
+
+class NNDynamicsStudentModel(NNDynamicsModel):
+    def __init__(self, 
+                 teacher,
+                 n_layers,
+                 size, 
+                 activation, 
+                 batch_size,
+                 iterations,
+                 learning_rate,
+                 sess,
+                 random_action_fraction=0.5,
+                 numpy_threshold=0,
+                 scope="NNDynamicsStudentModel"
+                 ):
+        """ Small network distilled from a teacher model (NNDynamicsModel, NNDynamicsRewardModel or the ensemble mean)
+        to be used by the planners only, the teacher stays the model that is fit on real data and evaluated.
+        Targets are the teacher's normalized predictions; random_action_fraction of the buffer actions are replaced
+        by uniform random actions, since the shooting planners mostly query the model off the data distribution.
+        With a reward teacher the reward is predicted as an extra output and predict returns (next state, reward). """
+        self.teacher = teacher
+        self.env = teacher.env
+        self.predict_reward = isinstance(teacher, NNDynamicsRewardModel)
+        self.random_action_fraction = random_action_fraction
+        ob_dim = self.env.observation_space.shape[0]
+        output_size = ob_dim + 1 if self.predict_reward else ob_dim
+
+        self.states_input_placeholder =  tf.placeholder(tf.float32, shape=(None, ob_dim))
+        self.actions_input_placeholder =  tf.placeholder(tf.float32, shape=(None, self.env.action_space.shape[0]))
+        self.states_action_input = tf.concat([self.states_input_placeholder, self.actions_input_placeholder], axis=1)
+        self.targets = tf.placeholder(tf.float32, shape=(None, output_size))
+
+        self.scope = scope
+        self.n_layers = n_layers
+        self.size = size
+        self.activation = activation
+        self.output_activation = None
+        self.prediction = self.build_network(self.states_action_input, 
+                                   output_size, 
+                                   self.scope, 
+                                   n_layers=n_layers, 
+                                   size=size,
+                                   activation=activation)
+        self.state_delta_predict = self.prediction[:, :ob_dim]
+        self.reward_predict = self.prediction[:, ob_dim:]
+
+        # same normalization as the teacher
+        self.normalization = teacher.normalization
+        self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = self.normalization
+
+        self.sess = sess
+        self.learning_rate = learning_rate
+        self.iterations = iterations
+        self.batch_size = batch_size
+
+        self.numpy_threshold = numpy_threshold
+        self.numpy_model = None
+        self.weights_version = 0
+        self.init_workspace()
+
+        self.loss = tf.reduce_mean(tf.squared_difference(self.targets, self.prediction))
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        self.train_step = self.optimizer.minimize(self.loss, var_list=tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self.scope))
+
+    def teacher_batch(self, data, batch_size):
+        """ Normalized inputs and teacher targets for batch_size buffer states """
+        sample_state, sample_action = data.sample(batch_size)[:2]
+        random_rows = np.random.uniform(size=len(sample_action)) < self.random_action_fraction
+        sample_action[random_rows] = np.random.uniform(low=self.env.action_space.low, 
+                                                       high=self.env.action_space.high, 
+                                                       size=[np.sum(random_rows), sample_action.shape[1]])
+
+        prediction = self.teacher.predict(sample_state, sample_action)
+        if self.predict_reward:
+            teacher_nxt_state, teacher_reward = prediction
+        else:
+            teacher_nxt_state = prediction
+
+        targets = self.normalize(teacher_nxt_state - sample_state, self.std_deltas, self.mean_deltas)
+        if self.predict_reward:
+            targets = np.concatenate([targets, self.normalize(np.reshape(teacher_reward, [-1, 1]), self.std_reward, self.mean_reward)], axis=1)
+
+        return (self.normalize(sample_state, self.std_obs, self.mean_obs), 
+                self.normalize(sample_action, self.std_action, self.mean_action), 
+                targets)
+
+    def fit(self, data):
+        """ Distill the teacher on states from data, returns the distillation loss and the error against the teacher """
+        print("Student model distillation for ", self.iterations, "times ... ")
+        for i in range(self.iterations):
+            normalized_state, normalized_action, targets = self.teacher_batch(data, self.batch_size)
+            loss, _ = self.sess.run([self.loss, self.train_step], 
+                          feed_dict={self.states_input_placeholder:normalized_state, 
+                                     self.actions_input_placeholder:normalized_action,
+                                     self.targets:targets})
+
+        self.numpy_model = None
+        self.weights_version += 1
+        return loss, self.teacher_error(data)
+
+    def teacher_error(self, data, batch_size=2000):
+        """ RMS error of the student against the teacher on a fresh batch, in normalized delta (and reward) units """
+        normalized_state, normalized_action, targets = self.teacher_batch(data, batch_size)
+        prediction = self.sess.run(self.prediction, feed_dict={self.states_input_placeholder:normalized_state, 
+                                                               self.actions_input_placeholder:normalized_action})
+        return np.sqrt(np.mean(np.square(prediction - targets)))
+
+    def predict_graph(self, states, actions):
+        """ In-graph version of predict, next state (and reward) tensors """
+        ob_dim = self.env.observation_space.shape[0]
+        normalized_state = (states - self.mean_obs.astype(np.float32)) / (self.std_obs.astype(np.float32) + 1e-10)
+        normalized_action = (actions - self.mean_action.astype(np.float32)) / (self.std_action.astype(np.float32) + 1e-10)
+
+        prediction = self.build_network(tf.concat([normalized_state, normalized_action], axis=1), 
+                                   int(self.prediction.shape[1]), 
+                                   self.scope, 
+                                   n_layers=self.n_layers, 
+                                   size=self.size,
+                                   activation=self.activation,
+                                   reuse=True)
+
+        nxt_states = states + prediction[:, :ob_dim] * self.std_deltas.astype(np.float32) + self.mean_deltas.astype(np.float32)
+        if self.predict_reward:
+            return nxt_states, prediction[:, ob_dim:] * np.float32(self.std_reward) + np.float32(self.mean_reward)
+        return nxt_states
+
+    def shared_network(self, states, actions):
+        ob_dim = self.env.observation_space.shape[0]
+        prediction = self.build_network(actions, 
+                                   int(self.prediction.shape[1]), 
+                                   self.scope, 
+                                   n_layers=self.n_layers, 
+                                   size=self.size,
+                                   activation=self.activation,
+                                   reuse=True,
+                                   split_states=states)
+        return [prediction[:, :ob_dim], prediction[:, ob_dim:]] if self.predict_reward else [prediction]
+
+    def predict(self, unnormalized_state, unnormalized_action, out=None):
+        """ Same interface as the teacher's predict """
+        if len(unnormalized_state) <= self.numpy_threshold or self.quantization:
+            prediction = self.predict_numpy(unnormalized_state, unnormalized_action)
+            nxt_state = prediction[0] if self.predict_reward else prediction
+            if out is not None:
+                out[...] = nxt_state
+                nxt_state = out
+            return (nxt_state, prediction[1]) if self.predict_reward else nxt_state
+
+        if out is not None:
+            normalized_state, normalized_action = self.normalize_into(unnormalized_state, unnormalized_action)
+        else:
+            normalized_state =  (unnormalized_state - self.mean_obs)/ (self.std_obs + 1e-10)
+            normalized_action =  (unnormalized_action - self.mean_action)/ (self.std_action + 1e-10)
+            out = np.empty(unnormalized_state.shape)
+
+        prediction = self.sess.run(self.prediction, feed_dict={self.states_input_placeholder:normalized_state, 
+                                                               self.actions_input_placeholder:normalized_action})
+        ob_dim = unnormalized_state.shape[1]
+        nxt_state = self.denormalize_into(unnormalized_state, prediction[:, :ob_dim], out)
+        if self.predict_reward:
+            return nxt_state, self.denomalize(prediction[:, ob_dim:], self.std_reward, self.mean_reward)
+        return nxt_state
+
+    def export_numpy(self):
+        """ Picklable numpy copy of the model with the current weights """
+        return numpy_nets.NumpyDynamicsModel(self.snapshot_weights(), self.normalization, self.n_layers, 
+                                             NUMPY_ACTIVATIONS[self.activation], None, 
+                                             FLAGS.LAYER_NORM, predict_reward=self.predict_reward)
+
+def window_starts(states, nxt_states, length):
+    """ Indices i of the buffer entries (in insertion order) where entries i..i+length-1 are consecutive steps of one
+    trajectory, i.e. every next state is the state of the following entry """
+    continuous = np.all(nxt_states[:-1] == states[1:], axis=1)
+    breaks = np.concatenate([[0], np.cumsum(~continuous)])
+    starts = np.arange(len(states) - length + 1)
+    return starts[breaks[starts + length - 1] - breaks[starts] == 0]
+
+class NNDynamicsChunkModel(NNDynamicsModel):
+    def __init__(self, 
+                 env, 
+                 chunk,
+                 data,
+                 n_layers,
+                 size, 
+                 activation, 
+                 normalization,
+                 batch_size,
+                 iterations,
+                 learning_rate,
+                 sess,
+                 numpy_threshold=0
+                 ):
+        """ Temporally abstracted model: predicts the state chunk steps ahead and the summed reward of the chunk
+        from a state and the chunk's actions [chunk * ac_dim], trained on windows of consecutive steps of the
+        trajectories in data (DataBufferGeneral of state, action, reward, next state, delta). predict returns
+        (state after the chunk, chunk reward) so a rollout over horizon steps is horizon / chunk model calls.
+        The action, delta and reward normalization are per chunk, computed from data. """
+        self.env = env
+        self.chunk = chunk
+        ob_dim = self.env.observation_space.shape[0]
+        ac_dim = self.env.action_space.shape[0]
+
+        self.states_input_placeholder =  tf.placeholder(tf.float32, shape=(None, ob_dim))
+        self.actions_input_placeholder =  tf.placeholder(tf.float32, shape=(None, chunk * ac_dim))
+        self.states_action_input = tf.concat([self.states_input_placeholder, self.actions_input_placeholder], axis=1)
+        self.targets = tf.placeholder(tf.float32, shape=(None, ob_dim + 1))
+
+        self.scope = "NNDynamicsChunkModel"
+        self.n_layers = n_layers
+        self.size = size
+        self.activation = activation
+        self.output_activation = None
+        self.prediction = self.build_network(self.states_action_input, 
+                                   ob_dim + 1, 
+                                   self.scope, 
+                                   n_layers=n_layers, 
+                                   size=size,
+                                   activation=activation)
+        self.state_delta_predict = self.prediction[:, :ob_dim]
+        self.reward_predict = self.prediction[:, ob_dim:]
+
+        # one step state normalization, chunk actions, deltas and rewards normalized from the windows in data
+        mean_obs, std_obs, mean_action, std_action, _, _, mean_nxt_state, std_nxt_state, _, _ = normalization
+        state, _, reward, nxt_state = self.windows(data, 10000)
+        chunk_deltas = nxt_state[:, -1] - state[:, 0]
+        chunk_reward = np.sum(reward, axis=1)
+        self.normalization = [mean_obs, std_obs, np.tile(mean_action, chunk), np.tile(std_action, chunk), 
+                              np.mean(chunk_reward), np.std(chunk_reward), mean_nxt_state, std_nxt_state, 
+                              np.mean(chunk_deltas, axis=0), np.std(chunk_deltas, axis=0)]
+        self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = self.normalization
+
+        self.sess = sess
+        self.learning_rate = learning_rate
+        self.iterations = iterations
+        self.batch_size = batch_size
+
+        self.numpy_threshold = numpy_threshold
+        self.numpy_model = None
+        self.weights_version = 0
+        self.init_workspace()
+
+        self.loss = tf.reduce_mean(tf.squared_difference(self.targets, self.prediction))
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        self.train_step = self.optimizer.minimize(self.loss, var_list=tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, self.scope))
+
+    def windows(self, data, num, items=None):
+        """ num random windows of chunk consecutive steps: states, actions, rewards, next states [num, chunk, ...] """
+        state, action, reward, nxt_state = (items or data.arrays())[:4]
+        starts = window_starts(state, nxt_state, self.chunk)
+        if len(starts) == 0:
+            raise ValueError("no run of %d consecutive steps in the buffer to train the chunk model on" % self.chunk)
+        indices = np.random.choice(starts, num)[:, None] + np.arange(self.chunk)
+        return state[indices], action[indices], reward[indices], nxt_state[indices]
+
+    def fit(self, data):
+        """ Fit on chunk windows of data, returns the state and reward losses (normalized) """
+        print("Chunk model fitting for ", self.iterations, "times ... ")
+        ob_dim = self.env.observation_space.shape[0]
+        items = data.arrays()
+        for i in range(self.iterations):
+            state, action, reward, nxt_state = self.windows(data, self.batch_size, items)
+            targets = np.concatenate([self.normalize(nxt_state[:, -1] - state[:, 0], self.std_deltas, self.mean_deltas),
+                                      self.normalize(np.sum(reward, axis=1, keepdims=True), self.std_reward, self.mean_reward)], axis=1)
+
+            prediction, _ = self.sess.run([self.prediction, self.train_step], 
+                          feed_dict={self.states_input_placeholder:self.normalize(state[:, 0], self.std_obs, self.mean_obs), 
+                                     self.actions_input_placeholder:self.normalize(np.reshape(action, [len(action), -1]), self.std_action, self.mean_action),
+                                     self.targets:targets})
+
+        self.numpy_model = None
+        self.weights_version += 1
+        errors = np.square(prediction - targets)
+        return np.mean(errors[:, :ob_dim]), np.mean(errors[:, ob_dim:])
+
+    def predict_graph(self, states, actions):
+        """ In-graph version of predict, state after the chunk and chunk reward tensors from chunk actions [N, chunk * ac_dim] """
+        ob_dim = self.env.observation_space.shape[0]
+        normalized_state = (states - self.mean_obs.astype(np.float32)) / (self.std_obs.astype(np.float32) + 1e-10)
+        normalized_action = (actions - self.mean_action.astype(np.float32)) / (self.std_action.astype(np.float32) + 1e-10)
+
+        prediction = self.build_network(tf.concat([normalized_state, normalized_action], axis=1), 
+                                   ob_dim + 1, 
+                                   self.scope, 
+                                   n_layers=self.n_layers, 
+                                   size=self.size,
+                                   activation=self.activation,
+                                   reuse=True)
+
+        nxt_states = states + prediction[:, :ob_dim] * self.std_deltas.astype(np.float32) + self.mean_deltas.astype(np.float32)
+        return nxt_states, prediction[:, ob_dim:] * np.float32(self.std_reward) + np.float32(self.mean_reward)
 
+    def predict(self, unnormalized_state, unnormalized_action, out=None):
+        """ State after the chunk and chunk reward for states [N, ob_dim] and chunk actions [N, chunk * ac_dim] """
+        if len(unnormalized_state) <= self.numpy_threshold or self.quantization:
+            nxt_state, reward = self.predict_numpy(unnormalized_state, unnormalized_action)
+            if out is None:
+                return nxt_state, reward
+            out[...] = nxt_state
+            return out, reward
 
+        if out is not None:
+            normalized_state, normalized_action = self.normalize_into(unnormalized_state, unnormalized_action)
+        else:
+            normalized_state =  (unnormalized_state - self.mean_obs)/ (self.std_obs + 1e-10)
+            normalized_action =  (unnormalized_action - self.mean_action)/ (self.std_action + 1e-10)
+            out = np.empty(unnormalized_state.shape)
 
+        prediction = self.sess.run(self.prediction, feed_dict={self.states_input_placeholder:normalized_state, 
+                                                               self.actions_input_placeholder:normalized_action})
+        ob_dim = unnormalized_state.shape[1]
+        return (self.denormalize_into(unnormalized_state, prediction[:, :ob_dim], out), 
+                self.denomalize(prediction[:, ob_dim:], self.std_reward, self.mean_reward))
 
+    def shared_network(self, states, actions):
+        ob_dim = self.env.observation_space.shape[0]
+        prediction = self.build_network(actions, ob_dim + 1, self.scope, n_layers=self.n_layers, size=self.size,
+                                        activation=self.activation, reuse=True, split_states=states)
+        return [prediction[:, :ob_dim], prediction[:, ob_dim:]]
 
+    def export_numpy(self):
+        """ Picklable numpy copy of the model with the current weights """
+        return numpy_nets.NumpyDynamicsModel(self.snapshot_weights(), self.normalization, self.n_layers, 
+                                             NUMPY_ACTIVATIONS[self.activation], None, 
+                                             FLAGS.LAYER_NORM, predict_reward=True)
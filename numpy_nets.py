@@ -0,0 +1,176 @@
+import numpy as np
+
+# Numpy forward pass of the tf.layers networks, used for small batches where sess.run dispatch
+# and feed dicts cost more than the math. No tensorflow import so worker processes stay light.
+
+ACTIVATIONS = {None: lambda x: x,
+               'tanh': np.tanh,
+               'relu': lambda x: np.maximum(x, 0.)}
+
+def layer_name(base, i):
+    # default tf.layers / layer_norm naming inside a scope: dense, dense_1, ...
+    return base if i == 0 else base + "_%d" % i
+
+def snapshot_variables(sess, variables, scope):
+    """ Fetch tf variables into a dict of float32 arrays keyed by their name relative to scope, e.g. 'dense/kernel' """
+    values = sess.run(variables)
+    return {v.name[len(scope) + 1:].split(':')[0]: np.asarray(value, dtype=np.float32) for v, value in zip(variables, values)}
+
+class Workspace(object):
+    """ Named buffers (float32 by default) reused across calls, (re)allocated only when the requested shape or
+    dtype changes. allocations counts the (re)allocations so steady state planning can be checked to allocate nothing. """
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.float32):
+        shape = tuple(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+def dense(x, weights, name, activation=None):
+    out = np.dot(x, weights[name + '/kernel']) + weights[name + '/bias']
+    return ACTIVATIONS[activation](out)
+
+def quantize_weights(weights, mode):
+    """ float16 or int8 copy of the dense kernels, int8 kernels come with per output channel scales (name/scale).
+    numpy has no float16 / int8 gemm, so the quantized values are kept in float32 arrays and the products still
+    run through BLAS: int8 products of fan-in up to 1040 accumulate exactly in float32 (127 * 127 * 1040 < 2^24) """
+    quantized = {}
+    for name, value in weights.items():
+        if not name.endswith('/kernel'):
+            quantized[name] = value
+        elif mode == 'float16':
+            quantized[name] = value.astype(np.float16).astype(np.float32)
+        elif mode == 'int8':
+            scale = np.maximum(np.max(np.abs(value), axis=0), 1e-8) / 127.
+            quantized[name] = np.round(value / scale).astype(np.float32)
+            quantized[name[:-len('kernel')] + 'scale'] = scale.astype(np.float32)
+        else:
+            raise ValueError("unknown quantization " + mode)
+    return quantized
+
+def float16_dense(x, weights, name, activation=None):
+    out = np.dot(x.astype(np.float16).astype(np.float32), weights[name + '/kernel']) + weights[name + '/bias']
+    return ACTIVATIONS[activation](out)
+
+def int8_dense(x, weights, name, input_scale, activation=None):
+    # symmetric int8 input with a calibrated per layer scale, int8 kernel with per output channel scales
+    x_int = np.clip(np.rint(x * (1. / input_scale)), -127, 127).astype(np.float32)
+    out = np.dot(x_int, weights[name + '/kernel'])
+    out *= input_scale * weights[name + '/scale']
+    out += weights[name + '/bias']
+    return ACTIVATIONS[activation](out)
+
+def layer_norm(x, weights, name, epsilon=1e-12):
+    # same as tf.contrib.layers.layer_norm over the feature axis
+    mean = np.mean(x, axis=1, keepdims=True)
+    var = np.var(x, axis=1, keepdims=True)
+    return (x - mean) / np.sqrt(var + epsilon) * weights[name + '/gamma'] + weights[name + '/beta']
+
+class NumpyDynamicsModel(object):
+    """ Picklable numpy copy of NNDynamicsModel (see NNDynamicsModel.export_numpy), holds no tensorflow objects.
+    With predict_reward the last output column is the normalized reward (NNDynamicsStudentModel of a reward model) """
+    def __init__(self, weights, normalization, n_layers, activation, output_activation, use_layer_norm, predict_reward=False):
+        self.weights = weights
+        self.predict_reward = predict_reward
+        self.mean_obs, self.std_obs, self.mean_action, self.std_action, self.mean_reward, self.std_reward, self.mean_nxt_state, self.std_nxt_state, self.mean_deltas, self.std_deltas = normalization
+        self.n_layers = n_layers
+        self.activation = activation
+        self.output_activation = output_activation
+        self.use_layer_norm = use_layer_norm
+        self.quantization = None
+        self.calibration = None
+
+    def dense(self, x, name, activation=None):
+        # dense layer in the precision set by quantize, records the input range while calibrating
+        if self.quantization == 'int8':
+            return int8_dense(x, self.quantized_weights, name, self.input_scales[name], activation)
+        if self.quantization == 'float16':
+            return float16_dense(x, self.quantized_weights, name, activation)
+        if self.calibration is not None:
+            self.calibration[name] = max(self.calibration.get(name, 0.), float(np.max(np.abs(x))))
+        return dense(x, self.weights, name, activation)
+
+    def quantize(self, mode, unnormalized_state, unnormalized_action):
+        """ Post-training quantization of the dense layers to mode ('int8' or 'float16', None is float32).
+        int8 input scales are the max abs input of every layer over the calibration batch. Returns self. """
+        self.quantization = None
+        if mode == 'int8':
+            self.calibration = {}
+            self.predict(unnormalized_state, unnormalized_action)
+            self.input_scales = {name: max(value, 1e-8) / 127. for name, value in self.calibration.items()}
+            self.calibration = None
+        if mode:
+            self.quantized_weights = quantize_weights(self.weights, mode)
+        self.quantization = mode
+        return self
+
+    def normalized_input(self, unnormalized_state, unnormalized_action):
+        normalized_state = (unnormalized_state - self.mean_obs) / (self.std_obs + 1e-10)
+        normalized_action = (unnormalized_action - self.mean_action) / (self.std_action + 1e-10)
+        return np.concatenate([normalized_state, normalized_action], axis=1).astype(np.float32)
+
+    def predict(self, unnormalized_state, unnormalized_action):
+        out = self.normalized_input(unnormalized_state, unnormalized_action)
+        for i in range(self.n_layers):
+            out = self.dense(out, layer_name("dense", i), self.activation)
+            if self.use_layer_norm:
+                out = layer_norm(out, self.weights, layer_name("LayerNorm", i))
+        normalized_state_delta = self.dense(out, layer_name("dense", self.n_layers), self.output_activation)
+
+        if self.predict_reward:
+            ob_dim = unnormalized_state.shape[1]
+            unnormalized_reward = normalized_state_delta[:, ob_dim:] * self.std_reward + self.mean_reward
+            return unnormalized_state + normalized_state_delta[:, :ob_dim] * self.std_deltas + self.mean_deltas, unnormalized_reward
+
+        return unnormalized_state + normalized_state_delta * self.std_deltas + self.mean_deltas
+
+class NumpyEnsembleDynamicsModel(NumpyDynamicsModel):
+    """ Picklable numpy copy of NNDynamicsEnsembleModel, the stacked [ensemble_size, in, out] member kernels
+    (kernel_i, bias_i, ln_gamma_i, ln_beta_i) run as one batched product per layer. predict is the ensemble mean """
+    def predict_all(self, unnormalized_state, unnormalized_action):
+        """ Next states of every member [ensemble_size, batch, ob_dim] """
+        out = self.normalized_input(unnormalized_state, unnormalized_action)
+        for i in range(self.n_layers + 1):
+            kernel = self.weights['kernel_%d' % i]
+            out = np.einsum('kbi,kio->kbo' if out.ndim == 3 else 'bi,kio->kbo', out, kernel) + self.weights['bias_%d' % i]
+            if i < self.n_layers:
+                out = ACTIVATIONS[self.activation](out)
+                if self.use_layer_norm:
+                    mean = np.mean(out, axis=2, keepdims=True)
+                    var = np.var(out, axis=2, keepdims=True)
+                    out = (out - mean) / np.sqrt(var + 1e-12) * self.weights['ln_gamma_%d' % i] + self.weights['ln_beta_%d' % i]
+            else:
+                out = ACTIVATIONS[self.output_activation](out)
+        return unnormalized_state[None] + out * self.std_deltas + self.mean_deltas
+
+    def predict(self, unnormalized_state, unnormalized_action):
+        return np.mean(self.predict_all(unnormalized_state, unnormalized_action), axis=0)
+
+class NumpyDynamicsRewardModel(NumpyDynamicsModel):
+    """ Picklable numpy copy of NNDynamicsRewardModel, predict returns next states and rewards """
+    def __init__(self, weights, normalization, use_layer_norm):
+        NumpyDynamicsModel.__init__(self, weights, normalization, 1, 'tanh', None, use_layer_norm)
+
+    def predict(self, unnormalized_state, unnormalized_action):
+        share = self.dense(self.normalized_input(unnormalized_state, unnormalized_action), "dense", 'tanh')
+        if self.use_layer_norm:
+            share = layer_norm(share, self.weights, "LayerNorm")
+
+        state_delta = self.dense(share, "dense_1", 'tanh')
+        reward = self.dense(share, "dense_3", 'tanh')
+        if self.use_layer_norm:
+            state_delta = layer_norm(state_delta, self.weights, "LayerNorm_1")
+            reward = layer_norm(reward, self.weights, "LayerNorm_2")
+        normalized_state_delta = self.dense(state_delta, "dense_2")
+        normalized_reward = self.dense(reward, "dense_4")
+
+        unnormalized_nxt_state = unnormalized_state + normalized_state_delta * self.std_deltas + self.mean_deltas
+        unnormalized_reward = normalized_reward * self.std_reward + self.mean_reward
+
+        return unnormalized_nxt_state, unnormalized_reward
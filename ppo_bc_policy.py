@@ -5,7 +5,9 @@ from baselines.common.distributions import make_pdtype
 import tflearn
 import baselines.common.tf_util as U
 import tensorflow as tf
+import numpy as np
 import gym
+import numpy_nets
 
 # from baselines.common.mpi_adam import MpiAdam
 # from baselines.common.mpi_moments import mpi_moments
@@ -15,8 +17,11 @@ import gym
 class MlpPolicy(object):
     recurrent = False
 
-    def __init__(self, sess, env, hid_size, num_hid_layers, clip_param, entcoeff):
+    def __init__(self, sess, env, hid_size, num_hid_layers, clip_param, entcoeff, numpy_threshold=0):
         self.sess = sess
+        # batches up to numpy_threshold observations are evaluated with a numpy snapshot of the weights
+        self.numpy_threshold = numpy_threshold
+        self.numpy_weights = None
         self.ob_space = env.observation_space
         self.ac_space = env.action_space
         self.ob_dim = env.observation_space.shape[0]
@@ -51,19 +56,20 @@ class MlpPolicy(object):
         self.update_op_ppo = tf.train.AdamOptimizer(self.learning_rate).minimize(self.ppo_loss, var_list=self.var_list)
         self.update_op_bc = tf.train.AdamOptimizer(self.learning_rate).minimize(self.bc_loss, var_list=self.var_list)
 
-    def build_network(self, sess, scope, ob):
+    def build_network(self, sess, scope, ob, ob_rms=None, reuse=False):
 
-        with tf.variable_scope(scope + "/obfilter"):
-            ob_rms = RunningMeanStd(shape=self.ob_space.shape)
+        if ob_rms is None:
+            with tf.variable_scope(scope + "/obfilter"):
+                ob_rms = RunningMeanStd(shape=self.ob_space.shape)
 
-        with tf.variable_scope(scope + '/vf'):
+        with tf.variable_scope(scope + '/vf', reuse=reuse):
             obz = tf.clip_by_value((ob - ob_rms.mean) / ob_rms.std, -5.0, 5.0)
             last_out = obz
             for i in range(self.num_hid_layers):
                 last_out = tf.nn.tanh(tf.layers.dense(last_out, self.hid_size, name="fc%i"%(i+1), kernel_initializer=U.normc_initializer(1.0)))
             vpred = tf.layers.dense(last_out, 1, name='final', kernel_initializer=U.normc_initializer(1.0))[:,0]
 
-        with tf.variable_scope(scope + '/pol'):
+        with tf.variable_scope(scope + '/pol', reuse=reuse):
             last_out = obz
             
             ############## tf layers version #############
@@ -133,6 +139,7 @@ class MlpPolicy(object):
                             })
 
     def lossandupdate_ppo(self, ob, ac, atarg, ret, cur_lrmult, learning_rate):
+         self.numpy_weights = None
          losses, _ = self.sess.run([self.losses, self.update_op_ppo],
                  feed_dict={self.ob: ob,
                             self.ac: ac, 
@@ -144,6 +151,7 @@ class MlpPolicy(object):
          return losses
 
     def update_bc(self, ob, ac, learning_rate):
+        self.numpy_weights = None
         self.sess.run(self.update_op_bc,
                  feed_dict={self.ob: ob,
                             self.ac: ac, 
@@ -160,6 +168,7 @@ class MlpPolicy(object):
                             })
 
     def optimize(self, lr, ob, ac, atarg, ret):
+        self.numpy_weights = None
         self.sess.run(self.update_op_ppo, feed_dict={self.learning_rate:lr,
                                                  self.ob: ob,
                                                  self.ac: ac, 
@@ -168,6 +177,8 @@ class MlpPolicy(object):
 
 
     def assign_old_eq_new(self):
+        # called every iteration right after ob_rms.update, so the numpy snapshot is refreshed with the new filter too
+        self.numpy_weights = None
         self.sess.run([self.assign_old_eq_new_op])
 
 
@@ -177,6 +188,9 @@ class MlpPolicy(object):
         # ensure dim is [?, s_dim]
             ob = ob[None]
 
+        if len(ob) <= self.numpy_threshold:
+            return self.act_numpy(ob, stochastic)
+
         if stochastic:
             ac1, vpred1 =  self.sess.run([self.sample_ac, self.vpred], feed_dict={self.ob: ob})
         else:
@@ -184,6 +198,43 @@ class MlpPolicy(object):
 
         return ac1, vpred1
 
+    def snapshot_weights(self):
+        """ Copy the current policy weights and observation filter out of the session for act_numpy """
+        self.numpy_weights = numpy_nets.snapshot_variables(self.sess, self.get_trainable_variables(), self.pi_scope)
+        self.numpy_weights['ob_mean'], self.numpy_weights['ob_std'] = self.sess.run([self.ob_rms.mean, self.ob_rms.std])
+
+    def act_numpy(self, ob, stochastic=True):
+        """ Numpy forward pass of act: observation filter and clipping, tanh layers, gaussian sampling """
+        if self.numpy_weights is None:
+            self.snapshot_weights()
+        weights = self.numpy_weights
+
+        if ob.ndim == 1:
+            ob = ob[None]
+        obz = np.clip((ob - weights['ob_mean']) / weights['ob_std'], -5.0, 5.0).astype(np.float32)
+
+        last_out = obz
+        for i in range(self.num_hid_layers):
+            last_out = numpy_nets.dense(last_out, weights, 'pi/vf/fc%i'%(i+1), 'tanh')
+        vpred = numpy_nets.dense(last_out, weights, 'pi/vf/final')[:,0]
+
+        last_out = obz
+        for i in range(self.num_hid_layers):
+            last_out = numpy_nets.dense(last_out, weights, 'pi/pol/fc%i'%(i+1), 'tanh')
+        ac = numpy_nets.dense(last_out, weights, 'pi/pol/final')
+
+        if stochastic:
+            ac = ac + np.exp(weights['pi/pol/logstd']) * np.random.normal(size=ac.shape)
+
+        return ac, vpred
+
+    def act_graph(self, ob):
+        """ Apply the current policy to an ob tensor with shared weights (used inside the in-graph mpc rollouts),
+        returns sampled action, mean action and vpred tensors """
+        with tf.variable_scope(self.pi_scope):
+            _, vpred, _, sample_ac, ac_mean = self.build_network(self.sess, 'pi', ob, ob_rms=self.ob_rms, reuse=True)
+        return sample_ac, ac_mean, vpred
+
     def get_old_variables(self):
         return tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, self.old_pi_scope)
 
@@ -0,0 +1,256 @@
+import numpy as np
+import threading
+import copy
+
+# Action sequence proposal generators for the shooting planners. Every proposal returns action paths
+# [horizon, num_paths, ac_dim] inside [low, high]; update() is called with the plan the controller chose
+# so proposals that learn from past plans (PCA) can refit.
+
+PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97]
+
+def primes(n):
+    """ First n primes """
+    found = list(PRIMES[:n])
+    candidate = found[-1] + 2
+    while len(found) < n:
+        if all(candidate % p for p in found if p * p <= candidate):
+            found.append(candidate)
+        candidate += 2
+    return found
+
+def radical_inverse(indices, base):
+    # van der Corput sequence of the integer indices in the given base
+    result = np.zeros(len(indices))
+    fraction = 1. / base
+    indices = np.array(indices)
+    while np.any(indices > 0):
+        result += (indices % base) * fraction
+        indices = indices // base
+        fraction /= base
+    return result
+
+def colored_noise(beta, size, axis=0):
+    """ Gaussian noise with unit std and power spectrum ~ 1/f^beta along axis (beta 0 is white noise) """
+    size = list(size)
+    length = size[axis]
+    freqs = np.fft.rfftfreq(length)
+    freqs[0] = freqs[1] if length > 1 else 1.
+    scale = freqs ** (-beta / 2.)
+
+    spectrum_size = size[:]
+    spectrum_size[axis] = len(freqs)
+    shape = [1] * len(size)
+    shape[axis] = len(freqs)
+    spectrum = (np.random.normal(size=spectrum_size) + 1j * np.random.normal(size=spectrum_size)) * np.reshape(scale, shape)
+
+    noise = np.fft.irfft(spectrum, n=length, axis=axis)
+    return noise / (np.std(noise, axis=axis, keepdims=True) + 1e-8)
+
+class Proposal(object):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, horizon, num_paths):
+        raise NotImplementedError
+
+    def update(self, action_path):
+        pass
+
+    # State changed by sample / update, restored when a speculative plan is dropped (controllers.AsyncController).
+    # Stateless proposals and the shared action pool return themselves
+    def snapshot(self):
+        return self
+
+    def scale(self, unit):
+        # [0, 1] samples to the action range
+        return self.low + unit * (self.high - self.low)
+
+    def scale_gaussian(self, noise, std=0.5):
+        # unit gaussian samples to the action range, std as a fraction of the half range, clipped
+        return np.clip((self.high + self.low) / 2. + noise * std * (self.high - self.low) / 2., self.low, self.high)
+
+class UniformProposal(Proposal):
+    """ i.i.d. uniform actions, the original sample_random_actions """
+    def sample(self, horizon, num_paths):
+        return np.random.uniform(low=self.low, high=self.high, size=[horizon, num_paths, len(self.high)])
+
+class HaltonProposal(Proposal):
+    """ Randomly shifted Halton points in the horizon * ac_dim cube, covers it more evenly than i.i.d. samples """
+    def __init__(self, low, high):
+        Proposal.__init__(self, low, high)
+        self.offset = 0
+
+    def snapshot(self):
+        return copy.copy(self)
+
+    def sample(self, horizon, num_paths):
+        ac_dim = len(self.high)
+        indices = np.arange(self.offset + 1, self.offset + num_paths + 1)
+        self.offset += num_paths
+        points = np.stack([radical_inverse(indices, base) for base in primes(horizon * ac_dim)], axis=1)
+        # Cranley-Patterson rotation, decorrelates successive calls
+        points = np.mod(points + np.random.uniform(size=horizon * ac_dim), 1.)
+        return self.scale(np.transpose(np.reshape(points, [num_paths, horizon, ac_dim]), [1, 0, 2]))
+
+class SobolProposal(Proposal):
+    """ Scrambled Sobol points in the horizon * ac_dim cube, needs scipy >= 1.7 (scipy.stats.qmc) """
+    def __init__(self, low, high, seed=None):
+        Proposal.__init__(self, low, high)
+        from scipy.stats import qmc
+        self.qmc = qmc
+        self.seed = seed
+
+    def sample(self, horizon, num_paths):
+        ac_dim = len(self.high)
+        sampler = self.qmc.Sobol(d=horizon * ac_dim, scramble=True, seed=self.seed)
+        points = sampler.random(num_paths)
+        return self.scale(np.transpose(np.reshape(points, [num_paths, horizon, ac_dim]), [1, 0, 2]))
+
+class ColoredNoiseProposal(Proposal):
+    """ Temporally correlated gaussian actions with a 1/f^beta spectrum over the horizon (beta 2 is close to a random walk) """
+    def __init__(self, low, high, beta=1., std=0.5):
+        Proposal.__init__(self, low, high)
+        self.beta = beta
+        self.std = std
+
+    def sample(self, horizon, num_paths):
+        return self.scale_gaussian(colored_noise(self.beta, [horizon, num_paths, len(self.high)]), self.std)
+
+class AR1Proposal(Proposal):
+    """ First order autoregressive actions: x_t = rho * x_t-1 + sqrt(1 - rho^2) * e_t, unit stationary std """
+    def __init__(self, low, high, rho=0.8, std=0.5):
+        Proposal.__init__(self, low, high)
+        self.rho = rho
+        self.std = std
+
+    def sample(self, horizon, num_paths):
+        noise = np.random.normal(size=[horizon, num_paths, len(self.high)])
+        for t in range(1, horizon):
+            noise[t] = self.rho * noise[t - 1] + np.sqrt(1 - self.rho ** 2) * noise[t]
+        return self.scale_gaussian(noise, self.std)
+
+def linear_basis(horizon, num_knots):
+    """ [horizon, num_knots] piecewise linear interpolation weights of evenly spaced knots """
+    knots = np.linspace(0, horizon - 1, num_knots)
+    steps = np.arange(horizon)[:, None]
+    spacing = knots[1] - knots[0] if num_knots > 1 else 1.
+    return np.maximum(1 - np.abs(steps - knots[None, :]) / spacing, 0.)
+
+class SplineProposal(Proposal):
+    """ Uniform actions at num_knots knots, linearly interpolated over the horizon: a num_knots * ac_dim search space """
+    def __init__(self, low, high, num_knots=3):
+        Proposal.__init__(self, low, high)
+        self.num_knots = num_knots
+
+    def sample(self, horizon, num_paths):
+        num_knots = min(self.num_knots, horizon)
+        knots = np.random.uniform(size=[num_knots, num_paths, len(self.high)])
+        return self.scale(np.einsum('hk,kpa->hpa', linear_basis(horizon, num_knots), knots))
+
+class PCAProposal(Proposal):
+    """ Gaussian sampling in the span of the top num_components temporal principal components of the last
+    history plans the controller chose. Falls back to uniform until min_history plans are collected. """
+    def __init__(self, low, high, num_components=3, history=200, min_history=20, std=1.):
+        Proposal.__init__(self, low, high)
+        self.num_components = num_components
+        self.history = history
+        self.min_history = min_history
+        self.std = std
+        self.plans = []
+
+    def update(self, action_path):
+        self.plans.append(np.array(action_path, copy=True))
+        self.plans = self.plans[-self.history:]
+
+    def snapshot(self):
+        snapshot = copy.copy(self)
+        snapshot.plans = list(self.plans)
+        return snapshot
+
+    def sample(self, horizon, num_paths):
+        plans = [plan for plan in self.plans if len(plan) == horizon]
+        if len(plans) < self.min_history:
+            return np.random.uniform(low=self.low, high=self.high, size=[horizon, num_paths, len(self.high)])
+
+        # centered per action dim, every action dim of every plan is one [horizon] sample of the temporal profile
+        plans = np.asarray(plans)
+        mean = np.mean(plans, axis=0)
+        data = np.reshape(np.transpose(plans - mean, [0, 2, 1]), [-1, horizon])
+        _, singular_values, components = np.linalg.svd(data, full_matrices=False)
+        k = min(self.num_components, len(singular_values))
+        component_std = singular_values[:k] / np.sqrt(len(data))
+
+        coefficients = np.random.normal(size=[num_paths, len(self.high), k]) * component_std * self.std
+        paths = mean[:, None, :] + np.transpose(np.einsum('pak,kh->pah', coefficients, components[:k]), [2, 0, 1])
+        return np.clip(paths, self.low, self.high)
+
+class RandomActionPool(Proposal):
+    """ Uniform actions served as zero-copy slices of a large pregenerated float32 buffer of size rows, drawn
+    in bulk from a seeded generator. The next buffer is generated ahead of time (in a background thread when
+    background is set) and swapped in when the current one is used up. Buffers are replaced rather than
+    overwritten, so plans kept as views of earlier slices (prev_action_path) stay valid.
+    Every slice is handed out once, callers may modify it in place. """
+    def __init__(self, low, high, size=2**19, seed=None, background=True):
+        Proposal.__init__(self, low, high)
+        self.size = size
+        self.rng = np.random.RandomState(seed)
+        # oversize requests are drawn on the caller's thread, from their own stream so the prefetch stays deterministic
+        self.oversize_rng = np.random.RandomState(self.rng.randint(2**31 - 1))
+        self.background = background
+        self.lock = threading.Lock()
+        self.buffer = self.generate(size)
+        self.position = 0
+        self.next_buffer = None
+        self.thread = None
+        self.prefetch()
+
+    def generate(self, rows, rng=None):
+        buffer = (rng or self.rng).random_sample([rows, len(self.high)]).astype(np.float32)
+        buffer *= (self.high - self.low).astype(np.float32)
+        buffer += self.low.astype(np.float32)
+        return buffer
+
+    def prefetch(self):
+        if self.background:
+            self.thread = threading.Thread(target=self.fill_next)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.next_buffer = None
+
+    def fill_next(self):
+        self.next_buffer = self.generate(self.size)
+
+    def take(self, rows):
+        """ [rows, ac_dim] uniform actions """
+        with self.lock:
+            if rows > self.size:
+                return self.generate(rows, self.oversize_rng)
+            if self.position + rows > self.size:
+                if self.thread is not None:
+                    self.thread.join()
+                    self.thread = None
+                self.buffer = self.next_buffer if self.next_buffer is not None else self.generate(self.size)
+                self.next_buffer = None
+                self.position = 0
+                self.prefetch()
+            actions = self.buffer[self.position:self.position + rows]
+            self.position += rows
+        return actions
+
+    def sample(self, horizon, num_paths):
+        return np.reshape(self.take(horizon * num_paths), [horizon, num_paths, len(self.high)])
+
+PROPOSALS = {'uniform': UniformProposal,
+             'halton': HaltonProposal,
+             'sobol': SobolProposal,
+             'colored': ColoredNoiseProposal,
+             'ar': AR1Proposal,
+             'spline': SplineProposal,
+             'pca': PCAProposal,
+             'pool': RandomActionPool}
+
+def make_proposal(name, env, **kwargs):
+    """ Proposal by name for the action space of env, kwargs go to the proposal constructor """
+    return PROPOSALS[name](env.action_space.low, env.action_space.high, **kwargs)
@@ -1,9 +1,10 @@
 import numpy as np
 import tensorflow as tf
 import gym
-from dynamics import NNDynamicsRewardModel, NNDynamicsModel
-from controllers import MPCcontroller, RandomController, MPCcontrollerPolicyNet, MPCcontrollerPolicyNetReward
-from cost_functions import cheetah_cost_fn, trajectory_cost_fn
+from dynamics import NNDynamicsRewardModel, NNDynamicsModel, NNDynamicsEnsembleModel, NNDynamicsStudentModel, NNDynamicsChunkModel
+from controllers import AdaptiveBudget, AsyncController, ReplanController, MPCcontroller, RandomController, MPCcontrollerPolicyNet, MPCcontrollerPolicyNetReward, CEMcontroller, MPPIcontroller, GradientMPCcontroller, TreeSearchcontrollerPolicyNetReward, ShardedMPCcontroller, ILQRcontroller, ChunkMPCcontroller
+from proposals import make_proposal, RandomActionPool
+from cost_functions import cheetah_cost_fn, cheetah_cost_fn_tf, trajectory_cost_fn
 import time
 import logz
 import os
@@ -73,8 +74,51 @@ tf.app.flags.DEFINE_integer('ep_len', 1000, '')
 # Neural network architecture args
 tf.app.flags.DEFINE_integer('n_layers', 2, '')
 tf.app.flags.DEFINE_integer('size', 256, '')
+tf.app.flags.DEFINE_integer('ensemble_size', 0, 'Without LEARN_REWARD use a bootstrapped ensemble of this many dynamics models, 0 uses a single model')
+tf.app.flags.DEFINE_float('disagreement_threshold', 0., 'Ensemble mpc: truncate imagined paths where the member disagreement (normalized delta std) exceeds this, 0 disables')
+tf.app.flags.DEFINE_integer('distill_size', 0, 'Plan with a student network of this width distilled from the dynamics model after every fit, 0 plans with the model itself')
+tf.app.flags.DEFINE_integer('distill_layers', 1, 'Student network hidden layers')
+tf.app.flags.DEFINE_integer('distill_iters', 200, 'Student distillation iterations per fit')
+tf.app.flags.DEFINE_string('quantize', '', 'Run the planning model in numpy with int8 or float16 dense layers calibrated on the model buffer, empty keeps float32')
+tf.app.flags.DEFINE_integer('numpy_threshold', 0, 'Batches up to this many rows run the model and policy forward pass in numpy instead of sess.run')
 # MPC Controller
 tf.app.flags.DEFINE_integer('mpc_horizon', 7, '')
+tf.app.flags.DEFINE_boolean('TERMINAL_VALUE', False, 'Add the discounted ppo value (vpred) of the final imagined states to the mpc path returns')
+tf.app.flags.DEFINE_float('value_weight', 1., 'Terminal value: weight of the value relative to the mpc costs')
+tf.app.flags.DEFINE_boolean('WARM_START', False, 'Seed the mpc samples with the shifted plan of the previous step')
+tf.app.flags.DEFINE_boolean('IN_GRAPH_ROLLOUT', False, 'Unroll the mpc rollouts inside one tf graph (single sess.run per step)')
+tf.app.flags.DEFINE_boolean('TREE_SEARCH', False, 'With LEARN_REWARD use batched tree search instead of policy rollouts for mpc ppo')
+tf.app.flags.DEFINE_integer('tree_iters', 20, 'Tree search iterations per step')
+tf.app.flags.DEFINE_integer('tree_batch', 8, 'Leaves expanded per tree search iteration')
+tf.app.flags.DEFINE_integer('tree_children', 4, 'Children per expanded leaf')
+tf.app.flags.DEFINE_string('prune_steps', '', 'Comma separated horizon steps after which mpc drops the worst paths, e.g. 5,10,20')
+tf.app.flags.DEFINE_float('prune_frac', 0.5, 'Fraction of the surviving paths dropped at every prune step')
+tf.app.flags.DEFINE_boolean('PRUNE_VALUE', False, 'Rank the paths at the prune steps by cost minus the ppo value of their current states')
+tf.app.flags.DEFINE_float('mpc_deadline', 0., 'Anytime mpc: wall clock budget per decision in seconds, 0 disables')
+tf.app.flags.DEFINE_integer('mpc_chunk', 100, 'Anytime mpc: paths evaluated per chunk')
+tf.app.flags.DEFINE_boolean('ADAPTIVE_BUDGET', False, 'Adapt simulated_paths and mpc_horizon per decision within the bounds below')
+tf.app.flags.DEFINE_integer('min_paths', 100, 'Adaptive budget: minimum simulated paths')
+tf.app.flags.DEFINE_integer('max_paths', 1600, 'Adaptive budget: maximum simulated paths')
+tf.app.flags.DEFINE_integer('min_horizon', 5, 'Adaptive budget: minimum mpc horizon')
+tf.app.flags.DEFINE_integer('max_horizon', 30, 'Adaptive budget: maximum mpc horizon')
+tf.app.flags.DEFINE_string('proposal', 'uniform', 'Action proposals of the mpc controllers: uniform (shared pregenerated action pool), halton, sobol, colored, ar, spline or pca')
+tf.app.flags.DEFINE_integer('replan_interval', 1, 'Execute the first replan_interval actions of every mpc plan open loop, 1 replans at every step')
+tf.app.flags.DEFINE_float('replan_threshold', 0.1, 'Replan early when the real state deviates from the model predicted one by more than this (in std_obs)')
+tf.app.flags.DEFINE_boolean('ASYNC_MPC', False, 'Plan the next step in a background thread from the model predicted state while the env steps')
+tf.app.flags.DEFINE_float('async_tolerance', 0.1, 'Async mpc: max deviation of the real from the predicted state (in std_obs) to keep the speculative plan')
+tf.app.flags.DEFINE_string('planner', 'rs', 'Planner of the random mpc controller: rs (random shooting), cem, mppi, sharded (rs across processes), grad (rs + gradient refinement), ilqr or chunk (rs through a chunk_size step model)')
+tf.app.flags.DEFINE_integer('cem_iters', 5, 'CEM iterations per step, simulated_paths are sampled every iteration')
+tf.app.flags.DEFINE_integer('cem_elites', 40, 'Number of CEM elite paths')
+tf.app.flags.DEFINE_integer('planner_workers', 4, 'Worker processes of the sharded planner')
+tf.app.flags.DEFINE_float('mppi_temperature', 1., 'MPPI temperature of the exponential cost weighting')
+tf.app.flags.DEFINE_float('mppi_noise', 0.5, 'MPPI noise std as a fraction of the action range')
+tf.app.flags.DEFINE_integer('grad_top_k', 10, 'Gradient planner: sampled paths refined by gradient descent')
+tf.app.flags.DEFINE_integer('grad_steps', 5, 'Gradient planner: gradient steps per decision')
+tf.app.flags.DEFINE_float('grad_step_size', 0.05, 'Gradient planner: step size as a fraction of the action range')
+tf.app.flags.DEFINE_integer('ilqr_iters', 3, 'iLQR iterations per step')
+tf.app.flags.DEFINE_float('ilqr_mu', 1., 'Initial iLQR regularization of Q_uu')
+tf.app.flags.DEFINE_integer('chunk_size', 5, 'Chunk planner: env steps predicted per model call')
+tf.app.flags.DEFINE_boolean('REPEAT_ACTIONS', False, 'Chunk planner: hold one sampled action for every chunk')
 
 tf.app.flags.DEFINE_boolean('mpc', False, 'mpc or not')
 tf.app.flags.DEFINE_boolean('mpc_rand', False, 'mpc_rand or not')
@@ -84,6 +128,7 @@ tf.app.flags.DEFINE_boolean('bc', False, 'bc or not')
 ############################
 def train(env, 
          cost_fn,
+         cost_fn_tf=None,
          logdir=None,
          render=False,
          learning_rate=1e-3,
@@ -135,6 +180,36 @@ def train(env,
 
     random_controller = RandomController(env)
 
+    prune_steps = [int(step) for step in FLAGS.prune_steps.split(',') if step]
+
+    # uniform random actions of all controllers come from one seeded pool
+    action_pool = RandomActionPool(env.action_space.low, env.action_space.high, seed=FLAGS.seed)
+
+    # every controller keeps its own proposal (pca learns from its plans)
+    def proposal():
+        if FLAGS.proposal != 'uniform':
+            return make_proposal(FLAGS.proposal, env)
+        return action_pool
+
+    # every controller keeps its own budget and stats
+    def adaptive_budget():
+        if FLAGS.ADAPTIVE_BUDGET:
+            return AdaptiveBudget(FLAGS.min_paths, FLAGS.max_paths, FLAGS.min_horizon, FLAGS.max_horizon)
+
+    # the planners use a distilled student when distill_size is set, dyn_model is still the one fit on data
+    def planning_model(dyn_model):
+        if FLAGS.distill_size:
+            return NNDynamicsStudentModel(teacher=dyn_model, 
+                                          n_layers=FLAGS.distill_layers, 
+                                          size=FLAGS.distill_size, 
+                                          activation=activation, 
+                                          batch_size=batch_size,
+                                          iterations=FLAGS.distill_iters,
+                                          learning_rate=learning_rate,
+                                          sess=sess,
+                                          numpy_threshold=FLAGS.numpy_threshold)
+        return dyn_model
+
     # Creat buffers
     model_data_buffer = DataBufferGeneral(FLAGS.MODELBUFFER_SIZE, 5)
     ppo_data_buffer = DataBufferGeneral(10000, 4)
@@ -175,7 +250,7 @@ def train(env,
 
     sess = tf.Session(config=tf_config)
 
-    policy_nn = MlpPolicy(sess=sess, env=env, hid_size=128, num_hid_layers=2, clip_param=clip_param , entcoeff=entcoeff)
+    policy_nn = MlpPolicy(sess=sess, env=env, hid_size=128, num_hid_layers=2, clip_param=clip_param , entcoeff=entcoeff, numpy_threshold=FLAGS.numpy_threshold)
 
     if FLAGS.LEARN_REWARD:
         print("Learn reward function")
@@ -184,45 +259,192 @@ def train(env,
                                         batch_size=batch_size,
                                         iterations=dynamics_iters,
                                         learning_rate=learning_rate,
-                                        sess=sess)
-
-        mpc_ppo_controller = MPCcontrollerPolicyNetReward(env=env, 
-                                       dyn_model=dyn_model, 
-                                       explore=FLAGS.MPC_EXP,
-                                       policy_net=policy_nn,
-                                       self_exp=FLAGS.SELFEXP,
-                                       horizon=mpc_horizon, 
-                                       num_simulated_paths=num_simulated_paths)
+                                        sess=sess,
+                                        numpy_threshold=FLAGS.numpy_threshold)
+        planner_model = planning_model(dyn_model)
+
+        if FLAGS.TREE_SEARCH:
+            mpc_ppo_controller = TreeSearchcontrollerPolicyNetReward(env=env, 
+                                           dyn_model=planner_model, 
+                                           explore=FLAGS.MPC_EXP,
+                                           policy_net=policy_nn,
+                                           self_exp=FLAGS.SELFEXP,
+                                           horizon=mpc_horizon, 
+                                           num_iterations=FLAGS.tree_iters,
+                                           expand_batch=FLAGS.tree_batch,
+                                           num_children=FLAGS.tree_children,
+                                           gamma=gamma,
+                                           proposal=action_pool)
+        else:
+            mpc_ppo_controller = MPCcontrollerPolicyNetReward(env=env, 
+                                           dyn_model=planner_model, 
+                                           explore=FLAGS.MPC_EXP,
+                                           policy_net=policy_nn,
+                                           self_exp=FLAGS.SELFEXP,
+                                           horizon=mpc_horizon, 
+                                           num_simulated_paths=num_simulated_paths,
+                                           warm_start=FLAGS.WARM_START,
+                                           in_graph=FLAGS.IN_GRAPH_ROLLOUT,
+                                           deadline=FLAGS.mpc_deadline,
+                                           chunk_size=FLAGS.mpc_chunk,
+                                           adaptive_budget=adaptive_budget(),
+                                           proposal=proposal(),
+                                           terminal_value=FLAGS.TERMINAL_VALUE,
+                                           value_weight=FLAGS.value_weight,
+                                           value_discount=gamma)
     else:
         print("Use predefined cost function")
-        dyn_model = NNDynamicsModel(env=env, 
-                                    n_layers=n_layers, 
-                                    size=size, 
-                                    activation=activation, 
-                                    output_activation=output_activation, 
-                                    normalization=normalization,
-                                    batch_size=batch_size,
-                                    iterations=dynamics_iters,
-                                    learning_rate=learning_rate,
-                                    sess=sess)
+        if FLAGS.ensemble_size:
+            dyn_model = NNDynamicsEnsembleModel(env=env, 
+                                                n_layers=n_layers, 
+                                                size=size, 
+                                                activation=activation, 
+                                                output_activation=output_activation, 
+                                                normalization=normalization,
+                                                batch_size=batch_size,
+                                                iterations=dynamics_iters,
+                                                learning_rate=learning_rate,
+                                                sess=sess,
+                                                ensemble_size=FLAGS.ensemble_size,
+                                                numpy_threshold=FLAGS.numpy_threshold)
+        else:
+            dyn_model = NNDynamicsModel(env=env, 
+                                        n_layers=n_layers, 
+                                        size=size, 
+                                        activation=activation, 
+                                        output_activation=output_activation, 
+                                        normalization=normalization,
+                                        batch_size=batch_size,
+                                        iterations=dynamics_iters,
+                                        learning_rate=learning_rate,
+                                        sess=sess,
+                                        numpy_threshold=FLAGS.numpy_threshold)
+        planner_model = planning_model(dyn_model)
 
         mpc_ppo_controller = MPCcontrollerPolicyNet(env=env, 
-                                       dyn_model=dyn_model, 
+                                       dyn_model=planner_model, 
                                        explore=FLAGS.MPC_EXP,
                                        policy_net=policy_nn,
                                        self_exp=FLAGS.SELFEXP,
                                        horizon=mpc_horizon, 
                                        cost_fn=cost_fn, 
-                                       num_simulated_paths=num_simulated_paths)
-
-    mpc_controller = MPCcontroller(env=env, 
-                                   dyn_model=dyn_model, 
-                                   horizon=mpc_horizon, 
-                                   cost_fn=cost_fn, 
-                                   num_simulated_paths=num_simulated_paths)
+                                       num_simulated_paths=num_simulated_paths,
+                                       warm_start=FLAGS.WARM_START,
+                                       in_graph=FLAGS.IN_GRAPH_ROLLOUT,
+                                       cost_fn_tf=cost_fn_tf,
+                                       prune_steps=prune_steps,
+                                       prune_fraction=FLAGS.prune_frac,
+                                       prune_value=FLAGS.PRUNE_VALUE,
+                                       deadline=FLAGS.mpc_deadline,
+                                       chunk_size=FLAGS.mpc_chunk,
+                                       adaptive_budget=adaptive_budget(),
+                                       proposal=proposal(),
+                                       terminal_value=FLAGS.TERMINAL_VALUE,
+                                       value_weight=FLAGS.value_weight,
+                                       value_discount=gamma)
+
+    # chunk planner model, fit on windows of the model buffer trajectories next to dyn_model
+    chunk_model = None
+    if FLAGS.planner == 'cem':
+        mpc_controller = CEMcontroller(env=env, 
+                                       dyn_model=planner_model, 
+                                       horizon=mpc_horizon, 
+                                       cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                       num_simulated_paths=num_simulated_paths,
+                                       num_elites=FLAGS.cem_elites,
+                                       iterations=FLAGS.cem_iters,
+                                       warm_start=FLAGS.WARM_START)
+    elif FLAGS.planner == 'mppi':
+        mpc_controller = MPPIcontroller(env=env, 
+                                        dyn_model=planner_model, 
+                                        horizon=mpc_horizon, 
+                                        cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                        num_simulated_paths=num_simulated_paths,
+                                        temperature=FLAGS.mppi_temperature,
+                                        noise_std=FLAGS.mppi_noise)
+    elif FLAGS.planner == 'grad':
+        mpc_controller = GradientMPCcontroller(env=env, 
+                                               dyn_model=planner_model, 
+                                               horizon=mpc_horizon, 
+                                               cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                               cost_fn_tf=None if FLAGS.LEARN_REWARD else cost_fn_tf, 
+                                               num_simulated_paths=num_simulated_paths,
+                                               top_k=FLAGS.grad_top_k,
+                                               refine_steps=FLAGS.grad_steps,
+                                               step_size=FLAGS.grad_step_size,
+                                               warm_start=FLAGS.WARM_START,
+                                               proposal=proposal())
+    elif FLAGS.planner == 'ilqr':
+        mpc_controller = ILQRcontroller(env=env, 
+                                        dyn_model=planner_model, 
+                                        horizon=mpc_horizon, 
+                                        cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                        iterations=FLAGS.ilqr_iters,
+                                        mu=FLAGS.ilqr_mu)
+    elif FLAGS.planner == 'chunk':
+        chunk_model = NNDynamicsChunkModel(env=env, 
+                                           chunk=FLAGS.chunk_size,
+                                           data=model_data_buffer,
+                                           n_layers=n_layers, 
+                                           size=size, 
+                                           activation=activation, 
+                                           normalization=normalization,
+                                           batch_size=batch_size,
+                                           iterations=dynamics_iters,
+                                           learning_rate=learning_rate,
+                                           sess=sess,
+                                           numpy_threshold=FLAGS.numpy_threshold)
+        mpc_controller = ChunkMPCcontroller(env=env, 
+                                            dyn_model=chunk_model, 
+                                            horizon=mpc_horizon, 
+                                            cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                            num_simulated_paths=num_simulated_paths,
+                                            repeat_actions=FLAGS.REPEAT_ACTIONS,
+                                            proposal=proposal(),
+                                            warm_start=FLAGS.WARM_START)
+    elif FLAGS.planner == 'sharded':
+        mpc_controller = ShardedMPCcontroller(env=env, 
+                                              dyn_model=planner_model, 
+                                              horizon=mpc_horizon, 
+                                              cost_fn=None if FLAGS.LEARN_REWARD else cost_fn, 
+                                              num_simulated_paths=num_simulated_paths,
+                                              num_workers=FLAGS.planner_workers)
+    else:
+        mpc_controller = MPCcontroller(env=env, 
+                                       dyn_model=planner_model, 
+                                       horizon=mpc_horizon, 
+                                       cost_fn=cost_fn, 
+                                       num_simulated_paths=num_simulated_paths,
+                                       warm_start=FLAGS.WARM_START,
+                                       in_graph=FLAGS.IN_GRAPH_ROLLOUT,
+                                       cost_fn_tf=cost_fn_tf,
+                                       prune_steps=prune_steps,
+                                       prune_fraction=FLAGS.prune_frac,
+                                       prune_value=FLAGS.PRUNE_VALUE,
+                                       deadline=FLAGS.mpc_deadline,
+                                       chunk_size=FLAGS.mpc_chunk,
+                                       ensemble_ts=FLAGS.ensemble_size > 0 and not FLAGS.LEARN_REWARD and not FLAGS.distill_size,
+                                       disagreement_threshold=FLAGS.disagreement_threshold or None,
+                                       adaptive_budget=adaptive_budget(),
+                                       proposal=proposal(),
+                                       value_net=policy_nn if FLAGS.TERMINAL_VALUE or FLAGS.PRUNE_VALUE else None,
+                                       terminal_value=FLAGS.TERMINAL_VALUE,
+                                       value_weight=FLAGS.value_weight,
+                                       value_discount=gamma)
     # if not PPO:
     #     mpc_ppo_controller = mpc_controller
 
+    if FLAGS.quantize:
+        planner_model.quantize(FLAGS.quantize, model_data_buffer)
+
+    if FLAGS.replan_interval > 1:
+        mpc_controller = ReplanController(mpc_controller, planner_model, interval=FLAGS.replan_interval, threshold=FLAGS.replan_threshold)
+        mpc_ppo_controller = ReplanController(mpc_ppo_controller, planner_model, interval=FLAGS.replan_interval, threshold=FLAGS.replan_threshold)
+
+    if FLAGS.ASYNC_MPC:
+        mpc_controller = AsyncController(mpc_controller, planner_model, tolerance=FLAGS.async_tolerance)
+        mpc_ppo_controller = AsyncController(mpc_ppo_controller, planner_model, tolerance=FLAGS.async_tolerance)
+
     #========================================================
     # 
     # Tensorflow session building.
@@ -258,6 +480,8 @@ def train(env,
     ppo_mpc = False
     mpc_returns = 0
     model_loss = 0
+    student_error = 0
+    chunk_loss = 0
     for itr in range(onpol_iters):
 
         print(" ")
@@ -277,6 +501,10 @@ def train(env,
         ################## fit mpc model
         if MPC:
             model_loss, reward_loss = dyn_model.fit(model_data_buffer)
+            if planner_model is not dyn_model:
+                _, student_error = planner_model.fit(model_data_buffer)
+            if chunk_model is not None:
+                chunk_loss, _ = chunk_model.fit(model_data_buffer)
 
 
         ################## ppo seg data
@@ -404,6 +632,35 @@ def train(env,
         logz.log_tabular("EpLenMean", np.mean(ep_lengths))
         logz.log_tabular("EpLenStd", np.std(ep_lengths))
         logz.log_tabular("TimestepsSoFar", timesteps_so_far)
+        if FLAGS.mpc_deadline:
+            # planner stats are logged with the first (PPO) row since it defines the log columns
+            anytime_samples, missed_deadlines = mpc_ppo_controller.anytime_stats()
+            logz.log_tabular("AnytimeSamples", anytime_samples)
+            logz.log_tabular("MissedDeadlines", missed_deadlines)
+        if FLAGS.ADAPTIVE_BUDGET:
+            # average budget actually spent per decision this iteration, 0 for controllers without one
+            for name, controller in [("MpcPpo", mpc_ppo_controller), ("MpcRand", mpc_controller)]:
+                budget = getattr(controller, "adaptive_budget", None)
+                paths, horizon, rows = budget.stats() if budget else (0, 0, 0)
+                logz.log_tabular(name + "Paths", paths)
+                logz.log_tabular(name + "Horizon", horizon)
+                logz.log_tabular(name + "ModelRows", rows)
+        if FLAGS.ASYNC_MPC:
+            logz.log_tabular("MpcPpoSpeculationHits", mpc_ppo_controller.async_stats())
+            logz.log_tabular("MpcRandSpeculationHits", mpc_controller.async_stats())
+        if FLAGS.replan_interval > 1:
+            # fraction of env steps that called the planner
+            logz.log_tabular("MpcPpoReplanRate", mpc_ppo_controller.replan_stats())
+            logz.log_tabular("MpcRandReplanRate", mpc_controller.replan_stats())
+        if FLAGS.distill_size:
+            # rms student error against the model, normalized delta units
+            logz.log_tabular("StudentError", student_error)
+        if chunk_model is not None:
+            # normalized chunk delta loss of the last fit batch
+            logz.log_tabular("ChunkModelLoss", chunk_loss)
+        # rollout workspace (re)allocations per decision, should stay 0 once the buffers are sized
+        logz.log_tabular("MpcPpoAllocations", mpc_ppo_controller.workspace_stats())
+        logz.log_tabular("MpcRandAllocations", mpc_controller.workspace_stats())
         logz.log_tabular("Condition", "PPO")
         logz.dump_tabular()
 
@@ -464,6 +721,10 @@ def train(env,
             save_path = saver.save(sess, logdir+"/model.ckpt")
             print("Model saved in path: %s" % save_path)
 
+    # planner worker processes and threads
+    mpc_controller.close()
+    mpc_ppo_controller.close()
+
 def build_summary_ops(logdir, env):
 
     summary_writer = tf.summary.FileWriter(logdir)
@@ -513,6 +774,7 @@ def main():
     if FLAGS.env_name == "HalfCheetah-v1":
         env = HalfCheetahEnvNew()
         cost_fn = cheetah_cost_fn
+        cost_fn_tf = cheetah_cost_fn_tf
 
         # env = gym.make(FLAGS.env_name)
         env.seed(FLAGS.seed)
@@ -520,9 +782,11 @@ def main():
         env = gym.make(FLAGS.env_name)
         env.seed(FLAGS.seed)
         cost_fn = None
+        cost_fn_tf = None
         
     train(env=env, 
                  cost_fn=cost_fn,
+                 cost_fn_tf=cost_fn_tf,
                  logdir=logdir,
                  render=FLAGS.render,
                  learning_rate=FLAGS.learning_rate,
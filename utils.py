@@ -110,6 +110,7 @@ def sample(env,
             st = env.reset()
 
         path = {'observations': [], 'actions': [], 'rewards': [], 'next_observations':[]}
+        controller.reset()
 
         for t in range(horizon):
            at = controller.get_action(st)
@@ -164,6 +165,8 @@ def traj_segment_generator(pi, mpc_controller, mpc_ppo_controller, bc_data_buffe
     t = 0
     ac = env.action_space.sample() # not used, just so we have the datatype
     ob = env.reset()
+    mpc_controller.reset()
+    mpc_ppo_controller.reset()
     new = True # marks if we're on first timestep of an episode
 
     cur_ep_ret = 0 # return in current episode
@@ -231,6 +234,9 @@ def traj_segment_generator(pi, mpc_controller, mpc_ppo_controller, bc_data_buffe
             print("ep_rets ", ep_rets)
             print("ep_lens ", ep_lens)
 
+            # no background planning while the model is fit
+            mpc_controller.wait()
+            mpc_ppo_controller.wait()
             break
 
 